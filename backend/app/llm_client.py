@@ -0,0 +1,798 @@
+"""LLM（Ollama / OpenAI）への HTTP クライアント。
+
+- 接続はホストごとに keep-alive で使い回す（同期は http.client、非同期は asyncio のストリーム）
+- OLLAMA_BASE_URL / AI_PROVIDER / AI_DEVICE などの環境変数は LLMConfig に一度だけ解決する
+- 応答の後処理（重複行の除去など）や HTTPException への変換は呼び出し側（main.py）で行う
+"""
+
+from __future__ import annotations
+
+import asyncio
+import http.client
+import json
+import os
+import socket
+import ssl
+import threading
+import urllib.parse
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_OLLAMA_BASE_URL = "http://127.0.0.1:11434"
+DEFAULT_OLLAMA_MODEL = "qwen2.5-coder:7b"
+DEFAULT_OPENAI_BASE_URL = "https://api.openai.com/v1"
+DEFAULT_OPENAI_MODEL = "gpt-4o-mini"
+DEFAULT_HTTP_TIMEOUT = 1800.0
+
+# ホストごとに保持するアイドル接続数の上限
+POOL_MAX_IDLE = 8
+
+
+class CancelledError(Exception):
+  """CancelToken でキャンセルされた"""
+
+
+class LLMHTTPError(Exception):
+  """LLM サーバーが 4xx / 5xx を返した"""
+
+  def __init__(self, status: int, body: str):
+    super().__init__(f"HTTP {status}: {body}")
+    self.status = status
+    self.body = body
+
+
+@dataclass(frozen=True)
+class LLMConfig:
+  provider: str
+  ollama_base_url: str
+  ollama_model: str
+  device: str
+  openai_api_key: Optional[str]
+  openai_base_url: str
+  openai_model: str
+  http_timeout: float
+  # インライン補完で FIM（/api/generate の raw プロンプト）を使うか。対応テンプレートのあるモデルのみ
+  inline_fim: bool = True
+  # Ollama の keep_alive（"30m" / 秒数 / -1 で常駐）。None なら送らず Ollama の既定（5 分）に任せる
+  keep_alive: Optional[Any] = None
+  # モデルごとの keep_alive。((モデル名, 値), ...)。タグなしの名前はそのファミリー全体に効く
+  keep_alive_models: Tuple[Tuple[str, Any], ...] = ()
+  # モデルに使える VRAM (GB)。None なら不明（自動検出はしない）
+  vram_gb: Optional[int] = None
+
+  @classmethod
+  def from_env(cls) -> "LLMConfig":
+    provider = (os.environ.get("AI_PROVIDER") or "").strip().lower()
+    api_key = os.environ.get("OPENAI_API_KEY") or None
+    if not provider:
+      provider = "openai" if api_key else "ollama"
+    timeout = DEFAULT_HTTP_TIMEOUT
+    raw = (os.environ.get("AI_LLM_HTTP_TIMEOUT") or "").strip()
+    if raw:
+      try:
+        if float(raw) >= 30:
+          timeout = float(raw)
+      except ValueError:
+        pass
+    return cls(
+      provider=provider,
+      ollama_base_url=(os.environ.get("OLLAMA_BASE_URL") or DEFAULT_OLLAMA_BASE_URL).rstrip("/"),
+      ollama_model=os.environ.get("OLLAMA_MODEL") or DEFAULT_OLLAMA_MODEL,
+      device=(os.environ.get("AI_DEVICE") or "cpu").lower(),
+      openai_api_key=api_key,
+      openai_base_url=(os.environ.get("OPENAI_BASE_URL") or DEFAULT_OPENAI_BASE_URL).rstrip("/"),
+      openai_model=os.environ.get("OPENAI_MODEL") or DEFAULT_OPENAI_MODEL,
+      http_timeout=timeout,
+      inline_fim=(os.environ.get("AI_INLINE_FIM") or "1").strip().lower() not in ("0", "false", "off", "no"),
+      keep_alive=_parse_keep_alive(os.environ.get("AI_KEEP_ALIVE") or ""),
+      keep_alive_models=_parse_keep_alive_models(os.environ.get("AI_KEEP_ALIVE_MODELS") or ""),
+      vram_gb=_parse_vram_gb(os.environ.get("AI_VRAM_GB") or ""),
+    )
+
+  def keep_alive_for(self, model: Optional[str]) -> Optional[Any]:
+    """model に効く keep_alive。完全一致 → タグなしの名前 → 全体設定の順で探す"""
+    name = (model or self.ollama_model).strip()
+    short = name.split(":", 1)[0]
+    found = None
+    for key, value in self.keep_alive_models:
+      if key == name:
+        return value
+      if found is None and key == short:
+        found = value
+    return found if found is not None else self.keep_alive
+
+
+def _parse_keep_alive(raw: str) -> Optional[Any]:
+  """"10m" などの期間文字列はそのまま、整数だけの値は秒数として int にする（Ollama は "-1" を期間として受け付けない）"""
+  raw = raw.strip()
+  if not raw:
+    return None
+  try:
+    return int(raw)
+  except ValueError:
+    return raw
+
+
+def _parse_vram_gb(raw: str) -> Optional[int]:
+  try:
+    return int(raw.strip())
+  except ValueError:
+    return None
+
+
+def _parse_keep_alive_models(raw: str) -> Tuple[Tuple[str, Any], ...]:
+  """"qwen3.5:9b=1h, deepseek-coder=10m" 形式（モデル名にコロンが入るので区切りは =）"""
+  pairs: List[Tuple[str, Any]] = []
+  for item in raw.split(","):
+    name, sep, value = item.partition("=")
+    parsed = _parse_keep_alive(value)
+    if sep and name.strip() and parsed is not None:
+      pairs.append((name.strip(), parsed))
+  return tuple(pairs)
+
+
+_config: Optional[LLMConfig] = None
+_config_lock = threading.Lock()
+
+
+def get_llm_config() -> LLMConfig:
+  """解決済みの設定（初回だけ環境変数を読む）"""
+  global _config
+  cfg = _config
+  if cfg is None:
+    with _config_lock:
+      if _config is None:
+        _config = LLMConfig.from_env()
+      cfg = _config
+  return cfg
+
+
+def reload_llm_config() -> LLMConfig:
+  """環境変数を変えたあとに呼ぶ。プロバイダも作り直す"""
+  global _config
+  with _config_lock:
+    _config = LLMConfig.from_env()
+    _providers.clear()
+  return _config
+
+
+class CancelToken:
+  """別スレッドから生成を打ち切るためのトークン。
+  cancel() すると、応答待ち・読み取り中のソケットも閉じる（LLM 側も接続断で生成をやめる）"""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._cancelled = False
+    self._callbacks: List[Any] = []
+
+  @property
+  def cancelled(self) -> bool:
+    return self._cancelled
+
+  def cancel(self) -> None:
+    with self._lock:
+      if self._cancelled:
+        return
+      self._cancelled = True
+      callbacks, self._callbacks = self._callbacks, []
+    for fn in callbacks:
+      try:
+        fn()
+      except Exception:
+        pass
+
+  def on_cancel(self, fn):
+    """キャンセル時に呼ぶ関数を登録し、登録を外す関数を返す（キャンセル済みならすぐ呼ぶ）"""
+    with self._lock:
+      if not self._cancelled:
+        self._callbacks.append(fn)
+        return lambda: self._remove(fn)
+    fn()
+    return lambda: None
+
+  def _remove(self, fn) -> None:
+    with self._lock:
+      try:
+        self._callbacks.remove(fn)
+      except ValueError:
+        pass
+
+
+def _shutdown_conn(conn: http.client.HTTPConnection) -> None:
+  sock = conn.sock
+  if sock is not None:
+    try:
+      sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+
+
+def _split_url(url: str) -> Tuple[tuple, str]:
+  """URL を (接続キー, リクエストパス) に分ける"""
+  parts = urllib.parse.urlsplit(url)
+  scheme = parts.scheme or "http"
+  port = parts.port or (443 if scheme == "https" else 80)
+  path = parts.path or "/"
+  if parts.query:
+    path += "?" + parts.query
+  return (scheme, parts.hostname or "127.0.0.1", port), path
+
+
+# ===== 同期クライアント =====
+
+
+class PooledResponse:
+  """http.client の応答。最後まで読んだら接続をプールに返し、途中で閉じたら接続ごと捨てる"""
+
+  def __init__(self, pool: "HTTPPool", key: tuple, conn: http.client.HTTPConnection, resp: http.client.HTTPResponse,
+               unregister=None):
+    self.status = resp.status
+    self._pool = pool
+    self._key = key
+    self._conn: Optional[http.client.HTTPConnection] = conn
+    self._resp = resp
+    # キャンセル時にこの接続を閉じるフックの登録解除（プールに戻す前に外す）
+    self._unregister = unregister
+
+  def read(self) -> bytes:
+    data = self._resp.read()
+    self._finish(reuse=True)
+    return data
+
+  def iter_lines(self) -> Iterator[bytes]:
+    """届いた分から 1 行ずつ返す（read(n) と違いチャンクが n バイト溜まるのを待たない）"""
+    buf = b""
+    while True:
+      chunk = self._resp.read1(65536)
+      if not chunk:
+        break
+      buf += chunk
+      while b"\n" in buf:
+        line, buf = buf.split(b"\n", 1)
+        yield line
+    if buf:
+      yield buf
+    self._finish(reuse=True)
+
+  def close(self) -> None:
+    self._finish(reuse=False)
+
+  def _finish(self, reuse: bool) -> None:
+    conn, self._conn = self._conn, None
+    if conn is None:
+      return
+    if self._unregister is not None:
+      self._unregister()
+    if reuse and self._resp.isclosed() and not self._resp.will_close:
+      self._pool.release(self._key, conn)
+    else:
+      conn.close()
+
+  def __enter__(self) -> "PooledResponse":
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.close()
+
+
+class HTTPPool:
+  """(scheme, host, port) ごとの keep-alive 接続プール（スレッドセーフ）"""
+
+  def __init__(self, max_idle: int = POOL_MAX_IDLE):
+    self._lock = threading.Lock()
+    self._idle: Dict[tuple, List[http.client.HTTPConnection]] = {}
+    self._max_idle = max_idle
+
+  def _acquire(self, key: tuple, timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+    with self._lock:
+      idle = self._idle.get(key)
+      conn = idle.pop() if idle else None
+    if conn is not None:
+      conn.timeout = timeout
+      if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+      return conn, True
+    scheme, host, port = key
+    if scheme == "https":
+      return http.client.HTTPSConnection(host, port, timeout=timeout), False
+    return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+  def release(self, key: tuple, conn: http.client.HTTPConnection) -> None:
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self._max_idle:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def request(
+    self,
+    method: str,
+    url: str,
+    body: Optional[bytes] = None,
+    headers: Optional[Dict[str, str]] = None,
+    timeout: float = DEFAULT_HTTP_TIMEOUT,
+    cancel: Optional[CancelToken] = None,
+  ) -> PooledResponse:
+    """リクエストを送り、ヘッダーまで受けた応答を返す。4xx / 5xx は LLMHTTPError。
+    cancel を渡すと、キャンセル時にこの接続を閉じる（その接続はプールに戻さない）"""
+    key, path = _split_url(url)
+    hdrs = dict(headers or {})
+    if body is not None:
+      hdrs.setdefault("Content-Type", "application/json")
+    while True:
+      conn, reused = self._acquire(key, timeout)
+      unregister = None
+      if cancel is not None:
+        if cancel.cancelled:
+          self.release(key, conn)
+          raise CancelledError()
+        unregister = cancel.on_cancel(lambda conn=conn: _shutdown_conn(conn))
+      try:
+        conn.request(method, path, body=body, headers=hdrs)
+        resp = conn.getresponse()
+        break
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        if unregister is not None:
+          unregister()
+        conn.close()
+        if cancel is not None and cancel.cancelled:
+          raise CancelledError()
+        # サーバー側でアイドル切断された再利用接続なら、新しい接続で 1 回だけやり直す
+        if not reused:
+          raise
+      except BaseException:
+        if unregister is not None:
+          unregister()
+        conn.close()
+        if cancel is not None and cancel.cancelled:
+          raise CancelledError()
+        raise
+    pooled = PooledResponse(self, key, conn, resp, unregister)
+    if resp.status >= 400:
+      detail = pooled.read().decode("utf-8", errors="replace")
+      raise LLMHTTPError(resp.status, detail)
+    return pooled
+
+
+# ===== 非同期クライアント =====
+
+
+class AsyncPooledResponse:
+  """asyncio ストリーム上の HTTP/1.1 応答（chunked / Content-Length / 切断まで のいずれか）"""
+
+  def __init__(self, pool: "AsyncHTTPPool", key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+               status: int, headers: Dict[str, str], timeout: float):
+    self.status = status
+    self.headers = headers
+    self._pool = pool
+    self._key = key
+    self._reader = reader
+    self._writer: Optional[asyncio.StreamWriter] = writer
+    self._timeout = timeout
+    self._reusable = headers.get("connection", "").lower() != "close"
+
+  async def _read(self, coro):
+    return await asyncio.wait_for(coro, self._timeout)
+
+  async def iter_chunks(self) -> AsyncIterator[bytes]:
+    try:
+      if "chunked" in self.headers.get("transfer-encoding", "").lower():
+        while True:
+          size_line = await self._read(self._reader.readline())
+          if not size_line:
+            raise ConnectionError("connection closed in chunked body")
+          size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+          if size == 0:
+            # trailer を読み飛ばす
+            while (await self._read(self._reader.readline())).strip():
+              pass
+            break
+          data = await self._read(self._reader.readexactly(size))
+          await self._read(self._reader.readexactly(2))
+          yield data
+      elif "content-length" in self.headers:
+        remaining = int(self.headers["content-length"])
+        while remaining > 0:
+          data = await self._read(self._reader.read(min(remaining, 65536)))
+          if not data:
+            raise ConnectionError("connection closed before end of body")
+          remaining -= len(data)
+          yield data
+      else:
+        self._reusable = False
+        while True:
+          data = await self._read(self._reader.read(65536))
+          if not data:
+            break
+          yield data
+    except BaseException:
+      self._reusable = False
+      self.close()
+      raise
+    self._finish()
+
+  async def iter_lines(self) -> AsyncIterator[bytes]:
+    buf = b""
+    async for chunk in self.iter_chunks():
+      buf += chunk
+      while b"\n" in buf:
+        line, buf = buf.split(b"\n", 1)
+        yield line
+    if buf:
+      yield buf
+
+  async def read(self) -> bytes:
+    parts = [chunk async for chunk in self.iter_chunks()]
+    return b"".join(parts)
+
+  def _finish(self) -> None:
+    writer, self._writer = self._writer, None
+    if writer is None:
+      return
+    if self._reusable:
+      self._pool.release(self._key, self._reader, writer)
+    else:
+      writer.close()
+
+  def close(self) -> None:
+    """最後まで読まずに閉じる（生成の打ち切り）。接続ごと捨てるので LLM 側も生成を止める"""
+    writer, self._writer = self._writer, None
+    if writer is not None:
+      writer.close()
+
+
+class AsyncHTTPPool:
+  """イベントループ上の keep-alive 接続プール。ブロッキングスレッドを使わずにストリームを読む"""
+
+  def __init__(self, max_idle: int = POOL_MAX_IDLE):
+    self._idle: Dict[tuple, List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+    self._max_idle = max_idle
+    self._ssl: Optional[ssl.SSLContext] = None
+
+  def _pool_key(self, key: tuple) -> tuple:
+    # 接続はループに紐づくので、ループごとに分ける
+    return (id(asyncio.get_running_loop()),) + key
+
+  async def _connect(self, key: tuple) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    scheme, host, port = key
+    if scheme == "https":
+      if self._ssl is None:
+        self._ssl = ssl.create_default_context()
+      return await asyncio.open_connection(host, port, ssl=self._ssl, server_hostname=host)
+    return await asyncio.open_connection(host, port)
+
+  def release(self, pool_key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    idle = self._idle.setdefault(pool_key, [])
+    if len(idle) < self._max_idle and not reader.at_eof():
+      idle.append((reader, writer))
+    else:
+      writer.close()
+
+  async def request(
+    self,
+    method: str,
+    url: str,
+    body: Optional[bytes] = None,
+    headers: Optional[Dict[str, str]] = None,
+    timeout: float = DEFAULT_HTTP_TIMEOUT,
+  ) -> AsyncPooledResponse:
+    key, path = _split_url(url)
+    pool_key = self._pool_key(key)
+    scheme, host, port = key
+    default_port = 443 if scheme == "https" else 80
+    lines = [
+      f"{method} {path} HTTP/1.1",
+      f"Host: {host}" if port == default_port else f"Host: {host}:{port}",
+      "Connection: keep-alive",
+    ]
+    hdrs = dict(headers or {})
+    if body is not None:
+      hdrs.setdefault("Content-Type", "application/json")
+      hdrs["Content-Length"] = str(len(body))
+    lines.extend(f"{k}: {v}" for k, v in hdrs.items())
+    raw = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+
+    while True:
+      idle = self._idle.get(pool_key)
+      reused = bool(idle)
+      if idle:
+        reader, writer = idle.pop()
+      else:
+        reader, writer = await asyncio.wait_for(self._connect(key), timeout)
+      try:
+        writer.write(raw)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        if not status_line:
+          raise ConnectionResetError("connection closed by server")
+        break
+      except (ConnectionResetError, BrokenPipeError):
+        writer.close()
+        # アイドル中に切られた再利用接続なら、新しい接続で 1 回だけやり直す
+        if not reused:
+          raise
+      except BaseException:
+        writer.close()
+        raise
+
+    try:
+      parts = status_line.decode("latin-1").split(None, 2)
+      status = int(parts[1])
+      resp_headers: Dict[str, str] = {}
+      while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if not line or line in (b"\r\n", b"\n"):
+          break
+        name, _, value = line.decode("latin-1").partition(":")
+        resp_headers[name.strip().lower()] = value.strip()
+    except BaseException:
+      writer.close()
+      raise
+    resp = AsyncPooledResponse(self, pool_key, reader, writer, status, resp_headers, timeout)
+    if status >= 400:
+      detail = (await resp.read()).decode("utf-8", errors="replace")
+      raise LLMHTTPError(status, detail)
+    return resp
+
+
+_http_pool = HTTPPool()
+_async_http_pool = AsyncHTTPPool()
+
+
+# ===== プロバイダ =====
+
+
+def _ollama_events(line: bytes) -> List[dict]:
+  """Ollama NDJSON の 1 行を {"type": "token" | "done", ...} に変換"""
+  line = line.strip()
+  if not line:
+    return []
+  try:
+    ev = json.loads(line.decode("utf-8", errors="replace"))
+  except json.JSONDecodeError:
+    return []
+  out: List[dict] = []
+  msg = str((ev.get("message") or {}).get("content") or "")
+  if msg:
+    out.append({"type": "token", "delta": msg})
+  if ev.get("done"):
+    out.append({"type": "done", "truncated": str(ev.get("done_reason") or "").lower() == "length"})
+  return out
+
+
+def _ollama_generate_events(line: bytes) -> List[dict]:
+  """Ollama /api/generate の NDJSON 1 行を {"type": "token" | "done", ...} に変換"""
+  line = line.strip()
+  if not line:
+    return []
+  try:
+    ev = json.loads(line.decode("utf-8", errors="replace"))
+  except json.JSONDecodeError:
+    return []
+  out: List[dict] = []
+  piece = str(ev.get("response") or "")
+  if piece:
+    out.append({"type": "token", "delta": piece})
+  if ev.get("done"):
+    out.append({"type": "done", "truncated": str(ev.get("done_reason") or "").lower() == "length"})
+  return out
+
+
+def _openai_events(line: bytes) -> List[dict]:
+  """OpenAI SSE の 1 行を {"type": "token" | "done", ...} に変換"""
+  text = line.decode("utf-8", errors="replace").strip()
+  if not text.startswith("data:"):
+    return []
+  data_str = text[len("data:"):].strip()
+  if data_str == "[DONE]":
+    return [{"type": "done", "truncated": False}]
+  try:
+    ev = json.loads(data_str)
+  except json.JSONDecodeError:
+    return []
+  out: List[dict] = []
+  for choice in ev.get("choices") or []:
+    piece = str((choice.get("delta") or {}).get("content") or "")
+    if piece:
+      out.append({"type": "token", "delta": piece})
+    if str(choice.get("finish_reason") or "").lower() == "length":
+      out.append({"type": "done", "truncated": True})
+  return out
+
+
+class LLMProvider:
+  """chat / stream_chat / astream_chat を持つプロバイダの共通部分。
+  stream 系は {"type": "token", "delta"} を逐次返し、最後に {"type": "done", "truncated"} を 1 回返す"""
+
+  name = ""
+  _chat_path = ""
+  _line_events = staticmethod(_ollama_events)
+
+  def __init__(self, config: LLMConfig):
+    self.config = config
+
+  def _url(self, path: str) -> str:
+    raise NotImplementedError
+
+  def _headers(self) -> Dict[str, str]:
+    return {}
+
+  def _chat_body(self, messages: list, max_tokens: int, temperature: float, model: Optional[str], stream: bool) -> dict:
+    raise NotImplementedError
+
+  def _parse_chat(self, data: dict) -> Tuple[str, bool]:
+    raise NotImplementedError
+
+  def chat(self, messages: list, max_tokens: int = 512, temperature: float = 0.2, model: Optional[str] = None) -> Tuple[str, bool]:
+    """(content, truncated) を返す"""
+    body = json.dumps(self._chat_body(messages, max_tokens, temperature, model, False)).encode("utf-8")
+    with _http_pool.request("POST", self._url(self._chat_path), body, self._headers(), self.config.http_timeout) as resp:
+      data = json.loads(resp.read().decode("utf-8", errors="replace"))
+    return self._parse_chat(data)
+
+  def stream_chat(
+    self,
+    messages: list,
+    max_tokens: int = 512,
+    temperature: float = 0.2,
+    model: Optional[str] = None,
+    cancel: Optional[CancelToken] = None,
+  ) -> Iterator[dict]:
+    """cancel された場合は CancelledError（done は返さない）"""
+    body = self._chat_body(messages, max_tokens, temperature, model, True)
+    return self._stream_events(self._chat_path, body, self._line_events, cancel)
+
+  def _stream_events(self, path: str, payload: dict, line_events, cancel: Optional[CancelToken]) -> Iterator[dict]:
+    body = json.dumps(payload).encode("utf-8")
+    truncated = False
+    try:
+      with _http_pool.request(
+        "POST", self._url(path), body, self._headers(), self.config.http_timeout, cancel=cancel,
+      ) as resp:
+        for line in resp.iter_lines():
+          for ev in line_events(line):
+            if ev["type"] == "done":
+              truncated = truncated or ev["truncated"]
+            else:
+              yield ev
+    except Exception:
+      # 閉じたソケットからの読み取りエラーはキャンセルとして扱う
+      if cancel is not None and cancel.cancelled:
+        raise CancelledError()
+      raise
+    if cancel is not None and cancel.cancelled:
+      raise CancelledError()
+    yield {"type": "done", "truncated": truncated}
+
+  async def astream_chat(
+    self, messages: list, max_tokens: int = 512, temperature: float = 0.2, model: Optional[str] = None,
+  ) -> AsyncIterator[dict]:
+    body = json.dumps(self._chat_body(messages, max_tokens, temperature, model, True)).encode("utf-8")
+    truncated = False
+    resp = await _async_http_pool.request("POST", self._url(self._chat_path), body, self._headers(), self.config.http_timeout)
+    try:
+      async for line in resp.iter_lines():
+        for ev in self._line_events(line):
+          if ev["type"] == "done":
+            truncated = truncated or ev["truncated"]
+          else:
+            yield ev
+    finally:
+      resp.close()
+    yield {"type": "done", "truncated": truncated}
+
+
+class OllamaProvider(LLMProvider):
+  name = "ollama"
+  _chat_path = "/api/chat"
+  _line_events = staticmethod(_ollama_events)
+
+  def _url(self, path: str) -> str:
+    return f"{self.config.ollama_base_url}{path}"
+
+  def _options(self, max_tokens: int, temperature: float) -> Dict[str, Any]:
+    options: Dict[str, Any] = {"temperature": temperature, "num_predict": max_tokens}
+    if self.config.device == "cpu":
+      # GPU を使わず CPU のみで実行させる
+      options["num_gpu"] = 0
+    return options
+
+  def _with_keep_alive(self, body: dict) -> dict:
+    # 毎回同じ値を送らないと、既定の 5 分でアンロードされてプレフィックスの KV キャッシュも失われる
+    keep_alive = self.config.keep_alive_for(body.get("model"))
+    if keep_alive is not None:
+      body["keep_alive"] = keep_alive
+    return body
+
+  def _chat_body(self, messages: list, max_tokens: int, temperature: float, model: Optional[str], stream: bool) -> dict:
+    return self._with_keep_alive({
+      "model": model or self.config.ollama_model,
+      "messages": messages,
+      "stream": stream,
+      "options": self._options(max_tokens, temperature),
+    })
+
+  def stream_generate(
+    self,
+    prompt: str,
+    max_tokens: int = 256,
+    temperature: float = 0.1,
+    model: Optional[str] = None,
+    stop: Optional[List[str]] = None,
+    raw: bool = True,
+    cancel: Optional[CancelToken] = None,
+  ) -> Iterator[dict]:
+    """/api/generate をストリームで呼ぶ。raw=True ならテンプレートを通さず prompt をそのまま渡す（FIM 用）"""
+    options = self._options(max_tokens, temperature)
+    if stop:
+      options["stop"] = list(stop)
+    body = {"model": model or self.config.ollama_model, "prompt": prompt, "raw": raw, "stream": True, "options": options}
+    self._with_keep_alive(body)
+    return self._stream_events("/api/generate", body, _ollama_generate_events, cancel)
+
+  def _parse_chat(self, data: dict) -> Tuple[str, bool]:
+    content = str(data.get("message", {}).get("content", "")).strip()
+    return content, str(data.get("done_reason") or "").lower() == "length"
+
+  def request_json(self, path: str, method: str = "GET", payload: Optional[dict] = None, timeout: float = 30) -> dict:
+    """/api/ps や /api/stop などの管理 API"""
+    body = json.dumps(payload).encode("utf-8") if payload is not None else None
+    with _http_pool.request(method, self._url(path), body, None, timeout) as resp:
+      return json.loads(resp.read().decode("utf-8", errors="replace") or "{}")
+
+  def stream_json(self, path: str, payload: dict, timeout: float = 600) -> Iterator[dict]:
+    """NDJSON を返す管理 API（/api/pull の進捗など）"""
+    body = json.dumps(payload).encode("utf-8")
+    with _http_pool.request("POST", self._url(path), body, None, timeout) as resp:
+      for line in resp.iter_lines():
+        line = line.strip()
+        if not line:
+          continue
+        try:
+          yield json.loads(line.decode("utf-8", errors="replace"))
+        except json.JSONDecodeError:
+          pass
+
+
+class OpenAIProvider(LLMProvider):
+  name = "openai"
+  _chat_path = "/chat/completions"
+  _line_events = staticmethod(_openai_events)
+
+  def _url(self, path: str) -> str:
+    return f"{self.config.openai_base_url}{path}"
+
+  def _headers(self) -> Dict[str, str]:
+    if not self.config.openai_api_key:
+      raise RuntimeError("OPENAI_API_KEY is not set")
+    return {"Authorization": f"Bearer {self.config.openai_api_key}"}
+
+  def _chat_body(self, messages: list, max_tokens: int, temperature: float, model: Optional[str], stream: bool) -> dict:
+    # OpenAI は OPENAI_MODEL 固定（model は Ollama のモデル名なので使わない）
+    body = {"model": self.config.openai_model, "temperature": temperature, "max_tokens": max_tokens, "messages": messages}
+    if stream:
+      body["stream"] = True
+    return body
+
+  def _parse_chat(self, data: dict) -> Tuple[str, bool]:
+    choice = (data.get("choices") or [])[0]
+    content = str(choice.get("message", {}).get("content", "")).strip()
+    return content, str(choice.get("finish_reason") or "").lower() == "length"
+
+
+_PROVIDER_CLASSES = {"ollama": OllamaProvider, "openai": OpenAIProvider}
+_providers: Dict[str, LLMProvider] = {}
+
+
+def get_llm_provider(name: Optional[str] = None) -> LLMProvider:
+  """name 省略時は設定の provider。未対応の名前は ValueError"""
+  config = get_llm_config()
+  key = (name or config.provider).strip().lower()
+  provider = _providers.get(key)
+  if provider is None:
+    cls = _PROVIDER_CLASSES.get(key)
+    if cls is None:
+      raise ValueError(f"unsupported AI_PROVIDER: {key}")
+    provider = _providers.setdefault(key, cls(config))
+  return provider
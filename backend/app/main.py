@@ -3,28 +3,36 @@ from __future__ import annotations
 import base64
 import configparser
 import ast
+import asyncio
+import hashlib
+import heapq
 import json
 import logging
 import mimetypes
 import os
 import queue
 import re
+import shlex
+import stat
 import subprocess
 import threading
 import time
 import urllib.error
 import urllib.request
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from html.parser import HTMLParser
 from pathlib import PurePosixPath
 from pathlib import Path
 from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
 
+from .llm_client import CancelledError, CancelToken, LLMHTTPError, LLMProvider, get_llm_config, get_llm_provider
 from .schemas import (
   AiAssistPayload,
   AiAssistResponse,
@@ -33,6 +41,7 @@ from .schemas import (
   AgentCommandLog,
   BuddyFeedbackPayload,
   ChatMessage,
+  CommandOutputChunkModel,
   CommandPayload,
   CopyPathPayload,
   CreateLinkPayload,
@@ -54,8 +63,12 @@ from .schemas import (
   ProposedAgentEdit,
   RunnerConfigModel,
   RunnerConfigUpdatePayload,
+  SearchPayload,
   SessionModel,
   UploadFilePayload,
+  WatcherHeartbeatPayload,
+  WatcherListChangesModel,
+  WatcherStatusPushPayload,
   WatcherModel,
   WatcherStatusModel,
 )
@@ -87,26 +100,11 @@ BASE_PATH, SESSIONS_ROOT, REGISTRY_ROOT = load_paths()
 def _get_available_vram_gb() -> Optional[int]:
   """利用可能な VRAM (GB) を推定する。
 
-  現状は環境変数 / config.ini の設定値のみを参照し、自動検出は行わない。
+  現状は環境変数 / config.ini の設定値のみを参照し、自動検出は行わない（LLMConfig で一度だけ解決する）。
   - 環境変数: AI_VRAM_GB
-  - config.ini: [ai] vram_gb
+  - config.ini: [ai] vram_gb（load_ai_config で AI_VRAM_GB に反映）
   """
-  env = os.environ.get("AI_VRAM_GB")
-  if env:
-    try:
-      return int(env)
-    except ValueError:
-      pass
-  try:
-    parser = configparser.ConfigParser()
-    parser.read(CONFIG_PATH)
-    if parser.has_section("ai") and parser.has_option("ai", "vram_gb"):
-      raw = parser.get("ai", "vram_gb").strip()
-      if raw:
-        return int(raw)
-  except Exception:
-    pass
-  return None
+  return get_llm_config().vram_gb
 
 
 def route_model(
@@ -261,6 +259,11 @@ def load_ai_config() -> None:
     ("ollama_base_url", "OLLAMA_BASE_URL"),
     ("ollama_model", "OLLAMA_MODEL"),
     ("ai_provider", "AI_PROVIDER"),
+    ("inline_fim", "AI_INLINE_FIM"),
+    ("keep_alive", "AI_KEEP_ALIVE"),
+    ("keep_alive_models", "AI_KEEP_ALIVE_MODELS"),
+    ("debate_parallel", "AI_DEBATE_PARALLEL"),
+    ("vram_gb", "AI_VRAM_GB"),
   ]
   for ini_key, env_key in mapping:
     if parser.has_option("ai", ini_key):
@@ -295,15 +298,7 @@ load_ai_config()
 
 
 def _ai_llm_http_timeout() -> float:
-  raw = (os.environ.get("AI_LLM_HTTP_TIMEOUT") or "").strip()
-  if raw:
-    try:
-      t = float(raw)
-      if t >= 30:
-        return t
-    except ValueError:
-      pass
-  return 1800.0
+  return get_llm_config().http_timeout
 
 
 def _ai_sse_keepalive_interval() -> float:
@@ -317,6 +312,17 @@ def _ai_sse_keepalive_interval() -> float:
   return 20.0
 
 
+def _ai_debate_parallel() -> int:
+  """Multi モードでレビュアーを同時に呼ぶ上限（既定 2）"""
+  raw = (os.environ.get("AI_DEBATE_PARALLEL") or "").strip()
+  if raw:
+    try:
+      return max(1, int(raw))
+    except ValueError:
+      pass
+  return 2
+
+
 # nginx 等のバッファリング抑止・中間キャッシュ抑止（長時間 SSE 向け）
 _AI_SSE_HEADERS = {
   "Cache-Control": "no-cache, no-transform",
@@ -358,29 +364,194 @@ def watcher_registry_files():
   return sorted(REGISTRY_ROOT.glob("*.json"), key=lambda p: p.name.lower())
 
 
-def load_watchers(timeout_sec: float = 30.0) -> List[WatcherModel]:
-  import time
+# Watcher の生存管理はメモリ上のレジストリで行う。GET /watchers は _registry/*.json を毎回読まず、
+# ハートビート（POST /watchers/{wid}/heartbeat・チャネル）で更新されたメモリを返すだけにする。
+# rsync で置かれる旧来の _registry/*.json はバックグラウンドで mtime が変わったものだけ読み込み、
+# 再起動に備えてレジストリ全体を定期的に 1 ファイルへ保存する。
+WATCHER_TIMEOUT_SEC = 30.0
+REGISTRY_SCAN_SEC = 5.0
+REGISTRY_PERSIST_SEC = 10.0
+REGISTRY_SNAPSHOT_FILE = REGISTRY_ROOT / ".relay_registry.json"
+
+
+class _WatcherRegistry:
+  """wid -> {displayName, lastHeartbeat, expiresAt, source}。一覧は変更時に作り直したものを返す"""
+
+  def __init__(self) -> None:
+    self._cond = threading.Condition()
+    self._entries: Dict[str, dict] = {}
+    self._live: List[WatcherModel] = []
+    self._live_ids: Tuple[Tuple[str, str], ...] = ()
+    self._version = 0
+    self._dirty = False
+    self._file_mtimes: Dict[str, float] = {}
+    self._started = False
+    # /watchers/changes の待ち手（イベントループ, asyncio.Event）。version が進んだら set する
+    self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+  def _ensure_started(self) -> None:
+    with self._cond:
+      if self._started:
+        return
+      self._started = True
+    self._load_snapshot()
+    self._scan_files()
+    threading.Thread(target=self._expiry_loop, daemon=True, name="watcher-registry-expiry").start()
+    threading.Thread(target=self._background_loop, daemon=True, name="watcher-registry-io").start()
+
+  def _rebuild(self) -> None:
+    """生きている Watcher の一覧を作り直す（_cond 保持中に呼ぶ）。顔ぶれが変わったときだけ version を進める"""
+    now = time.time()
+    live = sorted(
+      ((wid, e) for wid, e in self._entries.items() if e["expiresAt"] > now),
+      key=lambda item: item[0].lower(),
+    )
+    self._live = [WatcherModel(id=wid, displayName=e["displayName"], lastHeartbeat=e["lastHeartbeat"]) for wid, e in live]
+    ids = tuple((wid, e["displayName"]) for wid, e in live)
+    if ids != self._live_ids:
+      self._live_ids = ids
+      self._version += 1
+      self._cond.notify_all()
+      for loop, event in self._async_waiters:
+        loop.call_soon_threadsafe(event.set)
+
+  def heartbeat(self, wid: str, display_name: Optional[str] = None, interval_sec: Optional[float] = None,
+                ts: Optional[float] = None, source: str = "push") -> int:
+    """ハートビートを記録する。interval_sec があれば 2 回分の取りこぼし（送信の遅れを含む）までを生存とみなす"""
+    self._ensure_started()
+    now = time.time()
+    ts = now if ts is None else ts
+    timeout = max(3.0 * interval_sec, 3.0) if interval_sec else WATCHER_TIMEOUT_SEC
+    with self._cond:
+      entry = self._entries.get(wid)
+      if entry is not None and ts < entry["lastHeartbeat"]:
+        return self._version
+      self._entries[wid] = {
+        "displayName": display_name or (entry or {}).get("displayName") or wid,
+        "lastHeartbeat": ts,
+        "expiresAt": ts + timeout,
+        "source": source,
+      }
+      self._dirty = True
+      self._rebuild()
+      return self._version
+
+  def offline(self, wid: str) -> None:
+    """切断を検知したときに即座に一覧から外す"""
+    with self._cond:
+      entry = self._entries.get(wid)
+      if entry is None:
+        return
+      entry["expiresAt"] = 0.0
+      self._dirty = True
+      self._rebuild()
+
+  def list(self) -> List[WatcherModel]:
+    self._ensure_started()
+    with self._cond:
+      return list(self._live)
+
+  async def wait_changed(self, since: int, timeout: float) -> Tuple[int, List[WatcherModel]]:
+    """version が since より進むまで（最大 timeout 秒）待つ。待つ間スレッドプールのスレッドを占有しない"""
+    if not self._started:
+      # 初回だけスナップショットと _registry/*.json を読む
+      await asyncio.get_running_loop().run_in_executor(None, self._ensure_started)
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with self._cond:
+      if self._version != since:
+        return self._version, list(self._live)
+      self._async_waiters.append(waiter)
+    try:
+      await asyncio.wait_for(waiter[1].wait(), timeout)
+    except asyncio.TimeoutError:
+      pass
+    finally:
+      with self._cond:
+        self._async_waiters.remove(waiter)
+    with self._cond:
+      return self._version, list(self._live)
+
+  def _expiry_loop(self) -> None:
+    while True:
+      with self._cond:
+        now = time.time()
+        deadlines = [e["expiresAt"] for e in self._entries.values() if e["expiresAt"] > now]
+        if len(deadlines) != len(self._live):
+          self._rebuild()
+          continue
+        wait = min(deadlines) - now if deadlines else REGISTRY_SCAN_SEC
+        # heartbeat で期限が延びた場合は次の周回で測り直す
+        self._cond.wait(timeout=max(0.05, min(wait, REGISTRY_SCAN_SEC)))
+
+  def _background_loop(self) -> None:
+    last_persist = time.monotonic()
+    while True:
+      time.sleep(REGISTRY_SCAN_SEC)
+      try:
+        self._scan_files()
+      except Exception as e:
+        logger.warning("watcher registry scan failed: %s", e)
+      if time.monotonic() - last_persist >= REGISTRY_PERSIST_SEC:
+        last_persist = time.monotonic()
+        self._persist()
+
+  def _scan_files(self) -> None:
+    """rsync で置かれた _registry/*.json のうち mtime が変わったものだけ読む"""
+    for path in watcher_registry_files():
+      try:
+        mtime = path.stat().st_mtime
+      except OSError:
+        continue
+      if self._file_mtimes.get(path.name) == mtime:
+        continue
+      self._file_mtimes[path.name] = mtime
+      try:
+        data = json.loads(path.read_text("utf-8"))
+        ts = data.get("last_heartbeat") or data.get("last_seen") or data.get("heartbeat_ts") or mtime
+        ts_f = float(ts)
+      except Exception:
+        continue
+      self.heartbeat(path.stem, data.get("display_name"), ts=ts_f, source="file")
 
-  now = time.time()
-  res: List[WatcherModel] = []
-  for path in watcher_registry_files():
+  def _load_snapshot(self) -> None:
     try:
-      data = json.loads(path.read_text("utf-8"))
-    except Exception:
-      continue
-    ts = data.get("last_heartbeat") or data.get("last_seen") or data.get("heartbeat_ts")
-    if ts is None:
-      ts = path.stat().st_mtime
+      data = json.loads(REGISTRY_SNAPSHOT_FILE.read_text("utf-8"))
+    except (OSError, ValueError):
+      return
+    with self._cond:
+      for wid, entry in (data.get("watchers") or {}).items():
+        try:
+          self._entries[wid] = {
+            "displayName": str(entry.get("displayName") or wid),
+            "lastHeartbeat": float(entry["lastHeartbeat"]),
+            "expiresAt": float(entry["expiresAt"]),
+            "source": str(entry.get("source") or "snapshot"),
+          }
+        except (KeyError, TypeError, ValueError):
+          continue
+      self._rebuild()
+
+  def _persist(self) -> None:
+    with self._cond:
+      if not self._dirty:
+        return
+      self._dirty = False
+      data = {"savedAt": time.time(), "watchers": {wid: dict(e) for wid, e in self._entries.items()}}
+    tmp = REGISTRY_SNAPSHOT_FILE.with_name(REGISTRY_SNAPSHOT_FILE.name + ".tmp")
     try:
-      ts_f = float(ts)
-    except Exception:
-      continue
-    if now - ts_f > timeout_sec:
-      continue
-    wid = path.stem
-    display = data.get("display_name") or wid
-    res.append(WatcherModel(id=wid, displayName=display, lastHeartbeat=ts_f))
-  return res
+      tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+      os.replace(tmp, REGISTRY_SNAPSHOT_FILE)
+    except OSError as e:
+      logger.warning("failed to persist watcher registry: %s", e)
+      with self._cond:
+        self._dirty = True
+
+
+_watcher_registry = _WatcherRegistry()
+
+
+def load_watchers() -> List[WatcherModel]:
+  return _watcher_registry.list()
 
 
 def session_root(watcher_id: str, session: str) -> Path:
@@ -411,19 +582,82 @@ def normalize_rel_path(req_path: str) -> str:
   return rel
 
 
+# セッションごとの symlink 判定・解決結果キャッシュ。
+# NFS 上のセッション dir では stat 1 回がネットワーク往復になるため、ホットな file / file-chunk / file-raw で
+# パス深さ分の is_symlink() を毎回行わない。リンク作成・削除などの内部コマンド送信時に破棄し、
+# rsync 経由で現れた変更に備えて TTL でも失効させる。
+# 大きなツリーを眺め続けても膨らまないよう、セッションごとに _SYMLINK_CACHE_MAX_ENTRIES 件の LRU にする。
+_SYMLINK_CACHE_TTL_SEC = 15.0
+_SYMLINK_CACHE_MAX_ENTRIES = 4096
+_symlink_cache: Dict[str, "OrderedDict[str, Tuple[float, Any]]"] = {}
+_symlink_cache_lock = threading.Lock()
+
+
+def _symlink_cache_get(root: Path, key: str) -> Tuple[bool, Any]:
+  with _symlink_cache_lock:
+    entries = _symlink_cache.get(str(root))
+    entry = entries.get(key) if entries is not None else None
+    if entry is None:
+      return False, None
+    if time.time() - entry[0] > _SYMLINK_CACHE_TTL_SEC:
+      del entries[key]
+      return False, None
+    entries.move_to_end(key)
+  return True, entry[1]
+
+
+def _symlink_cache_put(root: Path, key: str, value: Any) -> None:
+  with _symlink_cache_lock:
+    entries = _symlink_cache.setdefault(str(root), OrderedDict())
+    entries[key] = (time.time(), value)
+    entries.move_to_end(key)
+    while len(entries) > _SYMLINK_CACHE_MAX_ENTRIES:
+      entries.popitem(last=False)
+
+
+def invalidate_symlink_cache(wid: str, sess: str) -> None:
+  """リンク作成・削除・移動など、パス構成が変わりうる操作の後に呼ぶ"""
+  with _symlink_cache_lock:
+    _symlink_cache.pop(str(SESSIONS_ROOT / wid / sess), None)
+
+
+def _is_symlink_cached(root: Path, rel: str) -> bool:
+  hit, value = _symlink_cache_get(root, "l:" + rel)
+  if hit:
+    return bool(value)
+  try:
+    is_link = stat.S_ISLNK(os.lstat(root / rel).st_mode)
+  except OSError:
+    # 存在しないパスは rsync で後から現れるためキャッシュしない
+    return False
+  _symlink_cache_put(root, "l:" + rel, is_link)
+  return is_link
+
+
 def path_has_symlink_component(root: Path, rel_path: str) -> bool:
   parts = [p for p in PurePosixPath(rel_path).parts if p not in ("", ".")]
-  cur = root
-  for part in parts:
-    cur = cur / part
-    try:
-      if cur.is_symlink():
-        return True
-    except Exception:
-      return False
+  for i in range(len(parts)):
+    if _is_symlink_cached(root, "/".join(parts[: i + 1])):
+      return True
   return False
 
 
+def resolve_symlink_dir_cached(root: Path, rel: str, target: Path) -> Optional[Path]:
+  """symlink を relay 上で解決し、ディレクトリなら解決先を返す（結果はセッション単位でキャッシュ）"""
+  hit, value = _symlink_cache_get(root, "r:" + rel)
+  if hit:
+    return Path(value) if value else None
+  resolved_dir: Optional[Path] = None
+  try:
+    resolved = target.resolve(strict=False)
+    if resolved.exists() and resolved.is_dir():
+      resolved_dir = resolved
+  except Exception:
+    pass
+  _symlink_cache_put(root, "r:" + rel, str(resolved_dir) if resolved_dir else "")
+  return resolved_dir
+
+
 def build_entry(root: Path, p: Path, children: Optional[List[FileEntryModel]] = None) -> FileEntryModel:
   is_symlink = p.is_symlink()
   is_dir_like = p.is_dir()
@@ -556,9 +790,73 @@ def serialize_file_tree(root: Path) -> List[FileEntryModel]:
   return [build_entry(root, root, children=root_children)]
 
 
+STAGED_MAX_AGE_SEC = 3600.0
+
+
+class _StagedExpiry:
+  """relay 上の staged ファイルの削除予定を期限順のヒープで持ち、期限が来たものだけ消す（ディレクトリは走査しない）"""
+
+  def __init__(self) -> None:
+    self._cond = threading.Condition()
+    self._heap: List[Tuple[float, str]] = []
+    # path -> 最新の期限。同じパスを登録し直したら古いヒープ要素は無視する（Watcher の StagedExpiry と同じ）
+    self._deadlines: Dict[str, float] = {}
+    self._started = False
+
+  def register(self, path: Path, ttl: float = STAGED_MAX_AGE_SEC, replace: bool = True) -> None:
+    """path を ttl 秒後に消す。replace=False なら既に登録済みのパスはそのまま"""
+    key = str(path)
+    with self._cond:
+      if not replace and key in self._deadlines:
+        return
+      deadline = time.time() + ttl
+      self._deadlines[key] = deadline
+      heapq.heappush(self._heap, (deadline, key))
+      if not self._started:
+        self._started = True
+        threading.Thread(target=self._loop, daemon=True, name="staged-expiry").start()
+      self._cond.notify()
+
+  def _loop(self) -> None:
+    while True:
+      with self._cond:
+        while True:
+          if not self._heap:
+            self._cond.wait()
+            continue
+          wait = self._heap[0][0] - time.time()
+          if wait <= 0:
+            break
+          self._cond.wait(timeout=wait)
+        now = time.time()
+        due: List[str] = []
+        while self._heap and self._heap[0][0] <= now:
+          deadline, key = heapq.heappop(self._heap)
+          if self._deadlines.get(key) == deadline:
+            del self._deadlines[key]
+            due.append(key)
+      for path in due:
+        try:
+          Path(path).unlink(missing_ok=True)
+        except Exception:
+          pass
+
+
+_staged_expiry = _StagedExpiry()
+
+
 def _cleanup_old_staged_files():
-  """relay 上の古い .staged_for_download* と .staged_uploads/* を削除（1 時間以上経過）"""
-  cutoff = time.time() - 3600.0
+  """起動時のクラッシュ復旧: relay 上の古い .staged_for_download* と .staged_uploads/* を削除（1 時間以上経過）し、
+  まだ新しいものは期限を登録する。以降は登録済みの期限でだけ消す"""
+  now = time.time()
+
+  def _expire(p: Path) -> None:
+    age = now - p.stat().st_mtime
+    if age >= STAGED_MAX_AGE_SEC:
+      p.unlink(missing_ok=True)
+    else:
+      _staged_expiry.register(p, STAGED_MAX_AGE_SEC - age, replace=False)
+
   try:
     for wid_dir in SESSIONS_ROOT.iterdir() if SESSIONS_ROOT.exists() else []:
       if not wid_dir.is_dir():
@@ -568,13 +866,13 @@ def _cleanup_old_staged_files():
           continue
         try:
           for p in sess_dir.glob(".staged_for_download*"):
-            if p.is_file() and p.stat().st_mtime < cutoff:
-              p.unlink(missing_ok=True)
+            if p.is_file():
+              _expire(p)
           uploads = sess_dir / ".staged_uploads"
           if uploads.is_dir():
             for p in uploads.iterdir():
-              if p.is_file() and p.stat().st_mtime < cutoff:
-                p.unlink(missing_ok=True)
+              if p.is_file():
+                _expire(p)
         except Exception:
           pass
   except Exception:
@@ -712,7 +1010,13 @@ app.add_middleware(
 
 @app.on_event("startup")
 def _startup_cleanup_staged():
-  _cleanup_old_staged_files()
+  # セッション数が多いと走査に時間がかかるので起動を待たせない
+  threading.Thread(target=_cleanup_old_staged_files, daemon=True, name="staged-startup-sweep").start()
+
+
+@app.on_event("startup")
+def _startup_watcher_registry():
+  _watcher_registry._ensure_started()
 
 
 @app.get("/info")
@@ -884,6 +1188,20 @@ def list_watchers():
   return load_watchers()
 
 
+@app.get("/watchers/changes", response_model=WatcherListChangesModel)
+async def wait_watchers_changed(since: int = Query(0, ge=0), timeout: float = Query(25.0, ge=0.0, le=60.0)):
+  """Watcher 一覧のロングポーリング。version が since と異なればすぐ、同じなら変化か timeout まで待って返す"""
+  version, watchers = await _watcher_registry.wait_changed(since, timeout)
+  return WatcherListChangesModel(version=version, watchers=watchers)
+
+
+@app.post("/watchers/{wid}/heartbeat")
+def post_watcher_heartbeat(wid: str, payload: WatcherHeartbeatPayload):
+  """Watcher からのハートビート（_registry/*.json の rsync を待たずに生存を反映する）"""
+  version = _watcher_registry.heartbeat(wid, payload.displayName, payload.intervalSec)
+  return {"ok": True, "version": version}
+
+
 DEFAULT_SESSION_NAME = "default"
 
 
@@ -925,16 +1243,82 @@ def create_session(wid: str, body: CreateSessionModel):
   return SessionModel(name=name, watcherId=wid)
 
 
-@app.get("/watchers/{wid}/sessions/{sess}/status", response_model=WatcherStatusModel)
-def get_status(wid: str, sess: str):
+# セッション状態（cwd・conda 環境）のキャッシュ。Watcher が変化時に送ってくる値（チャネル / POST）を正とし、
+# 送られてこないセッション（旧 Watcher）は .watcher_status.json を mtime が変わったときだけ読み直す。
+# push 後でも、rsync でそれより新しいファイルが届いた（push 時点から mtime が変わった）場合はファイルを読む
+# （push が途中で失敗しても UI の cwd が古いまま残らないように）。
+# 値ごとの ETag を付けるので、UI のポーリングは変化が無ければ 304 で済む。
+_session_status_cache: Dict[Tuple[str, str], dict] = {}
+_session_status_lock = threading.Lock()
+
+
+def _status_etag(data: dict) -> str:
+  digest = hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+  return f'"{digest[:20]}"'
+
+
+def _update_session_status(wid: str, sess: str, status: dict, full: bool) -> None:
+  """Watcher から届いた状態を反映する。full=False なら変わったキーだけが届く"""
+  key = (wid, sess)
+  with _session_status_lock:
+    entry = _session_status_cache.get(key)
+    data = {} if full or entry is None else dict(entry["data"])
+    data.update(status)
+    if entry is not None and entry["mtime"] is None and entry["data"] == data:
+      return
+    _session_status_cache[key] = {
+      "data": data, "etag": _status_etag(data), "mtime": None, "file_mtime": _status_file_mtime(wid, sess),
+    }
+
+
+def _status_file_mtime(wid: str, sess: str) -> Optional[float]:
+  try:
+    return (SESSIONS_ROOT / wid / sess / ".watcher_status.json").stat().st_mtime
+  except OSError:
+    return None
+
+
+def _get_session_status(wid: str, sess: str) -> dict:
+  with _session_status_lock:
+    entry = _session_status_cache.get((wid, sess))
+  pushed = entry is not None and entry["mtime"] is None
   root = session_root(wid, sess)
   status_path = root / ".watcher_status.json"
-  if not status_path.exists():
+  try:
+    mtime = status_path.stat().st_mtime
+  except OSError:
+    if pushed:
+      return entry
     raise HTTPException(status_code=404, detail="status file not found")
+  if pushed and mtime == entry["file_mtime"]:
+    return entry
+  if entry is not None and entry["mtime"] == mtime:
+    return entry
   try:
     data = json.loads(status_path.read_text("utf-8"))
   except Exception:
+    if pushed:
+      return entry
     raise HTTPException(status_code=500, detail="status file invalid")
+  seen, entry = entry, {"data": data, "etag": _status_etag(data), "mtime": mtime}
+  with _session_status_lock:
+    current = _session_status_cache.get((wid, sess))
+    # 読んでいる間に Watcher から新しく届いた値があればそちらを優先
+    if current is not None and current is not seen and current["mtime"] is None:
+      return current
+    _session_status_cache[(wid, sess)] = entry
+  return entry
+
+
+@app.get("/watchers/{wid}/sessions/{sess}/status", response_model=WatcherStatusModel)
+def get_status(wid: str, sess: str, request: Request, response: Response):
+  entry = _get_session_status(wid, sess)
+  etag = entry["etag"]
+  if etag in request.headers.get("if-none-match", ""):
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+  response.headers["ETag"] = etag
+  response.headers["Cache-Control"] = "no-cache"
+  data = entry["data"]
   return WatcherStatusModel(
     user=data.get("user", ""),
     host=data.get("host", ""),
@@ -945,6 +1329,13 @@ def get_status(wid: str, sess: str):
   )
 
 
+@app.post("/watchers/{wid}/sessions/{sess}/status")
+def post_status(wid: str, sess: str, payload: WatcherStatusPushPayload):
+  """Watcher からの状態通知（チャネル未接続時の経路）"""
+  _update_session_status(wid, sess, payload.status, payload.full)
+  return {"ok": True}
+
+
 @app.get("/watchers/{wid}/sessions/{sess}/debug/rt")
 def debug_rt(wid: str, sess: str):
   """RT モードの接続テスト。HTTP で echo コマンドを送り、応答または失敗理由を返す"""
@@ -972,7 +1363,7 @@ def debug_file_raw(wid: str, sess: str, path: str = Query(..., description="path
   result = {"path": path, "rel": rel, "rt_port": None, "rt_ok": False, "has_base64": False, "size": None, "error": None}
   port = _get_rt_port(wid)
   result["rt_port"] = port
-  if port is None:
+  if port is None and _get_watcher_channel(wid) is None:
     result["error"] = "rt_port not found"
     return result
   token = f"{int(time.time()*1000)}-{uuid.uuid4().hex[:8]}"
@@ -1094,13 +1485,13 @@ def get_file_children(
   rel = path.replace("\\", "/").strip().lstrip("/") or "."
 
   # Symlink: まず relay 上で解決して直接一覧取得を試す（RT モードで Watcher が別マシンの場合、symlink 先が relay 上にあれば成功）
-  if target.is_symlink():
-    try:
-      resolved = target.resolve(strict=False)
-      if resolved.exists() and resolved.is_dir():
+  if _is_symlink_cached(root, rel.strip("/")):
+    resolved = resolve_symlink_dir_cached(root, rel.strip("/"), target)
+    if resolved is not None:
+      try:
         return list_dir_entries_python(root, resolved, path_prefix=rel)
-    except Exception:
-      pass
+      except Exception:
+        pass
     return list_dir_entries_via_watcher(wid, sess, root, rel)
 
   if not target.exists():
@@ -1287,90 +1678,626 @@ def _get_rt_port(wid: str) -> Optional[int]:
     return None
 
 
-def _post_command_via_rt(wid: str, sess: str, command: str) -> tuple[bool, str]:
-  """RT 経由でコマンド送信。(成功したか, 失敗時は理由)"""
-  port = _get_rt_port(wid)
-  if port is None:
-    return False, "rt_port_not_found"
-  url = f"http://127.0.0.1:{port}/command"
-  body = json.dumps({"watcherId": wid, "session": sess, "command": command}, ensure_ascii=False).encode("utf-8")
+# Watcher の HTTP サーバは優先度別の有限キューで受け付ける。内部ファイル操作は interactive、
+# ユーザー / Agent のコマンドは command レーンに入れ、満杯時の 503 は Retry-After を見て 1 回だけ再試行する。
+_RT_BUSY_MAX_RETRY_WAIT_SEC = 2.0
+
+
+def _rt_priority(command: str) -> str:
+  return "interactive" if command.strip().startswith("_internal_") else "command"
+
+
+def _rt_urlopen(url: str, body: bytes, *, priority: str, timeout: float, content_type: str = "application/json"):
+  headers = {"Content-Type": content_type, "X-RT-Priority": priority}
+  for attempt in range(2):
+    req = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+      return urllib.request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as e:
+      if e.code != 503 or attempt > 0:
+        raise
+      try:
+        wait = float(e.headers.get("Retry-After") or 1)
+      except ValueError:
+        wait = 1.0
+      logger.info("watcher busy (%s lane), retrying in %.1fs: %s", priority, wait, url)
+      time.sleep(min(max(wait, 0.1), _RT_BUSY_MAX_RETRY_WAIT_SEC))
+
+
+def _rt_http_error_reason(e: urllib.error.HTTPError) -> str:
+  return _rt_status_reason(e.code)
+
+
+def _get_rt_metrics(port: int) -> Optional[dict]:
+  """Watcher のワーカープール状況（キュー長・待ち時間・拒否数）。旧 Watcher は None"""
   try:
-    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
-    with urllib.request.urlopen(req, timeout=120) as resp:
-      return (resp.status == 200), ""
-  except urllib.error.URLError as e:
-    return False, str(e.reason) if e.reason else str(e)
-  except Exception as e:
-    return False, str(e)
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=3) as resp:
+      return json.loads(resp.read().decode("utf-8", errors="replace"))
+  except Exception:
+    return None
+
+
+# ===== Watcher channel =====
+# Watcher が relay へ張る常設 WebSocket（/watchers/{wid}/channel）。1 本の接続に relay → Watcher の
+# リクエスト / 応答 / ストリーム、Watcher → relay のログを多重化する。リクエストごとに TCP 接続を
+# 張らないため、rt_port（リバーストンネル）が無い構成でも RT と同じ経路が使える。
+# 同期エンドポイント（スレッドプール）から使うため、送信は run_coroutine_threadsafe でイベントループに渡す
+# （イベントループ上からは send_async を使う）。送信開始前に失敗したときだけ ConnectionRefusedError で HTTP 経路へ
+# 送り直し、送信開始後のタイムアウトは WatcherSendUncertain として再送しない。受信したログ・ステータスのファイル書き込みは
+# 接続ごとの書き込みスレッドで到着順に行い、イベントループを止めない。
+_CHANNEL_STREAM_CREDIT = 16
+
+
+class WatcherSendUncertain(ConnectionError):
+  """チャネルへの送信が始まった後に失敗・タイムアウトした（Watcher に届いたか分からない）。
+  別経路で送り直すと二重実行になりうるので、呼び出し側は再送しない"""
+
+
+class _SendAttempt:
+  """スレッドからの 1 回の送信。送信が始まったか / 呼び出し側が諦めたかを排他的に決める"""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.started = False
+    self.abandoned = False
+
+  def start(self) -> bool:
+    with self.lock:
+      if self.abandoned:
+        return False
+      self.started = True
+      return True
+
+  def abandon(self) -> bool:
+    """まだ送信が始まっていなければ取りやめて True"""
+    with self.lock:
+      if self.started:
+        return False
+      self.abandoned = True
+      return True
+
+
+class _WatcherChannel:
+  def __init__(self, wid: str, websocket: WebSocket, loop: asyncio.AbstractEventLoop):
+    self.wid = wid
+    self.websocket = websocket
+    self.loop = loop
+    self.connected_at = time.time()
+    self.hello: Dict[str, Any] = {}
+    self.closed = False
+    self._send_lock = asyncio.Lock()
+    self._lock = threading.Lock()
+    self._pending: Dict[str, "queue.Queue[Optional[dict]]"] = {}
+    self._requests = 0
+    # log / status フレームのファイル書き込み（1 本なので到着順が保たれる）
+    self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"channel-io-{wid}")
+
+  def status(self) -> dict:
+    return {
+      "connected": not self.closed,
+      "connectedAt": self.connected_at,
+      "watcher": self.hello,
+      "requests": self._requests,
+      "inFlight": len(self._pending),
+    }
+
+  def usable_from_current_thread(self) -> bool:
+    """イベントループのスレッドから同期待ちするとデッドロックするため、その場合は使わない"""
+    try:
+      return asyncio.get_running_loop() is not self.loop
+    except RuntimeError:
+      return True
+
+  async def _send(self, frame: dict, attempt: Optional[_SendAttempt] = None) -> None:
+    async with self._send_lock:
+      # 送信ロック待ちの間に呼び出し側がタイムアウトしていたら送らない
+      if attempt is not None and not attempt.start():
+        return
+      await self.websocket.send_text(json.dumps(frame, ensure_ascii=False))
+
+  async def send_async(self, frame: dict) -> None:
+    """イベントループ上からの送信。送れなかった場合は ConnectionRefusedError"""
+    if self.closed:
+      raise ConnectionRefusedError("watcher channel closed")
+    try:
+      await self._send(frame)
+    except Exception as e:
+      raise ConnectionRefusedError(f"watcher channel send failed: {e}")
+
+  def send(self, frame: dict, timeout: Optional[float] = 10.0) -> None:
+    """スレッドからの送信。送信が始まる前に失敗・タイムアウトした場合は ConnectionRefusedError
+    （Watcher には届いていないので別経路で再送してよい）。送信が始まった後の失敗は WatcherSendUncertain。
+    イベントループのスレッドから呼ばれた場合は待たずに送信だけ予約する（timeout 付きは待てないので送らない）"""
+    if self.closed:
+      raise ConnectionRefusedError("watcher channel closed")
+    if not self.usable_from_current_thread():
+      if timeout is not None:
+        raise ConnectionRefusedError("watcher channel send would block the event loop; use send_async")
+      self.loop.create_task(self.send_async(frame))
+      return
+    attempt = _SendAttempt()
+    fut = asyncio.run_coroutine_threadsafe(self._send(frame, attempt), self.loop)
+    if timeout is not None:
+      try:
+        fut.result(timeout=timeout)
+      except Exception as e:
+        fut.cancel()
+        if attempt.abandon():
+          raise ConnectionRefusedError(f"watcher channel send failed before sending: {e}")
+        raise WatcherSendUncertain(f"watcher channel send may not have completed: {e}")
+
+  def dispatch(self, frame: dict) -> None:
+    """受信フレームを振り分ける（イベントループ上で呼ばれる）"""
+    kind = frame.get("type")
+    if kind == "hello":
+      self.hello = {k: v for k, v in frame.items() if k != "type"}
+      logger.info("watcher channel hello wid=%s %s", self.wid, self.hello)
+      _watcher_registry.heartbeat(self.wid, frame.get("displayName"), frame.get("heartbeatSec"))
+    elif kind == "heartbeat":
+      _watcher_registry.heartbeat(self.wid, frame.get("displayName"), frame.get("intervalSec"))
+    elif kind in ("status", "log"):
+      # ファイル書き込みはイベントループの外で（張り直しで閉じた後の旧接続のフレームは捨てる）
+      if not self.closed:
+        self._writer.submit(self._write_frame, frame)
+    elif kind in ("response", "data", "end"):
+      q = self._pending.get(str(frame.get("id")))
+      if q is not None:
+        q.put(frame)
+
+  def _write_frame(self, frame: dict) -> None:
+    """log / status フレームを書き込む（書き込みスレッドで呼ばれる）"""
+    sess = str(frame.get("session") or "")
+    try:
+      if frame.get("type") == "status":
+        status = frame.get("status")
+        if isinstance(status, dict):
+          _update_session_status(self.wid, sess, status, bool(frame.get("full")))
+      else:
+        _append_session_log(self.wid, sess, str(frame.get("text") or ""))
+    except HTTPException:
+      logger.warning("watcher channel %s for unknown session wid=%s sess=%s", frame.get("type"), self.wid, sess)
+    except Exception as e:
+      logger.warning("watcher channel %s write failed wid=%s sess=%s: %s", frame.get("type"), self.wid, sess, e)
+
+  def close(self) -> None:
+    self.closed = True
+    with self._lock:
+      pending = list(self._pending.values())
+      self._pending.clear()
+    for q in pending:
+      q.put(None)
+    # 受け取り済みのログは書き切る（待たない）
+    self._writer.shutdown(wait=False)
+
+  def _register(self) -> Tuple[str, "queue.Queue[Optional[dict]]"]:
+    req_id = uuid.uuid4().hex[:12]
+    q: "queue.Queue[Optional[dict]]" = queue.Queue()
+    with self._lock:
+      self._pending[req_id] = q
+      self._requests += 1
+    return req_id, q
+
+  def _unregister(self, req_id: str) -> None:
+    with self._lock:
+      self._pending.pop(req_id, None)
+
+  def _get(self, req_id: str, q: "queue.Queue[Optional[dict]]", timeout: float) -> dict:
+    try:
+      frame = q.get(timeout=timeout)
+    except queue.Empty:
+      try:
+        self.send({"type": "cancel", "id": req_id}, timeout=None)
+      except Exception:
+        pass
+      raise TimeoutError(f"watcher channel request timed out after {timeout:.0f}s")
+    if frame is None:
+      raise ConnectionError("watcher channel closed")
+    return frame
+
+  def request(self, path: str, body: dict, *, priority: str, timeout: float) -> Tuple[int, Any]:
+    """1 往復のリクエスト。(HTTP 相当のステータス, 応答 JSON) を返す"""
+    req_id, q = self._register()
+    try:
+      self.send({"type": "request", "id": req_id, "path": path, "body": body, "priority": priority})
+      frame = self._get(req_id, q, timeout)
+      return int(frame.get("status") or 500), frame.get("body")
+    finally:
+      self._unregister(req_id)
+
+  def open_stream(self, path: str, body: dict, *, priority: str, timeout: float) -> Tuple[int, Any]:
+    """ストリーム応答のリクエスト。成功時は (200, _WatcherChannelStream)、失敗時は (status, 応答 JSON)"""
+    req_id, q = self._register()
+    try:
+      self.send({
+        "type": "request", "id": req_id, "path": path, "body": body,
+        "priority": priority, "credit": _CHANNEL_STREAM_CREDIT,
+      })
+      frame = self._get(req_id, q, timeout)
+    except Exception:
+      self._unregister(req_id)
+      raise
+    status = int(frame.get("status") or 500)
+    if status != 200 or not frame.get("stream"):
+      self._unregister(req_id)
+      return status, frame.get("body")
+    return status, _WatcherChannelStream(self, req_id, q, timeout)
+
+
+class _WatcherChannelStream:
+  """チャネル上のストリーム応答を NDJSON 行（bytes）のイテレータとして読む。
+  読んだ分だけ credit を返すので、relay 側が遅いときは Watcher 側の送信が止まる"""
+
+  def __init__(self, channel: _WatcherChannel, req_id: str, q: "queue.Queue[Optional[dict]]", timeout: float):
+    self._channel = channel
+    self._req_id = req_id
+    self._queue = q
+    self._timeout = timeout
+    self._done = False
+
+  def __iter__(self) -> Iterator[bytes]:
+    consumed = 0
+    while not self._done:
+      frame = self._channel._get(self._req_id, self._queue, self._timeout)
+      if frame.get("type") == "end":
+        self._done = True
+        break
+      if frame.get("type") != "data":
+        continue
+      yield (json.dumps(frame.get("data"), ensure_ascii=False) + "\n").encode("utf-8")
+      consumed += 1
+      if consumed >= _CHANNEL_STREAM_CREDIT // 2:
+        self._channel.send({"type": "credit", "id": self._req_id, "credit": consumed}, timeout=None)
+        consumed = 0
+
+  def close(self) -> None:
+    if not self._done:
+      self._done = True
+      try:
+        self._channel.send({"type": "cancel", "id": self._req_id}, timeout=None)
+      except Exception:
+        pass
+    self._channel._unregister(self._req_id)
+
+
+_watcher_channels: Dict[str, _WatcherChannel] = {}
+_watcher_channels_lock = threading.Lock()
+
 
+def _get_watcher_channel(wid: str) -> Optional[_WatcherChannel]:
+  with _watcher_channels_lock:
+    channel = _watcher_channels.get(wid)
+  if channel is None or channel.closed or not channel.usable_from_current_thread():
+    return None
+  return channel
+
+
+def _has_rt_transport(wid: str) -> bool:
+  """RT 用 Watcher か（チャネル接続中、または rt_port 登録あり）"""
+  return _get_watcher_channel(wid) is not None or _get_rt_port(wid) is not None
+
+
+def _rt_status_reason(status: int) -> str:
+  if status == 404:
+    return "session_not_found"
+  if status == 503:
+    return "watcher_busy"
+  return f"HTTP {status}"
+
+
+def _rt_call(wid: str, path: str, payload: dict, *, priority: str, timeout: float) -> Tuple[Optional[dict], str]:
+  """Watcher の RT API を呼ぶ。チャネルがあればそれを使い、無ければ rt_port へ HTTP。
+  (応答 JSON, 失敗時は理由) を返す"""
+  channel = _get_watcher_channel(wid)
+  if channel is not None:
+    try:
+      for attempt in range(2):
+        status, data = channel.request(path, payload, priority=priority, timeout=timeout)
+        if status != 503 or attempt > 0:
+          break
+        time.sleep(_RT_BUSY_MAX_RETRY_WAIT_SEC / 2)
+      if status != 200:
+        return None, _rt_status_reason(status)
+      return (data if isinstance(data, dict) else {}), ""
+    except ConnectionRefusedError as e:
+      # Watcher に届く前に切れた場合だけ HTTP 経路で送り直す（届いた後なら二重実行になる）
+      logger.warning("watcher channel unavailable wid=%s path=%s: %s", wid, path, e)
+    except WatcherSendUncertain as e:
+      logger.warning("watcher channel send uncertain wid=%s path=%s, not retrying: %s", wid, path, e)
+      return None, "channel_send_uncertain"
+    except Exception as e:
+      logger.warning("watcher channel request failed wid=%s path=%s: %s", wid, path, e)
+      return None, str(e)
 
-def _post_command_via_rt_with_response(wid: str, sess: str, command: str, timeout: int = 7200) -> tuple[Optional[dict], str]:
-  """RT 経由でコマンド送信し、(レスポンス JSON, 失敗時は理由) を返す。Watcher が 404 の場合は reason に 'session_not_found' を返す。timeout は秒（省略時 7200）。"""
   port = _get_rt_port(wid)
   if port is None:
     return None, "rt_port_not_found"
-  url = f"http://127.0.0.1:{port}/command"
-  body = json.dumps({"watcherId": wid, "session": sess, "command": command}, ensure_ascii=False).encode("utf-8")
+  url = f"http://127.0.0.1:{port}{path}"
+  body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
   try:
-    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
+    with _rt_urlopen(url, body, priority=priority, timeout=timeout, content_type="application/json; charset=utf-8") as resp:
       return json.loads(resp.read().decode("utf-8", errors="replace")), ""
   except urllib.error.HTTPError as e:
-    if e.code == 404:
-      return None, "session_not_found"
-    return None, f"HTTP {e.code}"
+    return None, _rt_http_error_reason(e)
   except urllib.error.URLError as e:
     return None, str(e.reason) if e.reason else str(e)
   except Exception as e:
     return None, str(e)
 
 
-def _post_gpu_status_via_rt(wid: str, sess: str) -> tuple[Optional[dict], str]:
-  """Watcher の /gpu-status を呼ぶ。command は空で送り、Watcher 側で nvitop 優先→nvidia-smi フォールバック。"""
+@app.websocket("/watchers/{wid}/channel")
+async def watcher_channel(websocket: WebSocket, wid: str):
+  """Watcher からの常設チャネル。同じ wid で張り直された場合は新しい接続を優先する"""
+  await websocket.accept()
+  channel = _WatcherChannel(wid, websocket, asyncio.get_running_loop())
+  with _watcher_channels_lock:
+    previous = _watcher_channels.get(wid)
+    _watcher_channels[wid] = channel
+  if previous is not None:
+    previous.close()
+  logger.info("watcher channel connected wid=%s", wid)
+  try:
+    while True:
+      text = await websocket.receive_text()
+      try:
+        frame = json.loads(text)
+      except ValueError:
+        continue
+      if isinstance(frame, dict):
+        channel.dispatch(frame)
+  except WebSocketDisconnect:
+    pass
+  finally:
+    with _watcher_channels_lock:
+      replaced = _watcher_channels.get(wid) is not channel
+      if not replaced:
+        del _watcher_channels[wid]
+    channel.close()
+    if not replaced:
+      _watcher_registry.offline(wid)
+    logger.info("watcher channel disconnected wid=%s", wid)
+
+
+# /command のストリーム応答（stream: true）。出力は output フレームで逐次届き、最後に exit フレーム（exitCode など）。
+# relay は溜めずに中継するか、上限付きで集約するので、コマンドの出力量にかかわらずメモリは一定。
+RT_COMMAND_OUTPUT_MAX_CHARS = int(os.environ.get("RT_COMMAND_OUTPUT_MAX_CHARS", "2000000"))
+
+
+def _iter_stream_frames(source) -> Iterator[dict]:
+  """NDJSON 行（bytes）のイテレータをフレーム dict にする。終わったら（途中で閉じられても）source を閉じる"""
+  try:
+    for line in source:
+      if line.strip():
+        yield json.loads(line)
+  finally:
+    source.close()
+
+
+def _legacy_command_frames(data: dict) -> Iterator[dict]:
+  """ストリーム非対応の Watcher が返した 1 つの JSON を output + exit フレームに読み替える"""
+  rest = dict(data)
+  output = rest.pop("output", "")
+  if output:
+    yield {"type": "output", "text": output}
+  yield {"type": "exit", **rest}
+
+
+def _rt_open_stream(wid: str, path: str, payload: dict, *, priority: str, timeout: float) -> Tuple[Optional[Iterator[dict]], str]:
+  """Watcher のストリーム応答を開き、(フレームのイテレータ, 失敗時は理由) を返す。
+  イテレータは最後まで読むか close() すること。チャネルがあればそれを、無ければ rt_port への HTTP を使う"""
+  channel = _get_watcher_channel(wid)
+  if channel is not None:
+    try:
+      status, result = channel.open_stream(path, payload, priority=priority, timeout=timeout)
+    except ConnectionRefusedError as e:
+      logger.warning("watcher channel unavailable wid=%s path=%s: %s", wid, path, e)
+    except WatcherSendUncertain as e:
+      logger.warning("watcher channel send uncertain wid=%s path=%s, not retrying: %s", wid, path, e)
+      return None, "channel_send_uncertain"
+    except Exception as e:
+      return None, str(e)
+    else:
+      if status != 200:
+        return None, _rt_status_reason(status)
+      if isinstance(result, _WatcherChannelStream):
+        return _iter_stream_frames(result), ""
+      return _legacy_command_frames(result if isinstance(result, dict) else {}), ""
+
   port = _get_rt_port(wid)
   if port is None:
     return None, "rt_port_not_found"
-  url = f"http://127.0.0.1:{port}/gpu-status"
-  body = json.dumps({"watcherId": wid, "session": sess, "command": ""}, ensure_ascii=False).encode("utf-8")
+  url = f"http://127.0.0.1:{port}{path}"
+  body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
   try:
-    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
-    with urllib.request.urlopen(req, timeout=20) as resp:
-      data = json.loads(resp.read().decode("utf-8", errors="replace"))
-      return data, ""
+    resp = _rt_urlopen(url, body, priority=priority, timeout=timeout, content_type="application/json; charset=utf-8")
   except urllib.error.HTTPError as e:
-    if e.code == 404:
-      return None, "session_not_found"
-    return None, f"HTTP {e.code}"
+    return None, _rt_http_error_reason(e)
   except urllib.error.URLError as e:
     return None, str(e.reason) if e.reason else str(e)
   except Exception as e:
     return None, str(e)
+  if resp.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+    return _iter_stream_frames(resp), ""
+  try:
+    with resp:
+      data = json.loads(resp.read().decode("utf-8", errors="replace"))
+  except Exception as e:
+    return None, str(e)
+  return _legacy_command_frames(data), ""
+
+
+def _collect_command_frames(frames: Iterator[dict], max_chars: int = RT_COMMAND_OUTPUT_MAX_CHARS) -> dict:
+  """output フレームを上限付きで連結し、従来の /command 応答と同じ形の dict にする。
+  上限を超えたら先頭と末尾を半分ずつ残して中略する"""
+  head: List[str] = []
+  head_len = 0
+  tail: List[str] = []
+  tail_len = 0
+  omitted = 0
+  half = max(1, max_chars // 2)
+  for frame in frames:
+    kind = frame.get("type")
+    if kind == "output":
+      text = str(frame.get("text") or "")
+      if not tail and head_len + len(text) <= half:
+        head.append(text)
+        head_len += len(text) + 1
+        continue
+      tail.append(text)
+      tail_len += len(text) + 1
+      while tail_len > half and len(tail) > 1:
+        dropped = tail.pop(0)
+        tail_len -= len(dropped) + 1
+        omitted += len(dropped) + 1
+    elif kind == "exit":
+      # outputTruncated は Watcher 側の保持上限の話なので、ここで中略したかどうかで付け直す
+      result = {k: v for k, v in frame.items() if k not in ("type", "outputTruncated")}
+      parts = head
+      if omitted:
+        where = f"; full output id: {result['outputId']}" if result.get("outputId") else ""
+        parts = head + [f"...[{omitted} chars omitted{where}]..."]
+      result["output"] = "\n".join(parts + tail)
+      if omitted:
+        result["outputTruncated"] = True
+      return result
+  raise ConnectionError("command stream ended without exit frame")
 
 
-@app.post("/watchers/{wid}/sessions/{sess}/log-append")
-async def post_log_append(wid: str, sess: str, request: Request):
-  """RT Watcher からログを即時受信（リバーストンネル用）"""
-  root = session_root(wid, sess)
-  body = await request.body()
-  log_file = root / "commands.log"
-  log_file.parent.mkdir(parents=True, exist_ok=True)
-  text = body.decode("utf-8", errors="replace")
-  if text and not text.endswith("\n"):
-    text += "\n"
-  with log_file.open("ab") as f:
-    f.write(text.encode("utf-8"))
-  return {"ok": True}
+def _post_command_via_rt(wid: str, sess: str, command: str) -> tuple[bool, str]:
+  """RT 経由でコマンド送信。(成功したか, 失敗時は理由)"""
+  data, reason = _rt_call(
+    wid, "/command", {"watcherId": wid, "session": sess, "command": command},
+    priority=_rt_priority(command), timeout=120,
+  )
+  return data is not None, reason
+
+
+def _post_command_via_rt_with_response(
+  wid: str, sess: str, command: str, timeout: int = 7200, read_only: bool = False,
+) -> tuple[Optional[dict], str]:
+  """RT 経由でコマンド送信し、(レスポンス JSON, 失敗時は理由) を返す。Watcher が 404 の場合は reason に 'session_not_found' を返す。timeout は秒（省略時 7200）。
+  通常コマンドはストリーム応答で受け、出力は RT_COMMAND_OUTPUT_MAX_CHARS までに抑える（内部コマンドは 1 往復）。
+  read_only は読み取り専用コマンドの印（Watcher は索引を更新せず、Agent のものは並列レーンに流す）。"""
+  body = {"watcherId": wid, "session": sess, "command": command}
+  if read_only:
+    body["readOnly"] = True
+  if command.strip().startswith("_internal_"):
+    return _rt_call(wid, "/command", body, priority=_rt_priority(command), timeout=timeout)
+  frames, reason = _rt_open_stream(
+    wid, "/command", {**body, "stream": True}, priority=_rt_priority(command), timeout=timeout,
+  )
+  if frames is None:
+    return None, reason
+  try:
+    return _collect_command_frames(frames), ""
+  except Exception as e:
+    return None, str(e)
+  finally:
+    frames.close()
 
 
-@app.get("/watchers/{wid}/rt-status")
-def get_rt_status(wid: str):
-  """RT モード診断: rt_port ファイルの有無とポート番号を返す"""
-  port = _get_rt_port(wid)
-  port_file = REGISTRY_ROOT / f"{wid}.rt_port"
+def _post_gpu_status_via_rt(wid: str, sess: str) -> tuple[Optional[dict], str]:
+  """Watcher の /gpu-status を呼ぶ。command は空で送り、Watcher 側で nvitop 優先→nvidia-smi フォールバック。"""
+  return _rt_call(
+    wid, "/gpu-status", {"watcherId": wid, "session": sess, "command": ""},
+    priority="interactive", timeout=20,
+  )
+
+
+def _open_search_via_rt(wid: str, sess: str, payload: SearchPayload):
+  """Watcher の /search を開き、NDJSON 行のイテレータ（close() 付き）を返す。失敗時は HTTPException。"""
+  data = payload.model_dump()
+  data.update({"watcherId": wid, "session": sess})
+  channel = _get_watcher_channel(wid)
+  if channel is not None:
+    try:
+      status, result = channel.open_stream("/search", data, priority="interactive", timeout=300)
+    except Exception as e:
+      raise HTTPException(status_code=502, detail=str(e))
+    if status == 200:
+      return result
+    detail = (result or {}).get("error") if isinstance(result, dict) else None
+    raise HTTPException(status_code=status if status in (400, 404, 503) else 502, detail=detail or f"HTTP {status}")
+  port = _get_rt_port(wid)
+  if port is None:
+    raise HTTPException(status_code=503, detail="Workspace search requires an RT watcher (rt_port not found)")
+  url = f"http://127.0.0.1:{port}/search"
+  body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+  try:
+    return _rt_urlopen(url, body, priority="interactive", timeout=300)
+  except urllib.error.HTTPError as e:
+    detail = f"HTTP {e.code}"
+    try:
+      detail = json.loads(e.read().decode("utf-8", errors="replace")).get("error") or detail
+    except Exception:
+      pass
+    status = e.code if e.code in (400, 404, 503) else 502
+    raise HTTPException(status_code=status, detail=detail)
+  except urllib.error.URLError as e:
+    raise HTTPException(status_code=502, detail=str(e.reason) if e.reason else str(e))
+  except Exception as e:
+    raise HTTPException(status_code=502, detail=str(e))
+
+
+@app.post("/watchers/{wid}/sessions/{sess}/search")
+def post_workspace_search(wid: str, sess: str, payload: SearchPayload):
+  """ワークスペース全文検索。Watcher の結果（1 行 1 JSON: match... / done）をそのまま逐次中継する。"""
+  if not payload.query:
+    raise HTTPException(status_code=400, detail="query required")
+  resp = _open_search_via_rt(wid, sess, payload)
+
+  def _iter_lines():
+    try:
+      for line in resp:
+        if line.strip():
+          yield line if line.endswith(b"\n") else line + b"\n"
+    except Exception as e:
+      logger.warning("workspace search stream aborted: %s", e)
+      yield (json.dumps({"type": "error", "error": str(e)}, ensure_ascii=False) + "\n").encode("utf-8")
+    finally:
+      resp.close()
+
+  return StreamingResponse(
+    _iter_lines(),
+    media_type="application/x-ndjson",
+    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+  )
+
+
+@app.post("/watchers/{wid}/sessions/{sess}/log-append")
+async def post_log_append(wid: str, sess: str, request: Request):
+  """RT Watcher からログを即時受信（リバーストンネル用）"""
+  body = await request.body()
+  _append_session_log(wid, sess, body.decode("utf-8", errors="replace"))
+  return {"ok": True}
+
+
+def _append_session_log(wid: str, sess: str, text: str) -> None:
+  """commands.log へ追記し、待っている読み手を起こす（log-append とチャネルの log フレーム共通）"""
+  root = session_root(wid, sess)
+  log_file = root / "commands.log"
+  log_file.parent.mkdir(parents=True, exist_ok=True)
+  if text and not text.endswith("\n"):
+    text += "\n"
+  with log_file.open("ab") as f:
+    f.write(text.encode("utf-8"))
+  _session_dir_notifier.notify(root)
+
+
+@app.get("/watchers/{wid}/rt-status")
+def get_rt_status(wid: str):
+  """RT モード診断: rt_port ファイルの有無とポート番号、チャネル接続状況を返す"""
+  port = _get_rt_port(wid)
+  port_file = REGISTRY_ROOT / f"{wid}.rt_port"
+  with _watcher_channels_lock:
+    channel = _watcher_channels.get(wid)
   return {
     "registry_root": str(REGISTRY_ROOT),
     "rt_port_file_exists": port_file.exists(),
     "rt_port": port,
+    # Watcher のワーカープール（キュー長・待ち時間・拒否数）。旧 Watcher では null
+    "rt_metrics": _get_rt_metrics(port) if port is not None else None,
+    # Watcher → relay の常設チャネル。未接続なら null
+    "channel": channel.status() if channel is not None else None,
   }
 
 
@@ -1396,30 +2323,75 @@ def get_gpu_status(wid: str, sess: str):
   return result
 
 
+def _iter_command_stream(wid: str, sess: str, frames: Iterator[dict]) -> Iterator[bytes]:
+  exit_code = None
+  try:
+    for frame in frames:
+      if frame.get("type") == "output":
+        frame = {"type": "output", "text": _strip_cmd_exit_markers(frame.get("text", ""))}
+        if not frame["text"]:
+          continue
+      elif frame.get("type") == "exit":
+        exit_code = frame.get("exitCode")
+      yield (json.dumps(frame, ensure_ascii=False) + "\n").encode("utf-8")
+  except Exception as e:
+    logger.warning("command stream aborted wid=%s sess=%s: %s", wid, sess, e)
+    yield (json.dumps({"type": "error", "error": str(e)}, ensure_ascii=False) + "\n").encode("utf-8")
+  finally:
+    frames.close()
+    # ターミナルの ln -s / rm なども symlink 構成を変えうる
+    invalidate_symlink_cache(wid, sess)
+    logger.info("command stream finished wid=%s sess=%s exitCode=%s", wid, sess, exit_code)
+
+
 @app.post("/watchers/{wid}/sessions/{sess}/commands")
-def post_command(wid: str, sess: str, payload: CommandPayload):
+def post_command(wid: str, sess: str, payload: CommandPayload, stream: bool = Query(False)):
+  """stream=1 なら RT の出力を NDJSON（output フレーム… → exit フレーム）で溜めずに中継する。
+  RT で届かず commands.txt にフォールバックした場合は stream 指定でも通常の JSON を返す。"""
   cmd = payload.command.rstrip()
   logger.info("command received wid=%s sess=%s cmd_len=%d cmd_preview=%r", wid, sess, len(cmd), (cmd[:60] + "..") if len(cmd) > 60 else cmd)
 
-  # RT を先に試す（Relay にセッション dir が無くても Watcher に届く）
-  rt_resp, rt_error = _post_command_via_rt_with_response(wid, sess, cmd)
+  # 読み取り専用のコマンド（ls / cat など）は Watcher が実行後に検索索引を更新しない
+  read_only = _is_readonly_agent_command(cmd)
+  if stream:
+    body = {"watcherId": wid, "session": sess, "command": cmd, "stream": True}
+    if read_only:
+      body["readOnly"] = True
+    frames, rt_error = _rt_open_stream(wid, "/command", body, priority=_rt_priority(cmd), timeout=7200)
+    if frames is not None:
+      return StreamingResponse(
+        _iter_command_stream(wid, sess, frames),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+      )
+    rt_resp = None
+  else:
+    # RT を先に試す（Relay にセッション dir が無くても Watcher に届く）
+    rt_resp, rt_error = _post_command_via_rt_with_response(wid, sess, cmd, read_only=read_only)
+  # ターミナルの ln -s / rm なども symlink 構成を変えうる
+  invalidate_symlink_cache(wid, sess)
   if rt_resp is not None:
     out = _strip_cmd_exit_markers(rt_resp.get("output", ""))
     exit_code = rt_resp.get("exitCode", 0)
     out_lines = len(out.splitlines()) if out else 0
     logger.info("command delivered via RT wid=%s sess=%s output_lines=%d exitCode=%s", wid, sess, out_lines, exit_code)
     # RT 成功時は commands.txt に書かない（Watcher が rsync pull で commands.txt を読んで再実行するため二重実行になる）
-    return {
+    result = {
       "ok": True,
       "rt": True,
       "output": out,
       "exitCode": exit_code,
       "_trace": {"method": "rt", "outputLineCount": out_lines, "exitCode": exit_code},
     }
+    # 出力を中略した場合、全文は /command-output/{outputId} から取れる
+    if rt_resp.get("outputId"):
+      result["outputId"] = rt_resp["outputId"]
+    if rt_resp.get("outputTruncated"):
+      result["outputTruncated"] = True
+    return result
 
-  # rt_port がある = RT 用 Watcher。届かなかったら 503 で理由を返す（commands.txt は別マシンでは読めない）
-  rt_port = _get_rt_port(wid)
-  if rt_port is not None:
+  # チャネル接続中 / rt_port がある = RT 用 Watcher。届かなかったら 503 で理由を返す（commands.txt は別マシンでは読めない）
+  if _has_rt_transport(wid):
     logger.warning("command RT failed wid=%s sess=%s rt_error=%s", wid, sess, rt_error)
     raise HTTPException(
       status_code=503,
@@ -1450,6 +2422,37 @@ def post_command(wid: str, sess: str, payload: CommandPayload):
   return {"ok": True, "_trace": {"method": "commands_txt"}}
 
 
+@app.get("/watchers/{wid}/sessions/{sess}/command-output/{output_id}", response_model=CommandOutputChunkModel)
+def get_command_output(
+  wid: str,
+  sess: str,
+  output_id: str,
+  offset: int = Query(0, ge=0),
+  length: int = Query(262144, ge=1, le=1000000),
+):
+  """中略されたコマンド出力の全文（Watcher が gzip で保持）を offset から length バイト分返す。
+  コマンドが実行中で書き出しが終わっていない間は totalSize が null、inProgress が true"""
+  if not re.match(r"^[A-Za-z0-9._-]+$", output_id):
+    raise HTTPException(status_code=400, detail="invalid output id")
+  resp, reason = _post_command_via_rt_with_response(wid, sess, f"_internal_read_output::{output_id}::{offset}::{length}", timeout=60)
+  if resp is None:
+    status = 404 if reason == "session_not_found" else 503
+    raise HTTPException(status_code=status, detail=reason or "watcher unreachable")
+  chunk = resp.get("outputChunk")
+  if not isinstance(chunk, dict):
+    raise HTTPException(status_code=404, detail=_strip_cmd_exit_markers(resp.get("output", "")).strip() or "output not found")
+  return CommandOutputChunkModel(
+    path=output_id,
+    offset=chunk.get("offset", offset),
+    length=chunk.get("length", 0),
+    totalSize=chunk.get("totalSize"),
+    content=chunk.get("content", ""),
+    hasMore=bool(chunk.get("hasMore")),
+    nextOffset=chunk.get("nextOffset", offset),
+    inProgress=bool(chunk.get("inProgress")),
+  )
+
+
 @app.post("/watchers/{wid}/sessions/{sess}/cleanup-staged")
 def cleanup_staged(wid: str, sess: str):
   """現在セッションの .staged_for_download* と .staged_uploads/* を一括削除（relay と Watcher 両方）。
@@ -1524,6 +2527,221 @@ def clear_commands(wid: str, sess: str):
   return {"ok": True, "relay_cleared": relay_done, "watcher_cleaned": watcher_cleaned}
 
 
+# ===== commands.txt フォールバックの完了待ち =====
+# commands.txt 経由のコマンドには直前に ID 行（"#@cmd-id <id>"）を付ける。旧 Watcher は "#" 行を読み飛ばすだけ、
+# 新 Watcher は実行後にセッション dir へ完了記録 .command_done.<id>（exitCode 等の JSON）を書く。
+# 待機側はファイルを定期ポーリングせず、セッション dir の変更通知で起きて判定だけ行う。
+COMMAND_ID_LINE_PREFIX = "#@cmd-id "
+COMMAND_DONE_PREFIX = ".command_done."
+# NFS など inotify が届かない FS 向けの保険。通知が来なくてもこの間隔で判定し直す
+_DIR_WAIT_RECHECK_SEC = 1.0
+
+
+class _SessionDirNotifier:
+  """セッション dir の変更を待機スレッドへ通知する。Linux では inotify、それ以外は待機者がいる間だけ 1 本のスレッドで stat を比較する。"""
+
+  _IN_MASK = 0x2 | 0x4 | 0x8 | 0x80 | 0x100 | 0x200  # MODIFY | ATTRIB | CLOSE_WRITE | MOVED_TO | CREATE | DELETE
+  _IN_IGNORED = 0x8000
+  _POLL_SEC = 0.1
+  _POLL_FILES = ("commands.log", ".commands.offset", ".ls_result.txt")
+
+  def __init__(self) -> None:
+    self._cond = threading.Condition()
+    self._versions: Dict[str, int] = {}
+    self._wd_to_dir: Dict[int, str] = {}
+    self._dir_to_wd: Dict[str, int] = {}
+    self._waiters: Dict[str, int] = {}
+    self._libc: Any = None
+    self._fd: Optional[int] = None
+    self._started = False
+    self._poll_thread: Optional[threading.Thread] = None
+
+  def _ensure_started(self) -> None:
+    if self._started:
+      return
+    self._started = True
+    try:
+      import ctypes
+      import ctypes.util
+      import sys
+      if not sys.platform.startswith("linux"):
+        return
+      libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+      fd = libc.inotify_init1(os.O_CLOEXEC)
+      if fd < 0:
+        return
+      self._libc, self._fd = libc, fd
+      threading.Thread(target=self._inotify_loop, daemon=True, name="session-dir-inotify").start()
+    except Exception as e:
+      logger.info("inotify unavailable, falling back to stat polling: %s", e)
+      self._libc = self._fd = None
+
+  def _bump(self, key: str) -> None:
+    with self._cond:
+      self._versions[key] = self._versions.get(key, 0) + 1
+      self._cond.notify_all()
+
+  def notify(self, directory: Path) -> None:
+    """外部から変更を知らせる（log-append 受信時など）"""
+    self._bump(str(directory))
+
+  def _inotify_loop(self) -> None:
+    import struct
+    header = struct.Struct("iIII")
+    while True:
+      try:
+        buf = os.read(self._fd, 64 * 1024)
+      except InterruptedError:
+        continue
+      except OSError as e:
+        logger.warning("inotify read failed: %s", e)
+        return
+      pos = 0
+      changed: set = set()
+      while pos + header.size <= len(buf):
+        wd, mask, _cookie, name_len = header.unpack_from(buf, pos)
+        pos += header.size + name_len
+        with self._cond:
+          key = self._wd_to_dir.get(wd)
+          if key is not None and mask & self._IN_IGNORED:
+            self._wd_to_dir.pop(wd, None)
+            self._dir_to_wd.pop(key, None)
+        if key is not None:
+          changed.add(key)
+      for key in changed:
+        self._bump(key)
+
+  def _watch(self, key: str) -> bool:
+    """inotify の監視を追加。使えなければ False"""
+    if self._fd is None:
+      return False
+    with self._cond:
+      if key in self._dir_to_wd:
+        return True
+    wd = self._libc.inotify_add_watch(self._fd, os.fsencode(key), self._IN_MASK)
+    if wd < 0:
+      return False
+    with self._cond:
+      self._wd_to_dir[wd] = key
+      self._dir_to_wd[key] = wd
+    return True
+
+  def _snapshot(self, key: str) -> tuple:
+    sig = []
+    for name in ("",) + self._POLL_FILES:
+      try:
+        st = os.stat(os.path.join(key, name) if name else key)
+        sig.append((st.st_mtime_ns, st.st_size))
+      except OSError:
+        sig.append(None)
+    return tuple(sig)
+
+  def _poll_loop(self) -> None:
+    snapshots: Dict[str, tuple] = {}
+    while True:
+      with self._cond:
+        keys = [k for k, n in self._waiters.items() if n > 0]
+        if not keys:
+          self._poll_thread = None
+          return
+      for key in keys:
+        snap = self._snapshot(key)
+        if key in snapshots and snapshots[key] != snap:
+          self._bump(key)
+        snapshots[key] = snap
+      time.sleep(self._POLL_SEC)
+
+  def wait_for(self, directory: Path, predicate, timeout_sec: float):
+    """predicate() が真値を返すまで待ち、その値を返す（タイムアウト時は最後の評価結果）。"""
+    self._ensure_started()
+    key = str(directory)
+    watched = self._watch(key) if directory.is_dir() else False
+    deadline = time.time() + timeout_sec
+    with self._cond:
+      self._waiters[key] = self._waiters.get(key, 0) + 1
+      if not watched and self._poll_thread is None:
+        self._poll_thread = threading.Thread(target=self._poll_loop, daemon=True, name="session-dir-poll")
+        self._poll_thread.start()
+    try:
+      while True:
+        with self._cond:
+          seen = self._versions.get(key, 0)
+        result = predicate()
+        remaining = deadline - time.time()
+        if result or remaining <= 0:
+          return result
+        with self._cond:
+          self._cond.wait_for(
+            lambda: self._versions.get(key, 0) != seen,
+            timeout=min(remaining, _DIR_WAIT_RECHECK_SEC),
+          )
+    finally:
+      with self._cond:
+        self._waiters[key] -= 1
+        if self._waiters[key] <= 0:
+          del self._waiters[key]
+
+
+_session_dir_notifier = _SessionDirNotifier()
+
+
+def _new_command_id() -> str:
+  return f"{int(time.time()*1000)}-{uuid.uuid4().hex[:8]}"
+
+
+def _append_command_with_id(root: Path, command: str) -> Tuple[str, int]:
+  """commands.txt に ID 行付きでコマンドを追記し、(cmd_id, 処理済みとみなすバイト offset) を返す"""
+  cmd_file = root / "commands.txt"
+  cmd_file.parent.mkdir(parents=True, exist_ok=True)
+  cmd_id = _new_command_id()
+  with cmd_file.open("ab") as f:
+    f.write(f"{COMMAND_ID_LINE_PREFIX}{cmd_id}\n{command.rstrip()}\n".encode("utf-8"))
+    target_offset = f.tell()
+  return cmd_id, target_offset
+
+
+def _read_command_done(root: Path, cmd_id: str) -> Optional[dict]:
+  """完了記録を読む。未完了なら None"""
+  try:
+    text = (root / f"{COMMAND_DONE_PREFIX}{cmd_id}").read_text("utf-8", errors="replace")
+  except OSError:
+    return None
+  try:
+    data = json.loads(text)
+  except ValueError:
+    # 書き込み途中（次の変更通知で読み直す）
+    return None
+  return data if isinstance(data, dict) else {}
+
+
+def _wait_command_done(root: Path, cmd_id: str, target_offset: int, timeout_sec: float) -> Optional[dict]:
+  """完了記録（新 Watcher）または .commands.offset の到達（旧 Watcher）を待つ。旧 Watcher の場合は {} を返す"""
+  offset_file = root / ".commands.offset"
+  target_lines: Optional[int] = None
+
+  def _offset_reached() -> bool:
+    nonlocal target_lines
+    value, is_bytes = _read_commands_offset(offset_file)
+    if is_bytes:
+      return value >= target_offset
+    # 行数で記録する旧 Watcher 向け: 目標バイト位置までの行数を一度だけ数える
+    if target_lines is None:
+      target_lines = _count_command_lines(root / "commands.txt", limit_bytes=target_offset)
+    return value >= target_lines
+
+  def _done() -> Optional[Tuple[dict]]:
+    # 記録が {} でも完了として扱えるよう 1 要素タプルで返す
+    record = _read_command_done(root, cmd_id)
+    if record is not None:
+      return (record,)
+    if _offset_reached():
+      return ({},)
+    return None
+
+  result = _session_dir_notifier.wait_for(root, _done, timeout_sec)
+  return result[0] if result else None
+
+
 def list_dir_entries_via_watcher(
   wid: str,
   sess: str,
@@ -1542,65 +2760,35 @@ def list_dir_entries_via_watcher(
       raise HTTPException(status_code=502, detail="watcher dir listing failed (rt response error)")
 
   # フォールバック: commands.txt 経由（従来モード or RT で HTTP 失敗時）
-  cmd_file = root / "commands.txt"
-  log_file = root / "commands.log"
   ls_file = root / ".ls_result.txt"
 
-  start_size = log_file.stat().st_size if log_file.exists() else 0
-  before_ls_mtime = ls_file.stat().st_mtime if ls_file.exists() else -1.0
-
-  cmd_file.parent.mkdir(parents=True, exist_ok=True)
-  with cmd_file.open("a", encoding="utf-8") as f:
-    f.write(cmd + "\n")
+  def _ls_mtime() -> float:
+    try:
+      return ls_file.stat().st_mtime
+    except OSError:
+      return -1.0
 
-  deadline = time.time() + 12.0
-  saw_done = False
-  saw_any_ls_done = False
-  while time.time() < deadline:
-    if ls_file.exists():
-      try:
-        now_mtime = ls_file.stat().st_mtime
-        if before_ls_mtime < 0 or now_mtime > before_ls_mtime:
-          saw_done = True
-          break
-      except Exception:
-        pass
-    if log_file.exists():
-      try:
-        with log_file.open("rb") as lf:
-          lf.seek(start_size)
-          chunk = lf.read().decode("utf-8", errors="replace")
-        if "__LS_DONE__::" in chunk:
-          saw_any_ls_done = True
-        if f"__LS_DONE__::{rel_path}" in chunk:
-          saw_done = True
-          break
-      except Exception:
-        pass
-    time.sleep(0.2)
+  before_ls_mtime = _ls_mtime()
+  cmd_id, target_offset = _append_command_with_id(root, cmd)
 
-  # Fallback: accept generic LS completion if result file exists.
-  if not saw_done and saw_any_ls_done and ls_file.exists():
-    saw_done = True
+  def _ls_updated() -> bool:
+    now_mtime = _ls_mtime()
+    return now_mtime >= 0 and (before_ls_mtime < 0 or now_mtime > before_ls_mtime)
 
+  # .ls_result.txt の更新、または完了記録（→ 結果ファイルの到着待ちへ）で起きる
+  saw_done = _session_dir_notifier.wait_for(
+    root, lambda: _ls_updated() or _read_command_done(root, cmd_id) is not None, 12.0
+  )
   if not saw_done:
     if strict:
       raise HTTPException(status_code=504, detail="watcher dir listing timed out (no ls_result received)")
     return []
-  # __LS_DONE__ で break した場合、.ls_result.txt が rsync で届くまで待つ（最大 8 秒）
-  if not ls_file.exists():
-    file_deadline = time.time() + 8.0
-    while time.time() < file_deadline:
-      if ls_file.exists():
-        break
-      time.sleep(0.3)
-  if not ls_file.exists():
-    if strict:
-      raise HTTPException(status_code=504, detail="watcher dir listing timed out (ls_result file missing)")
-    return []
-  if before_ls_mtime >= 0 and ls_file.stat().st_mtime <= before_ls_mtime:
-    # stale result; give watcher a short extra window
-    time.sleep(0.3)
+  # 完了記録が先に届いた場合、.ls_result.txt が rsync で届くまで待つ（最大 8 秒）
+  if not _ls_updated() and not _session_dir_notifier.wait_for(root, _ls_updated, 8.0):
+    if not ls_file.exists():
+      if strict:
+        raise HTTPException(status_code=504, detail="watcher dir listing timed out (ls_result file missing)")
+      return []
 
   try:
     text = ls_file.read_text("utf-8", errors="replace")
@@ -1658,24 +2846,25 @@ def _parse_ls_result_to_entries(rel_path: str, text: str) -> List[FileEntryModel
 
 def wait_internal_exit(log_file: Path, start_size: int, timeout_sec: float = 12.0) -> bool:
   marker_prefix = "__CMD_EXIT_CODE__::INTERNAL:"
-  deadline = time.time() + timeout_sec
   pos = start_size
 
-  while time.time() < deadline:
-    if log_file.exists():
-      try:
-        with log_file.open("rb") as lf:
-          lf.seek(pos)
-          chunk = lf.read().decode("utf-8", errors="replace")
-          pos = lf.tell()
-        for line in chunk.splitlines():
-          if line.startswith(marker_prefix):
-            code = line.split(marker_prefix, 1)[1].strip()
-            return code == "0"
-      except Exception:
-        pass
-    time.sleep(0.15)
-  return False
+  def _exit_code() -> Optional[str]:
+    # 変更通知のたびに前回位置以降の追記分だけを読む
+    nonlocal pos
+    try:
+      with log_file.open("rb") as lf:
+        lf.seek(pos)
+        chunk = lf.read()
+    except OSError:
+      return None
+    complete = chunk.rfind(b"\n") + 1
+    pos += complete
+    for line in chunk[:complete].decode("utf-8", errors="replace").splitlines():
+      if line.startswith(marker_prefix):
+        return line.split(marker_prefix, 1)[1].strip()
+    return None
+
+  return _session_dir_notifier.wait_for(log_file.parent, _exit_code, timeout_sec) == "0"
 
 
 def _strip_cmd_exit_markers(text: str) -> str:
@@ -1692,40 +2881,42 @@ def _strip_cmd_exit_markers(text: str) -> str:
   return "\n".join(out_lines).strip("\n")
 
 
-def _count_command_lines(cmd_file: Path) -> int:
+def _count_command_lines(cmd_file: Path, limit_bytes: Optional[int] = None) -> int:
   if not cmd_file.exists():
     return 0
   try:
     with cmd_file.open("rb") as f:
-      return f.read().count(b"\n")
+      return f.read(limit_bytes if limit_bytes is not None else -1).count(b"\n")
   except Exception:
     return 0
 
 
-def _read_commands_offset(offset_file: Path) -> int:
-  if not offset_file.exists():
-    return 0
+# Watcher は .commands.offset に処理済みバイト位置を "bytes:<n>" で書く（接頭辞なしは旧形式の行数）
+COMMANDS_OFFSET_BYTES_PREFIX = "bytes:"
+
+
+def _read_commands_offset(offset_file: Path) -> Tuple[int, bool]:
+  """(値, バイト位置か) を返す"""
   try:
-    return int(offset_file.read_text("utf-8", errors="replace").strip() or "0")
-  except Exception:
-    return 0
+    raw = offset_file.read_text("utf-8", errors="replace").strip()
+  except OSError:
+    return 0, False
+  try:
+    if raw.startswith(COMMANDS_OFFSET_BYTES_PREFIX):
+      return int(raw[len(COMMANDS_OFFSET_BYTES_PREFIX):] or "0"), True
+    return int(raw or "0"), False
+  except ValueError:
+    return 0, False
 
 
-def append_command_and_wait_processed(root: Path, command: str, timeout_sec: float = 20.0) -> bool:
-  cmd_file = root / "commands.txt"
-  offset_file = root / ".commands.offset"
-  cmd_file.parent.mkdir(parents=True, exist_ok=True)
+def append_command_and_wait_done(root: Path, command: str, timeout_sec: float = 20.0) -> Optional[dict]:
+  """commands.txt に追記して処理完了を待つ。完了記録（exitCode 等）を返し、旧 Watcher なら {}、タイムアウトなら None"""
+  cmd_id, target_offset = _append_command_with_id(root, command)
+  return _wait_command_done(root, cmd_id, target_offset, timeout_sec)
 
-  target_offset = _count_command_lines(cmd_file) + 1
-  with cmd_file.open("a", encoding="utf-8") as f:
-    f.write(command.rstrip() + "\n")
 
-  deadline = time.time() + timeout_sec
-  while time.time() < deadline:
-    if _read_commands_offset(offset_file) >= target_offset:
-      return True
-    time.sleep(0.15)
-  return False
+def append_command_and_wait_processed(root: Path, command: str, timeout_sec: float = 20.0) -> bool:
+  return append_command_and_wait_done(root, command, timeout_sec=timeout_sec) is not None
 
 
 def request_staged_file_from_watcher(root: Path, rel_path: str, timeout_sec: float = 20.0) -> Path:
@@ -1741,7 +2932,10 @@ def request_staged_file_from_watcher(root: Path, rel_path: str, timeout_sec: flo
     f"_internal_stage_file_for_download::{rel_path}::{token}",
     timeout_sec=timeout_sec
   )
-  if ok and token_file.exists():
+  # 読み終えた呼び出し側が消すが、待ち切れずに後から rsync で届いた場合もここで期限を付けておく
+  _staged_expiry.register(token_file)
+  # rsync では完了記録がステージファイルより先に届くことがあるため少しだけ待つ
+  if ok and _session_dir_notifier.wait_for(root, token_file.exists, 2.0):
     return token_file
 
   # Backward-compatible fallback: legacy fixed staged filename.
@@ -1756,16 +2950,16 @@ def request_staged_file_from_watcher(root: Path, rel_path: str, timeout_sec: flo
   if not ok:
     raise HTTPException(status_code=404, detail="watcher failed to stage file")
 
-  deadline = time.time() + timeout_sec
   threshold = max(before_mtime + 1e-6, stage_started_ts - 0.25)
-  while time.time() < deadline:
-    if legacy_file.exists():
-      try:
-        if legacy_file.stat().st_mtime >= threshold:
-          return legacy_file
-      except Exception:
-        pass
-    time.sleep(0.15)
+
+  def _legacy_staged() -> bool:
+    try:
+      return legacy_file.stat().st_mtime >= threshold
+    except OSError:
+      return False
+
+  if _session_dir_notifier.wait_for(root, _legacy_staged, timeout_sec):
+    return legacy_file
   raise HTTPException(status_code=404, detail="staged file not found")
 
 
@@ -1836,26 +3030,14 @@ def fetch_file_bytes_via_watcher(root: Path, rel_path: str, wid: Optional[str] =
 
 
 def save_file_via_watcher_rt(wid: str, sess: str, rel_path: str, content: str) -> bool:
-  """RT モードで HTTP 経由で保存。成功時 True"""
+  """RT モードで HTTP（またはチャネル）経由で保存。成功時 True"""
   token = f"{int(time.time()*1000)}-{uuid.uuid4().hex[:8]}"
   cmd = f"_internal_move_staged_file::{token}::{rel_path}"
-  body = json.dumps(
-    {"watcherId": wid, "session": sess, "command": cmd, "stagedContent": content},
-    ensure_ascii=False,
-  ).encode("utf-8")
-  port = _get_rt_port(wid)
-  if port is None:
-    return False
-  url = f"http://127.0.0.1:{port}/command"
-  try:
-    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json; charset=utf-8"}, method="POST")
-    with urllib.request.urlopen(req, timeout=30) as resp:
-      if resp.status != 200:
-        return False
-      data = json.loads(resp.read().decode("utf-8", errors="replace"))
-      return data.get("ok") is True
-  except Exception:
-    return False
+  data, _ = _rt_call(
+    wid, "/command", {"watcherId": wid, "session": sess, "command": cmd, "stagedContent": content},
+    priority="interactive", timeout=30,
+  )
+  return data is not None and data.get("ok") is True
 
 
 def save_file_via_watcher(root: Path, rel_path: str, content: str, wid: Optional[str] = None, sess: Optional[str] = None) -> None:
@@ -1870,6 +3052,8 @@ def save_file_via_watcher(root: Path, rel_path: str, content: str, wid: Optional
     staged_file.write_bytes(base64.b64decode(content[7:]))
   else:
     staged_file.write_text(content, encoding="utf-8")
+  # Watcher が取り込めなかった場合に残らないよう期限を付ける
+  _staged_expiry.register(staged_file)
 
   ok = append_command_and_wait_processed(
     root,
@@ -1958,6 +3142,30 @@ def _build_chat_editor_context_block(payload: AiAssistPayload, *, mode: str, thi
   return "\n\n".join(parts) if parts else ""
 
 
+def _with_editor_context(user_content: str, context_block: str, label: str) -> str:
+  """新しい発話（最後の user ターン）の前にエディタ文脈を付ける。
+
+  毎ターン変わりうる文脈を履歴の後ろに置くことで、system（静的な指示）→ 履歴 の部分は前ターンと同じになり、
+  Ollama がプロンプトの KV キャッシュを履歴の末尾まで再利用できる（文脈が変わっても再計算は最後のターンだけ）。
+  """
+  if not context_block:
+    return user_content
+  return f"--- {label} ---\n{context_block}\n\n{user_content}"
+
+
+def _trim_history(history: list, max_history: int) -> list:
+  """履歴を max_history 件以内に切り詰める。
+
+  history[-max_history:] だと毎ターン先頭が 1 往復ずつずれてプロンプトの KV キャッシュが効かないため、
+  古い側は max_history の半分（偶数）単位でまとめて落とし、次に溢れるまで先頭を動かさない。
+  """
+  excess = len(history) - max_history
+  if excess <= 0:
+    return list(history)
+  block = max(2, (max_history // 2) & ~1)
+  return history[-(-excess // block) * block:]
+
+
 def _cleanup_llm_output(text: str, max_repeats: int = 2) -> str:
   """LLM 出力の単純な後処理。
 
@@ -1980,6 +3188,132 @@ def _cleanup_llm_output(text: str, max_repeats: int = 2) -> str:
   return "\n".join(out)
 
 
+def _llm_http_exception(label: str, e: Exception) -> HTTPException:
+  """LLM 呼び出しの例外を HTTPException に変換する（label は "Ollama" / "OpenAI"）"""
+  if isinstance(e, HTTPException):
+    return e
+  if isinstance(e, LLMHTTPError):
+    return HTTPException(status_code=502, detail=f"{label} error: {e.body}")
+  if label == "Ollama" and isinstance(e, OSError) and (isinstance(e, ConnectionRefusedError) or e.errno == 111):
+    base = get_llm_config().ollama_base_url
+    return HTTPException(
+      status_code=502,
+      detail=(
+        "Ollama に接続できません（Connection refused）。"
+        f"Relay サーバー上で ollama serve を起動し、ollama_base_url={base} が正しいか config.ini を確認してください。"
+      ),
+    )
+  return HTTPException(status_code=502, detail=f"{label} request failed: {e}")
+
+
+def _llm_provider(name: Optional[str] = None) -> LLMProvider:
+  """name 省略時は AI_PROVIDER / OPENAI_API_KEY から決まるプロバイダ。OpenAI はキー未設定なら 503"""
+  try:
+    provider = get_llm_provider(name)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  if provider.name == "openai" and not provider.config.openai_api_key:
+    raise HTTPException(status_code=503, detail="OPENAI_API_KEY is not set")
+  return provider
+
+
+def _provider_label(provider: LLMProvider) -> str:
+  return "OpenAI" if provider.name == "openai" else "Ollama"
+
+
+def _acquire_resident(provider: LLMProvider, model: Optional[str]) -> str:
+  """Ollama なら予算内に収まるよう古いモデルをアンロードしてから、model を使用中として登録する（OpenAI は空文字）"""
+  if provider.name != "ollama":
+    return ""
+  _model_residency.make_room(model)
+  return _model_residency.acquire(model)
+
+
+def _call_provider_with_meta(
+  provider: LLMProvider,
+  messages: list,
+  max_tokens: int,
+  temperature: float,
+  model: Optional[str],
+) -> Tuple[str, bool]:
+  label = _provider_label(provider)
+  resident = _acquire_resident(provider, model)
+  try:
+    content, truncated = provider.chat(messages, max_tokens=max_tokens, temperature=temperature, model=model)
+  except (KeyError, IndexError, AttributeError, TypeError):
+    raise HTTPException(status_code=500, detail=f"invalid {label} response format")
+  except Exception as e:
+    raise _llm_http_exception(label, e)
+  finally:
+    if resident:
+      _model_residency.release(resident)
+  return _cleanup_llm_output(content), truncated
+
+
+def _stream_provider_chat(
+  provider: LLMProvider,
+  messages: list,
+  max_tokens: int,
+  temperature: float,
+  model: Optional[str],
+  cancel: Optional[CancelToken] = None,
+):
+  """provider.stream_chat を {"type": "token"|"done", ...} に整えて yield する（done に全文を載せる）。
+  cancel でキャンセルされた場合は CancelledError をそのまま送出する"""
+  label = _provider_label(provider)
+  acc_chunks: List[str] = []
+  truncated = False
+  resident = _acquire_resident(provider, model)
+  try:
+    for ev in provider.stream_chat(messages, max_tokens=max_tokens, temperature=temperature, model=model, cancel=cancel):
+      if ev["type"] == "token":
+        acc_chunks.append(ev["delta"])
+        yield ev
+      else:
+        truncated = bool(ev.get("truncated"))
+  except CancelledError:
+    raise
+  except Exception as e:
+    raise _llm_http_exception(label, e)
+  finally:
+    if resident:
+      _model_residency.release(resident)
+  full = _cleanup_llm_output("".join(acc_chunks))
+  yield {"type": "done", "result": full, "truncated": truncated}
+
+
+async def _astream_provider_chat(
+  provider: LLMProvider,
+  messages: list,
+  max_tokens: int,
+  temperature: float,
+  model: Optional[str],
+):
+  """_stream_provider_chat の非同期版（イベントループ上で読み、スレッドを占有しない）"""
+  label = _provider_label(provider)
+  acc_chunks: List[str] = []
+  truncated = False
+  resident = ""
+  if provider.name == "ollama":
+    # /api/ps・/api/stop は同期呼び出しなのでスレッドで行う
+    await asyncio.get_running_loop().run_in_executor(None, _model_residency.make_room, model)
+    resident = _model_residency.acquire(model)
+  try:
+    async for ev in provider.astream_chat(messages, max_tokens=max_tokens, temperature=temperature, model=model):
+      if ev["type"] == "token":
+        acc_chunks.append(ev["delta"])
+        yield ev
+      else:
+        truncated = bool(ev.get("truncated"))
+  except Exception as e:
+    raise _llm_http_exception(label, e)
+  finally:
+    if resident:
+      _model_residency.release(resident)
+  full = _cleanup_llm_output("".join(acc_chunks))
+  yield {"type": "done", "result": full, "truncated": truncated}
+
+
 def _call_ollama_with_meta(
   messages: list,
   max_tokens: int = 512,
@@ -1990,51 +3324,7 @@ def _call_ollama_with_meta(
 
   戻り値は (content, truncated)。truncated は done_reason が length のとき True。
   """
-  base = os.environ.get("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
-  model = model or os.environ.get("OLLAMA_MODEL", "qwen2.5-coder:7b")
-  device = os.environ.get("AI_DEVICE", "cpu").lower()
-  options: Dict[str, Any] = {"temperature": temperature, "num_predict": max_tokens}
-  if device == "cpu":
-    # GPU を使わず CPU のみで実行させる
-    options.setdefault("num_gpu", 0)
-  body = json.dumps(
-    {
-      "model": model,
-      "messages": messages,
-      "stream": False,
-      "options": options,
-    }
-  ).encode("utf-8")
-  req = urllib.request.Request(
-    f"{base.rstrip('/')}/api/chat",
-    data=body,
-    headers={"Content-Type": "application/json"},
-    method="POST",
-  )
-  try:
-    with urllib.request.urlopen(req, timeout=_ai_llm_http_timeout()) as resp:
-      data = json.loads(resp.read().decode("utf-8", errors="replace"))
-  except urllib.error.HTTPError as e:
-    detail = e.read().decode("utf-8", errors="replace")
-    raise HTTPException(status_code=502, detail=f"Ollama error: {detail}")
-  except OSError as e:
-    if e.errno == 111:  # Connection refused
-      base = os.environ.get("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
-      raise HTTPException(
-        status_code=502,
-        detail=f"Ollama に接続できません（Connection refused）。Relay サーバー上で ollama serve を起動し、ollama_base_url={base} が正しいか config.ini を確認してください。"
-      )
-    raise HTTPException(status_code=502, detail=f"Ollama request failed: {e}")
-  except Exception as e:
-    raise HTTPException(status_code=502, detail=f"Ollama request failed: {e}")
-  try:
-    content = str(data.get("message", {}).get("content", "")).strip()
-    content = _cleanup_llm_output(content)
-    done_reason = str(data.get("done_reason") or "").lower()
-    truncated = done_reason == "length"
-    return content, truncated
-  except Exception:
-    raise HTTPException(status_code=500, detail="invalid Ollama response format")
+  return _call_provider_with_meta(_llm_provider("ollama"), messages, max_tokens, temperature, model)
 
 
 def _call_ollama(
@@ -2058,71 +3348,7 @@ def _stream_ollama_chat(
 
   戻り値は {"type": "token"|"done", ...} 形式の dict を yield するイテレータ。
   """
-  base = os.environ.get("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
-  model = model or os.environ.get("OLLAMA_MODEL", "qwen2.5-coder:7b")
-  device = os.environ.get("AI_DEVICE", "cpu").lower()
-  options: Dict[str, Any] = {"temperature": temperature, "num_predict": max_tokens}
-  if device == "cpu":
-    options.setdefault("num_gpu", 0)
-  body = json.dumps(
-    {
-      "model": model,
-      "messages": messages,
-      "stream": True,
-      "options": options,
-    }
-  ).encode("utf-8")
-  req = urllib.request.Request(
-    f"{base.rstrip('/')}/api/chat",
-    data=body,
-    headers={"Content-Type": "application/json"},
-    method="POST",
-  )
-  acc_chunks: List[str] = []
-  truncated = False
-  try:
-    with urllib.request.urlopen(req, timeout=_ai_llm_http_timeout()) as resp:
-      buf = b""
-      while True:
-        chunk = resp.read(4096)
-        if not chunk:
-          break
-        buf += chunk
-        while b"\n" in buf:
-          line, buf = buf.split(b"\n", 1)
-          line = line.strip()
-          if not line:
-            continue
-          try:
-            ev = json.loads(line.decode("utf-8", errors="replace"))
-          except json.JSONDecodeError:
-            continue
-          msg = str((ev.get("message") or {}).get("content") or "")
-          if msg:
-            acc_chunks.append(msg)
-            yield {"type": "token", "delta": msg}
-          if ev.get("done"):
-            done_reason = str(ev.get("done_reason") or "").lower()
-            truncated = done_reason == "length"
-  except urllib.error.HTTPError as e:
-    detail = e.read().decode("utf-8", errors="replace")
-    raise HTTPException(status_code=502, detail=f"Ollama error: {detail}")
-  except OSError as e:
-    if e.errno == 111:  # Connection refused
-      base = os.environ.get("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
-      raise HTTPException(
-        status_code=502,
-        detail=(
-          "Ollama に接続できません（Connection refused）。"
-          f"Relay サーバー上で ollama serve を起動し、ollama_base_url={base} が正しいか config.ini を確認してください。"
-        ),
-      )
-    raise HTTPException(status_code=502, detail=f"Ollama request failed: {e}")
-  except Exception as e:
-    raise HTTPException(status_code=502, detail=f"Ollama request failed: {e}")
-
-  full = _cleanup_llm_output("".join(acc_chunks))
-  yield {"type": "done", "result": full, "truncated": truncated}
+  return _stream_provider_chat(_llm_provider("ollama"), messages, max_tokens, temperature, model)
 
 
 def _call_openai_with_meta(
@@ -2131,45 +3357,7 @@ def _call_openai_with_meta(
   temperature: float = 0.2,
 ) -> Tuple[str, bool]:
   """OpenAI Chat Completions API を呼び、(content, truncated) を返す。"""
-  api_key = os.environ.get("OPENAI_API_KEY")
-  if not api_key:
-    raise HTTPException(status_code=503, detail="OPENAI_API_KEY is not set")
-  model = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
-  body = json.dumps(
-    {
-      "model": model,
-      "temperature": temperature,
-      "max_tokens": max_tokens,
-      "messages": messages,
-    }
-  ).encode("utf-8")
-  req = urllib.request.Request(
-    "https://api.openai.com/v1/chat/completions",
-    data=body,
-    headers={
-      "Content-Type": "application/json",
-      "Authorization": f"Bearer {api_key}",
-    },
-    method="POST",
-  )
-  try:
-    with urllib.request.urlopen(req, timeout=_ai_llm_http_timeout()) as resp:
-      data = json.loads(resp.read().decode("utf-8", errors="replace"))
-  except urllib.error.HTTPError as e:
-    detail = e.read().decode("utf-8", errors="replace")
-    raise HTTPException(status_code=502, detail=f"OpenAI error: {detail}")
-  except Exception as e:
-    raise HTTPException(status_code=502, detail=f"OpenAI request failed: {e}")
-  try:
-    choices = data.get("choices") or []
-    choice = choices[0]
-    content = str(choice.get("message", {}).get("content", "")).strip()
-    content = _cleanup_llm_output(content)
-    finish_reason = str(choice.get("finish_reason") or "").lower()
-    truncated = finish_reason == "length"
-    return content, truncated
-  except Exception:
-    raise HTTPException(status_code=500, detail="invalid OpenAI response format")
+  return _call_provider_with_meta(_llm_provider("openai"), messages, max_tokens, temperature, None)
 
 
 def _call_openai(messages: list, max_tokens: int = 512, temperature: float = 0.2) -> str:
@@ -2187,68 +3375,7 @@ def _stream_openai_chat(
 
   戻り値は {"type": "token"|"done", ...} 形式の dict を yield するイテレータ。
   """
-  api_key = os.environ.get("OPENAI_API_KEY")
-  if not api_key:
-    raise HTTPException(status_code=503, detail="OPENAI_API_KEY is not set")
-  model = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
-  body = json.dumps(
-    {
-      "model": model,
-      "temperature": temperature,
-      "max_tokens": max_tokens,
-      "messages": messages,
-      "stream": True,
-    }
-  ).encode("utf-8")
-  req = urllib.request.Request(
-    "https://api.openai.com/v1/chat/completions",
-    data=body,
-    headers={
-      "Content-Type": "application/json",
-      "Authorization": f"Bearer {api_key}",
-    },
-    method="POST",
-  )
-  acc_chunks: List[str] = []
-  truncated = False
-  try:
-    with urllib.request.urlopen(req, timeout=_ai_llm_http_timeout()) as resp:
-      buf = ""
-      while True:
-        chunk = resp.read(4096)
-        if not chunk:
-          break
-        buf += chunk.decode("utf-8", errors="replace")
-        lines = buf.split("\n")
-        buf = lines.pop() or ""
-        for line in lines:
-          line = line.strip()
-          if not line or not line.startswith("data:"):
-            continue
-          data_str = line[len("data:") :].strip()
-          if data_str == "[DONE]":
-            break
-          try:
-            ev = json.loads(data_str)
-          except json.JSONDecodeError:
-            continue
-          for choice in ev.get("choices") or []:
-            delta = choice.get("delta") or {}
-            content_piece = str(delta.get("content") or "")
-            if content_piece:
-              acc_chunks.append(content_piece)
-              yield {"type": "token", "delta": content_piece}
-            finish_reason = str(choice.get("finish_reason") or "").lower()
-            if finish_reason == "length":
-              truncated = True
-  except urllib.error.HTTPError as e:
-    detail = e.read().decode("utf-8", errors="replace")
-    raise HTTPException(status_code=502, detail=f"OpenAI error: {detail}")
-  except Exception as e:
-    raise HTTPException(status_code=502, detail=f"OpenAI request failed: {e}")
-
-  full = _cleanup_llm_output("".join(acc_chunks))
-  yield {"type": "done", "result": full, "truncated": truncated}
+  return _stream_provider_chat(_llm_provider("openai"), messages, max_tokens, temperature, None)
 
 
 def _stream_llm_messages(
@@ -2256,27 +3383,30 @@ def _stream_llm_messages(
   max_tokens: int = 900,
   temperature: float = 0.2,
   model: Optional[str] = None,
+  cancel: Optional[CancelToken] = None,
 ):
   """AI_PROVIDER / OPENAI_API_KEY に応じて Ollama / OpenAI のストリーミングを切り替える。"""
-  provider = (os.environ.get("AI_PROVIDER") or "").strip().lower()
-  if not provider and os.environ.get("OPENAI_API_KEY"):
-    provider = "openai"
-  if not provider:
-    provider = "ollama"
-  if provider == "ollama":
-    return _stream_ollama_chat(messages, max_tokens=max_tokens, temperature=temperature, model=model)
-  if provider == "openai":
-    return _stream_openai_chat(messages, max_tokens=max_tokens, temperature=temperature)
-  raise HTTPException(status_code=400, detail=f"unsupported AI_PROVIDER: {provider}")
-
-
-def _iter_sse_chat_llm_events(
+  return _stream_provider_chat(_llm_provider(), messages, max_tokens, temperature, model, cancel)
+
+
+def _astream_llm_messages(
+  messages: List[dict],
+  max_tokens: int = 900,
+  temperature: float = 0.2,
+  model: Optional[str] = None,
+):
+  """_stream_llm_messages の非同期版。"""
+  return _astream_provider_chat(_llm_provider(), messages, max_tokens, temperature, model)
+
+
+async def _iter_sse_chat_llm_events(
   messages: List[dict],
   chat_max_tokens: int,
   temperature: float,
   selected_model: Optional[str],
-) -> Iterator[str]:
-  """チャット用 LLM ストリームを SSE に変換。長いトークン間ギャップ中はコメント行でキープアライブを送る。"""
+):
+  """チャット用 LLM ストリームを SSE に変換。長いトークン間ギャップ中はコメント行でキープアライブを送る。
+  LLM の応答はイベントループ上で読むので、同時に多数のチャットがあってもスレッドを占有しない。"""
 
   full_text = ""
   truncated_flag = False
@@ -2303,56 +3433,39 @@ def _iter_sse_chat_llm_events(
       return f"data: {json.dumps(done_ev, ensure_ascii=False)}\n\n"
     return None
 
-  if ping <= 0:
-    for ev in _stream_llm_messages(messages, max_tokens=chat_max_tokens, temperature=temperature, model=selected_model):
+  events = _astream_llm_messages(messages, max_tokens=chat_max_tokens, temperature=temperature, model=selected_model)
+  try:
+    pending: Optional[asyncio.Future] = None
+    while True:
+      if pending is None:
+        pending = asyncio.ensure_future(events.__anext__())
+      if ping > 0:
+        done, _ = await asyncio.wait({pending}, timeout=ping)
+        if not done:
+          yield ": syncterm-hb\n\n"
+          continue
+      try:
+        ev = await pending
+      except StopAsyncIteration:
+        break
+      pending = None
       line = format_ev(ev)
       if line:
         yield line
-    return
-
-  q: queue.Queue[Tuple[str, Any]] = queue.Queue(maxsize=256)
-
-  def worker() -> None:
-    try:
-      for ev in _stream_llm_messages(messages, max_tokens=chat_max_tokens, temperature=temperature, model=selected_model):
-        q.put(("ev", ev))
-    except BaseException as e:
-      q.put(("err", e))
-    finally:
-      q.put(("end", None))
-
-  threading.Thread(target=worker, daemon=True).start()
-  while True:
-    try:
-      kind, payload = q.get(timeout=ping)
-    except queue.Empty:
-      yield ": syncterm-hb\n\n"
-      continue
-    if kind == "end":
-      break
-    if kind == "err":
-      raise payload
-    line = format_ev(payload)
-    if line:
-      yield line
+  finally:
+    if pending is not None and not pending.done():
+      pending.cancel()
+    await events.aclose()
 
 
 def _call_llm(system_prompt: str, user_prompt: str, max_tokens: int = 512, temperature: float = 0.2, model: Optional[str] = None) -> str:
   """AI_PROVIDER または OPENAI_API_KEY の有無で Ollama / OpenAI を切り替え。未設定なら Ollama 優先（API フリー）。"""
-  provider = (os.environ.get("AI_PROVIDER") or "").strip().lower()
-  if not provider and os.environ.get("OPENAI_API_KEY"):
-    provider = "openai"
-  if not provider:
-    provider = "ollama"
   messages = [
     {"role": "system", "content": system_prompt},
     {"role": "user", "content": user_prompt},
   ]
-  if provider == "ollama":
-    return _call_ollama(messages, max_tokens=max_tokens, temperature=temperature, model=model)
-  if provider == "openai":
-    return _call_openai(messages, max_tokens=max_tokens, temperature=temperature)
-  raise HTTPException(status_code=400, detail=f"unsupported AI_PROVIDER: {provider}")
+  content, _truncated = _call_llm_messages_with_meta(messages, max_tokens=max_tokens, temperature=temperature, model=model)
+  return content
 
 
 def _call_llm_messages_with_meta(
@@ -2365,16 +3478,7 @@ def _call_llm_messages_with_meta(
 
   戻り値は (content, truncated)。
   """
-  provider = (os.environ.get("AI_PROVIDER") or "").strip().lower()
-  if not provider and os.environ.get("OPENAI_API_KEY"):
-    provider = "openai"
-  if not provider:
-    provider = "ollama"
-  if provider == "ollama":
-    return _call_ollama_with_meta(messages, max_tokens=max_tokens, temperature=temperature, model=model)
-  if provider == "openai":
-    return _call_openai_with_meta(messages, max_tokens=max_tokens, temperature=temperature)
-  raise HTTPException(status_code=400, detail=f"unsupported AI_PROVIDER: {provider}")
+  return _call_provider_with_meta(_llm_provider(), messages, max_tokens, temperature, model)
 
 
 def _call_llm_messages(
@@ -2396,106 +3500,256 @@ def call_openai_chat_limited(system_prompt: str, user_prompt: str, max_tokens: i
   return _call_llm(system_prompt, user_prompt, max_tokens=max_tokens, temperature=0.1, model=model)
 
 
-def _ollama_request(path: str, method: str = "GET", data: Optional[bytes] = None, timeout: float = 30) -> dict:
-  base = os.environ.get("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
-  url = f"{base.rstrip('/')}{path}"
-  req = urllib.request.Request(url, data=data, method=method)
-  if data:
-    req.add_header("Content-Type", "application/json")
-  with urllib.request.urlopen(req, timeout=timeout) as resp:
-    return json.loads(resp.read().decode("utf-8", errors="replace"))
+def _ollama_request(path: str, method: str = "GET", payload: Optional[dict] = None, timeout: float = 30) -> dict:
+  return get_llm_provider("ollama").request_json(path, method=method, payload=payload, timeout=timeout)
 
 
 def _ollama_pull(model: str, timeout: float = 600) -> None:
-  base = os.environ.get("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
-  body = json.dumps({"name": model, "stream": False}).encode("utf-8")
-  req = urllib.request.Request(
-    f"{base.rstrip('/')}/api/pull",
-    data=body,
-    headers={"Content-Type": "application/json"},
-    method="POST",
-  )
-  with urllib.request.urlopen(req, timeout=timeout) as resp:
-    data = json.loads(resp.read().decode("utf-8", errors="replace"))
+  data = get_llm_provider("ollama").request_json("/api/pull", "POST", {"name": model, "stream": False}, timeout=timeout)
   if data.get("status") != "success":
     raise HTTPException(status_code=502, detail=f"Ollama pull failed: {data.get('status', 'unknown')}")
 
 
 def _ollama_pull_stream(model: str, timeout: float = 600):
   """Ollama pull を stream で実行し、各イベントを yield する。"""
-  base = os.environ.get("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
-  body = json.dumps({"name": model, "stream": True}).encode("utf-8")
-  req = urllib.request.Request(
-    f"{base.rstrip('/')}/api/pull",
-    data=body,
-    headers={"Content-Type": "application/json"},
-    method="POST",
-  )
   try:
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-      buf = b""
-      while True:
-        chunk = resp.read(4096)
-        if not chunk:
-          if buf.strip():
-            try:
-              yield json.loads(buf.decode("utf-8", errors="replace"))
-            except json.JSONDecodeError:
-              pass
-          break
-        buf += chunk
-        while b"\n" in buf:
-          line, buf = buf.split(b"\n", 1)
-          line = line.strip()
-          if not line:
-            continue
-          try:
-            yield json.loads(line.decode("utf-8", errors="replace"))
-          except json.JSONDecodeError:
-            pass
-  except urllib.error.HTTPError as e:
-    yield {"status": "error", "error": e.read().decode("utf-8", errors="replace")}
+    yield from get_llm_provider("ollama").stream_json("/api/pull", {"name": model, "stream": True}, timeout=timeout)
+  except LLMHTTPError as e:
+    yield {"status": "error", "error": e.body}
   except Exception as e:
     yield {"status": "error", "error": str(e)}
 
 
-def _ollama_stop_model(name: str, timeout: float = 10) -> None:
-  base = os.environ.get("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
-  body = json.dumps({"name": name}).encode("utf-8")
-  req = urllib.request.Request(
-    f"{base.rstrip('/')}/api/stop",
-    data=body,
-    headers={"Content-Type": "application/json"},
-    method="POST",
-  )
+def _ollama_stop_model(name: str, timeout: float = 10) -> bool:
+  """モデルをアンロードする（prompt なし・keep_alive 0 の /api/generate）。成功したら True"""
   try:
-    with urllib.request.urlopen(req, timeout=timeout):
-      return
+    data = get_llm_provider("ollama").request_json(
+      "/api/generate", "POST", {"model": name, "keep_alive": 0}, timeout=timeout
+    )
   except Exception:
-    # モデルが既にアンロード済み or 未起動などは無視
-    return
+    # 既にアンロード済み・Ollama に届かないなどは失敗として扱い、呼び出し側で /api/ps を読み直す
+    return False
+  return data.get("done_reason") in (None, "unload") and not data.get("error")
 
 
-def _ollama_stop_unselected(chosen_model: str) -> None:
-  """現在ロードされているモデルのうち、選択中以外をアンロードしてメモリを解放する。"""
-  base_name = (chosen_model or "").strip()
-  if not base_name:
-    return
-  # コロンなし表記にも対応
-  base_name_short = base_name.split(":", 1)[0]
-  try:
-    data = _ollama_request("/api/ps", timeout=5)
-    models = data.get("models", []) or []
-    for m in models:
-      name = (m.get("name") or "").strip()
-      if not name:
+def _ollama_model_key(name: Optional[str]) -> str:
+  """/api/ps の表記に揃える（タグ省略は :latest）"""
+  name = (name or "").strip()
+  if name and ":" not in name:
+    name += ":latest"
+  return name
+
+
+# /api/ps・/api/tags の結果を使い回す秒数
+RESIDENCY_PS_TTL = 5.0
+RESIDENCY_TAGS_TTL = 60.0
+# VRAM のうちモデル本体に使ってよい割合（残りは KV キャッシュや他プロセス用）
+RESIDENCY_VRAM_FRACTION = 0.9
+# 先読みでのモデルロード待ち上限（秒）
+RESIDENCY_LOAD_TIMEOUT = 600
+
+
+class _ModelResidencyManager:
+  """Ollama に載っているモデルを、VRAM 予算内の LRU として管理する。
+
+  - 載っているモデルとメモリ量は /api/ps から取る。使った時刻と実行中の呼び出し数はここで覚える
+  - 新しいモデルを使う前に、予算を超える分だけ「実行中でない・最も古く使った」モデルからアンロードする
+  - 次に使いそうなモデル（Multi のレビュアーなど）は prefetch でバックグラウンドに載せておく
+  - VRAM が不明（AI_VRAM_GB / [ai] vram_gb 未設定）のときは Ollama の判断に任せ、何もアンロードしない
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._loaded: Dict[str, int] = {}
+    self._loaded_at = 0.0
+    self._installed: Dict[str, int] = {}
+    self._installed_at = 0.0
+    self._last_used: Dict[str, float] = {}
+    self._active: Dict[str, int] = {}
+    self._prefetching: set[str] = set()
+
+  def budget_bytes(self) -> Optional[int]:
+    vram = _get_available_vram_gb()
+    if not vram or vram <= 0:
+      return None
+    return int(vram * RESIDENCY_VRAM_FRACTION * (1024 ** 3))
+
+  def loaded(self, refresh: bool = False) -> Dict[str, int]:
+    """{モデル名: 使用メモリ (bytes)}。取得に失敗したら前回の値"""
+    with self._lock:
+      if not refresh and time.time() - self._loaded_at < RESIDENCY_PS_TTL:
+        return dict(self._loaded)
+    try:
+      data = _ollama_request("/api/ps", timeout=5)
+    except Exception:
+      with self._lock:
+        return dict(self._loaded)
+    models: Dict[str, int] = {}
+    for m in data.get("models", []) or []:
+      name = _ollama_model_key(m.get("name") or m.get("model"))
+      if name:
+        models[name] = int(m.get("size_vram") or m.get("size") or 0)
+    with self._lock:
+      self._loaded = models
+      self._loaded_at = time.time()
+      for name in models:
+        # 外部（ollama run など）で載ったモデルは最も古い扱い
+        self._last_used.setdefault(name, 0.0)
+      return dict(models)
+
+  def installed(self) -> Dict[str, int]:
+    """{インストール済みモデル名: ファイルサイズ (bytes)}。まだ載っていないモデルのメモリ量の見積もりに使う"""
+    with self._lock:
+      if time.time() - self._installed_at < RESIDENCY_TAGS_TTL:
+        return dict(self._installed)
+    try:
+      data = _ollama_request("/api/tags", timeout=5)
+    except Exception:
+      with self._lock:
+        return dict(self._installed)
+    models: Dict[str, int] = {}
+    for m in data.get("models", []) or []:
+      name = _ollama_model_key(m.get("name") or m.get("model"))
+      if name:
+        models[name] = int(m.get("size") or 0)
+    with self._lock:
+      self._installed = models
+      self._installed_at = time.time()
+    return models
+
+  def acquire(self, model: Optional[str]) -> str:
+    key = _ollama_model_key(model or get_llm_config().ollama_model)
+    with self._lock:
+      self._active[key] = self._active.get(key, 0) + 1
+      self._last_used[key] = time.time()
+    return key
+
+  def release(self, key: str) -> None:
+    with self._lock:
+      n = self._active.get(key, 0) - 1
+      if n > 0:
+        self._active[key] = n
+      else:
+        self._active.pop(key, None)
+      self._last_used[key] = time.time()
+
+  def make_room(self, model: Optional[str], protect: Tuple[str, ...] = ()) -> List[str]:
+    """model を載せても予算に収まるよう、古いモデルからアンロードする。アンロードしたモデル名を返す"""
+    budget = self.budget_bytes()
+    if budget is None:
+      return []
+    key = _ollama_model_key(model or get_llm_config().ollama_model)
+    loaded = self.loaded()
+    if key in loaded:
+      need = 0
+    else:
+      need = self.installed().get(key, 0)
+    keep = {key, *(_ollama_model_key(m) for m in protect)}
+    with self._lock:
+      candidates = sorted(
+        (name for name in loaded if name not in keep and not self._active.get(name)),
+        key=lambda name: self._last_used.get(name, 0.0),
+      )
+    total = sum(loaded.values())
+    evicted: List[str] = []
+    failed = False
+    for name in candidates:
+      if total + need <= budget:
+        break
+      if not _ollama_stop_model(name):
+        failed = True
         continue
-      short = name.split(":", 1)[0]
-      if short != base_name_short:
-        _ollama_stop_model(name)
-  except Exception:
-    # ps 取得に失敗した場合は何もしない（安全優先）
-    return
+      total -= loaded[name]
+      evicted.append(name)
+    if failed:
+      # 失敗したモデルが本当に載っているかは /api/ps に聞き直す
+      self.loaded(refresh=True)
+    elif evicted:
+      with self._lock:
+        for name in evicted:
+          self._loaded.pop(name, None)
+    return evicted
+
+  def concurrent_fit(self, models: List[str], protect: Tuple[str, ...] = ()) -> int:
+    """models を先頭から何個まで同時に載せられるか（最低 1。VRAM 不明なら全部）
+
+    実行中のモデルと protect（Multi のモデレーターなど）のうち載っているものは
+    アンロードされないので、その分を先に予算から差し引く。
+    """
+    budget = self.budget_bytes()
+    if budget is None:
+      return len(models)
+    loaded = self.loaded()
+    installed = self.installed()
+    keys = [_ollama_model_key(m) for m in models]
+    with self._lock:
+      pinned = {name for name, n in self._active.items() if n > 0}
+    pinned.update(_ollama_model_key(m) for m in protect)
+    # models に含まれるものはループで数えるので二重に数えない
+    pinned.difference_update(keys)
+    total = sum(loaded.get(name, 0) for name in pinned)
+    seen: set[str] = set()
+    count = 0
+    for key in keys:
+      if key not in seen:
+        seen.add(key)
+        total += loaded.get(key) or installed.get(key, 0)
+      if total > budget:
+        break
+      count += 1
+    return max(1, count)
+
+  def _load(self, key: str, protect: Tuple[str, ...]) -> None:
+    try:
+      if key in self.loaded() or key not in self.installed():
+        return
+      budget = self.budget_bytes()
+      if budget is None:
+        return
+      self.make_room(key, protect)
+      # 予算に収まらないなら実行中のモデルを押し出さないよう先読みはやめる
+      if sum(self.loaded().values()) + self.installed().get(key, 0) > budget:
+        return
+      payload: Dict[str, Any] = {"model": key}
+      keep_alive = get_llm_config().keep_alive_for(key)
+      if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+      # prompt なしの /api/generate はモデルをロードするだけ
+      _ollama_request("/api/generate", "POST", payload, timeout=RESIDENCY_LOAD_TIMEOUT)
+      with self._lock:
+        self._last_used[key] = time.time()
+      self.loaded(refresh=True)
+    except Exception:
+      return
+    finally:
+      with self._lock:
+        self._prefetching.discard(key)
+
+  def prefetch(self, models: List[str], protect: Tuple[str, ...] = ()) -> None:
+    """次に使うモデルをバックグラウンドで順にロードする（Ollama 以外・VRAM 不明のときは何もしない）。
+    protect のモデルと先読み対象どうしは、場所を空けるためのアンロード対象にしない"""
+    if get_llm_config().provider != "ollama" or self.budget_bytes() is None:
+      return
+    keys = [_ollama_model_key(m) for m in models if m and m.strip()]
+    protect = tuple(keys) + tuple(protect)
+    with self._lock:
+      keys = [k for k in keys if k not in self._prefetching]
+      self._prefetching.update(keys)
+    if not keys:
+      return
+
+    def _run():
+      for key in keys:
+        self._load(key, protect)
+
+    threading.Thread(target=_run, name="ollama-prefetch", daemon=True).start()
+
+
+_model_residency = _ModelResidencyManager()
+
+
+def _get_ollama_installed_models() -> List[str]:
+  return sorted(_model_residency.installed())
 
 
 def _ollama_suggested_models() -> List[str]:
@@ -2632,11 +3886,7 @@ def _ollama_suggested_models() -> List[str]:
 @app.get("/watchers/{wid}/sessions/{sess}/ai-models")
 def get_ai_models(wid: str, sess: str):
   session_root(wid, sess)
-  provider = (os.environ.get("AI_PROVIDER") or "").strip().lower()
-  if not provider and os.environ.get("OPENAI_API_KEY"):
-    provider = "openai"
-  if not provider:
-    provider = "ollama"
+  provider = get_llm_config().provider
   if provider != "ollama":
     return {"installed": [], "suggested": [], "provider": provider}
   try:
@@ -2689,7 +3939,7 @@ def get_ai_models(wid: str, sess: str):
     ]
   # 候補に存在しないものは除外
   recommended = [m for m in recommended if m in suggested_all]
-  default = (os.environ.get("OLLAMA_MODEL") or "qwen2.5-coder:7b").strip()
+  default = get_llm_config().ollama_model.strip()
   if default and default not in suggested:
     suggested = [default] + [s for s in suggested if s != default]
   if default and default not in recommended and default in suggested_all:
@@ -2700,14 +3950,18 @@ def get_ai_models(wid: str, sess: str):
 @app.post("/watchers/{wid}/sessions/{sess}/ai-ensure-model")
 def ai_ensure_model(wid: str, sess: str, payload: AiEnsureModelPayload):
   session_root(wid, sess)
-  if (os.environ.get("AI_PROVIDER") or "").strip().lower() == "openai":
+  if get_llm_config().provider == "openai":
     return {"ok": True, "message": "OpenAI does not require model install"}
   try:
     model = payload.model.strip()
     _ollama_pull(model, timeout=600)
-    _ollama_stop_unselected(model)
-  except urllib.error.HTTPError as e:
-    raise HTTPException(status_code=e.code, detail=e.read().decode("utf-8", errors="replace"))
+    # 他のモデルは VRAM 予算を超える分だけ古い順にアンロードし、選んだモデルを先に載せておく
+    _model_residency.make_room(model)
+    _model_residency.prefetch([model])
+  except LLMHTTPError as e:
+    raise HTTPException(status_code=e.status, detail=e.body)
+  except HTTPException:
+    raise
   except Exception as e:
     raise HTTPException(status_code=502, detail=str(e))
   return {"ok": True}
@@ -2717,7 +3971,7 @@ def ai_ensure_model(wid: str, sess: str, payload: AiEnsureModelPayload):
 def ai_ensure_model_stream(wid: str, sess: str, payload: AiEnsureModelPayload):
   """モデル pull の進捗を SSE でストリームする。"""
   session_root(wid, sess)
-  if (os.environ.get("AI_PROVIDER") or "").strip().lower() == "openai":
+  if get_llm_config().provider == "openai":
     def _openai_done():
       yield f"data: {json.dumps({'status': 'success', 'message': 'OpenAI does not require model install'})}\n\n"
     return StreamingResponse(_openai_done(), media_type="text/event-stream", headers=dict(_AI_SSE_HEADERS))
@@ -2733,8 +3987,9 @@ def ai_ensure_model_stream(wid: str, sess: str, payload: AiEnsureModelPayload):
       if isinstance(total, (int, float)) and total and isinstance(completed, (int, float)):
         ev = {**ev, "percent": min(100, round(100 * completed / total))}
       yield f"data: {json.dumps(ev)}\n\n"
-    # pull 完了後に他モデルをアンロード
-    _ollama_stop_unselected(model)
+    # pull 完了後、予算を超える分だけ他モデルをアンロードして選んだモデルを載せておく
+    _model_residency.make_room(model)
+    _model_residency.prefetch([model])
 
   return StreamingResponse(_gen(), media_type="text/event-stream", headers=dict(_AI_SSE_HEADERS))
 
@@ -2759,6 +4014,7 @@ def _send_internal_cmd(wid: str, sess: str, cmd: str) -> dict:
   """内部コマンドを RT で送信。RT 成功時は commands.txt に書かない（poll で二重実行されるため）。
   Relay 上にセッション dir が無くても送信する（RT は Watcher 側の dir で実行される）。"""
   rt_resp, rt_reason = _post_command_via_rt_with_response(wid, sess, cmd)
+  invalidate_symlink_cache(wid, sess)
   if rt_resp is not None:
     return {"ok": True, "rt": True}
   if rt_reason == "session_not_found":
@@ -2766,6 +4022,9 @@ def _send_internal_cmd(wid: str, sess: str, cmd: str) -> dict:
       status_code=404,
       detail="Session not found on Watcher. Ensure Watcher has LOCAL_WATCHER_DIR/session and watcher_manager_rt.sh has run.",
     )
+  if rt_reason == "channel_send_uncertain":
+    # Watcher に届いている可能性があるので commands.txt で送り直さない（二重実行になる）
+    raise HTTPException(status_code=503, detail="command may have reached the Watcher; not retried")
   root = SESSIONS_ROOT / wid / sess
   cmd_file = root / "commands.txt"
   cmd_file.parent.mkdir(parents=True, exist_ok=True)
@@ -2851,7 +4110,48 @@ def _extract_command_from_response(text: str) -> Optional[str]:
 
 
 def _strip_command_tags(text: str) -> str:
-  return re.sub(r"<command>[\s\S]*?</command>", "", text, flags=re.DOTALL | re.IGNORECASE).strip()
+  text = re.sub(r"<command>[\s\S]*?</command>", "", text, flags=re.DOTALL | re.IGNORECASE)
+  return re.sub(r"<search\b[^>]*>[\s\S]*?</search\s*>", "", text, flags=re.DOTALL | re.IGNORECASE).strip()
+
+
+# Agent の <search> 1 回で返す一致数の上限（モデルへ返す出力を抑える）
+AGENT_SEARCH_MAX_RESULTS = 200
+
+# Agent 用 system プロンプトに足す <search> の説明
+AGENT_SEARCH_PROMPT = (
+  "To find text in the workspace, prefer <search>TEXT</search> over grep -r: it uses the watcher's index and "
+  "returns path:line:text relative to the session root. Optional attributes: path=\"sub/dir\", regex=\"true\", "
+  "include=\"*.py,*.md\". It honours .gitignore and skips hidden and binary files; use grep in a <command> "
+  "when you need those.\n"
+)
+
+
+def _extract_searches_from_response(text: str) -> List[SearchPayload]:
+  """<search path="..." regex="true" include="*.py,*.md">TEXT</search> を抽出して検索条件にする"""
+  out: List[SearchPayload] = []
+  for attrs, body in re.findall(r"<search\b([^>]*)>([\s\S]*?)</search\s*>", text, re.DOTALL | re.IGNORECASE):
+    query = body.strip()
+    if not query:
+      continue
+    opts = {k.lower(): v for k, _, v in re.findall(r'(\w+)\s*=\s*(["\'])(.*?)\2', attrs)}
+    out.append(SearchPayload(
+      query=query,
+      path=(opts.get("path") or ".").strip().lstrip("/") or ".",
+      regex=opts.get("regex", "").strip().lower() in ("1", "true", "yes"),
+      include=[g.strip() for g in opts.get("include", "").split(",") if g.strip()],
+      maxResults=AGENT_SEARCH_MAX_RESULTS,
+    ))
+  return out
+
+
+def _agent_search_label(payload: SearchPayload) -> str:
+  """ログ・UI に出す <search> の表記"""
+  label = f"[search] {payload.query!r}"
+  if payload.path != ".":
+    label += f" in {payload.path}"
+  if payload.include:
+    label += f" ({','.join(payload.include)})"
+  return label
 
 
 def _strip_edit_tags(text: str) -> str:
@@ -3169,6 +4469,104 @@ def _is_potentially_destructive_command(cmd: str) -> bool:
   return any(d in c for d in dangerous)
 
 
+# 読み取り専用とみなすコマンド。判定は relay だけで行い、Watcher には /command の readOnly で伝える
+_AGENT_READONLY_COMMANDS = frozenset({
+  "cat", "head", "tail", "ls", "pwd", "wc", "grep", "egrep", "fgrep", "rg", "find", "stat", "file", "du", "df",
+  "tree", "which", "whoami", "id", "uname", "date", "echo", "printenv", "diff", "cmp", "sort", "cut",
+  "nl", "md5sum", "sha1sum", "sha256sum", "basename", "dirname", "realpath", "readlink", "nproc", "free",
+  "uptime", "ps", "lscpu", "jq",
+})
+_AGENT_READONLY_SUBCOMMANDS = {
+  "git": frozenset({"status", "log", "diff", "show", "rev-parse", "ls-files", "ls-tree", "blame", "grep", "describe", "shortlog", "cat-file"}),
+  "pip": frozenset({"show", "list", "freeze"}),
+  "pip3": frozenset({"show", "list", "freeze"}),
+  "conda": frozenset({"list", "info"}),
+  "npm": frozenset({"ls", "list", "view"}),
+}
+# --version / -V だけなら読み取り専用
+_AGENT_VERSION_ONLY_COMMANDS = frozenset({"python", "python3", "node", "nvcc", "gcc", "go", "rustc", "cargo", "java"})
+# 読み取り系でも書き込み・実行になる引数。
+# "-x" は短いオプション（-ux のようにまとめて書かれても拾う）、"--xxx" は長いオプション（省略形も拾う）、
+# それ以外の "-xxx"（find の述語）は完全一致で見る
+_AGENT_READONLY_FORBIDDEN_ARGS = {
+  "find": ("-exec", "-execdir", "-ok", "-okdir", "-delete", "-fprint", "-fprint0", "-fprintf", "-fls"),
+  "sort": ("-o", "--output", "--compress-program"),
+  "date": ("-s", "--set"),
+  "tree": ("-o",),
+  "rg": ("--pre", "--pre-glob"),
+  "git": ("-O", "--open-files-in-pager", "--output", "--ext-diff", "--textconv"),
+}
+# 引数がこれだけなら読み取り専用（値を取るものは "--name=" の形）
+_AGENT_READONLY_QUERY_ARGS = {
+  # 引数つきはホスト名の変更（-F / --file はファイルから設定）になる
+  "hostname": frozenset({
+    "-s", "--short", "-f", "--fqdn", "--long", "-d", "--domain", "-i", "--ip-address",
+    "-I", "--all-ip-addresses", "-A", "--all-fqdns",
+  }),
+  # -pm / -r / -ac などの設定変更を除き、一覧・問い合わせだけ
+  "nvidia-smi": frozenset({"-L", "--list-gpus", "-q", "--query", "--query-gpu=", "--query-compute-apps=", "--format="}),
+}
+
+
+def _agent_arg_is_forbidden(arg: str, forbidden: Tuple[str, ...]) -> bool:
+  if arg.startswith("--"):
+    name = arg.split("=", 1)[0]
+    # GNU の長いオプションは一意な前方一致（--out など）でも通る
+    return any(f.startswith("--") and (f == name or (len(name) > 3 and f.startswith(name))) for f in forbidden)
+  if arg.startswith("-") and len(arg) > 1:
+    if arg in forbidden:
+      return True
+    # -uo / -ofile のようなまとめ書き。値の部分も含めて 1 文字ずつ見る（誤って弾くぶんには害がない）
+    shorts = {f[1] for f in forbidden if len(f) == 2}
+    return any(ch in shorts for ch in arg[1:])
+  return False
+
+
+def _agent_segment_is_readonly(tokens: List[str]) -> bool:
+  if not tokens:
+    return False
+  name = tokens[0]
+  args = tokens[1:]
+  allowed = _AGENT_READONLY_QUERY_ARGS.get(name)
+  if allowed is not None:
+    return all(a in allowed or (a.startswith("--") and "=" in a and a.split("=", 1)[0] + "=" in allowed) for a in args)
+  forbidden = _AGENT_READONLY_FORBIDDEN_ARGS.get(name, ())
+  if any(_agent_arg_is_forbidden(a, forbidden) for a in args):
+    return False
+  if name in _AGENT_READONLY_COMMANDS:
+    return True
+  if name in _AGENT_VERSION_ONLY_COMMANDS:
+    return args in (["--version"], ["-V"], ["version"])
+  subcommands = _AGENT_READONLY_SUBCOMMANDS.get(name)
+  return bool(subcommands and args and args[0] in subcommands)
+
+
+def _is_readonly_agent_command(cmd: str) -> bool:
+  """cwd・ファイル・環境を変えない読み取り専用コマンドか（同じステップの他のコマンドと並列に実行してよいか）。
+
+  パイプ（|）でつないだ各段が許可リストのコマンドであることを求める。リダイレクト・; && & ・サブシェル・$ 展開・
+  バッククォートを含むものは、中身にかかわらず読み取り専用としない。
+  """
+  c = (cmd or "").strip()
+  if not c or "`" in c or "$" in c or "\n" in c:
+    return False
+  try:
+    lexer = shlex.shlex(c, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    tokens = list(lexer)
+  except ValueError:
+    return False
+  segments: List[List[str]] = [[]]
+  for tok in tokens:
+    if tok == "|":
+      segments.append([])
+    elif tok and all(ch in "();<>|&" for ch in tok):
+      return False
+    else:
+      segments[-1].append(tok)
+  return all(_agent_segment_is_readonly(seg) for seg in segments)
+
+
 def _truncate_agent_output(text: str, max_chars: int = 8000) -> str:
   s = _strip_cmd_exit_markers(text or "")
   if len(s) <= max_chars:
@@ -3376,7 +4774,9 @@ def _execute_agent_command(
   send_cmd = f"_agent_silent::{cmd}"
 
   # 1) RT を先に試す
-  rt_resp, rt_error = _post_command_via_rt_with_response(wid, sess, send_cmd, timeout=timeout)
+  rt_resp, rt_error = _post_command_via_rt_with_response(
+    wid, sess, send_cmd, timeout=timeout, read_only=_is_readonly_agent_command(cmd),
+  )
   if rt_resp is not None:
     return {
       "ok": True,
@@ -3387,8 +4787,7 @@ def _execute_agent_command(
     }, ""
 
   # 2) RT watcher があるのに届かなかった場合は、その失敗をそのまま返す
-  rt_port = _get_rt_port(wid)
-  if rt_port is not None:
+  if _has_rt_transport(wid):
     return None, f"rt_delivery_failed:{rt_error}"
 
   # 3) 非 RT 構成なら commands.txt 経由にフォールバック
@@ -3396,25 +4795,101 @@ def _execute_agent_command(
   if not root.exists():
     return None, "session_not_found"
 
-  ok = append_command_and_wait_processed(root, send_cmd, timeout_sec=min(float(timeout), 20.0))
-  if not ok:
+  record = append_command_and_wait_done(root, send_cmd, timeout_sec=min(float(timeout), 20.0))
+  if record is None:
     return None, "commands_txt_timeout"
 
   # commands.txt フォールバックでは watcher 応答本文を即取得できない場合がある。
   # 少なくとも「配送・処理完了」は返し、次の推論で transport failure 扱いにしない。
+  # 完了記録があれば終了コードはそこから取る（旧 Watcher は 0 扱い）。
   return {
     "ok": True,
     "rt": False,
     "output": "",
-    "exitCode": 0,
+    "exitCode": record.get("exitCode", 0),
     "_trace": {"method": "commands_txt"},
   }, ""
 
 
+def _execute_agent_search(wid: str, sess: str, payload: SearchPayload) -> Tuple[Optional[dict], str]:
+  """Agent の <search> を Watcher の /search で実行し、grep -rn と同じ path:line:text の出力にする。
+  戻り値は _execute_agent_command と同じ形（一致なしは exitCode 1）"""
+  try:
+    resp = _open_search_via_rt(wid, sess, payload)
+  except HTTPException as e:
+    return None, f"search_failed:{e.detail}"
+  lines: List[str] = []
+  done: dict = {}
+  try:
+    for raw in resp:
+      if not raw.strip():
+        continue
+      frame = json.loads(raw)
+      if frame.get("type") == "match":
+        lines.append(f"{frame.get('path')}:{frame.get('line')}:{frame.get('preview', '')}")
+      elif frame.get("type") == "error":
+        return None, f"search_failed:{frame.get('error')}"
+      elif frame.get("type") == "done":
+        done = frame
+  except Exception as e:
+    return None, f"search_failed:{e}"
+  finally:
+    resp.close()
+  if not done:
+    return None, "search_failed:stream ended without a done frame"
+  if done.get("truncated"):
+    lines.append(f"[truncated at {len(lines)} matches; narrow the query, path or include]")
+  return {"ok": True, "output": "\n".join(lines), "exitCode": 0 if done.get("matches") else 1}, ""
+
+
+# 1 ステップで同時に実行する読み取り専用コマンドの上限（Watcher の WATCHER_READONLY_PARALLEL の既定と同じ）
+AGENT_PARALLEL_COMMANDS = 4
+
+
+def _agent_command_batches(wid: str, cmds: List[str]) -> List[List[str]]:
+  """提案されたコマンドを、続けて並んだ読み取り専用コマンドのまとまりに分ける（それ以外は 1 つずつ）。
+  書き込みうるコマンドは前後の区切りになるので、順序に依存する手順はそのまま保たれる。
+  commands.txt 経由（RT 無し）は 1 本の列で処理されるため並列にしない"""
+  if len(cmds) < 2 or not _has_rt_transport(wid):
+    return [[cmd] for cmd in cmds]
+  batches: List[List[str]] = []
+  for cmd in cmds:
+    if _is_readonly_agent_command(cmd) and batches and _is_readonly_agent_command(batches[-1][-1]):
+      batches[-1].append(cmd)
+    else:
+      batches.append([cmd])
+  return batches
+
+
+def _agent_command_result(cmd: str, exec_resp: Optional[dict], exec_error: str) -> Tuple[AgentCommandLog, str]:
+  """_execute_agent_command の結果を (ログ, モデルへ返すフィードバック) にする"""
+  if exec_resp is not None:
+    out = _truncate_agent_output(exec_resp.get("output", ""))
+    exit_code = exec_resp.get("exitCode", 0)
+    return (
+      AgentCommandLog(command=cmd, exitCode=exit_code, output=out, outputId=exec_resp.get("outputId")),
+      f"[Command executed]\n"
+      f"$ {cmd}\n\n"
+      f"Exit code: {exit_code}\n\n"
+      f"Output:\n{out}",
+    )
+  return (
+    AgentCommandLog(command=cmd, exitCode=None, output="", error=exec_error),
+    f"[Command delivery failed]\n"
+    f"$ {cmd}\n\n"
+    f"Error: {exec_error}",
+  )
+
+
 # トークン上限で途切れた場合に「続き」を取得する最大回数（任意長対応）
 MAX_CONTINUATION_ROUNDS = 50
 
 
+def _raise_if_cancelled(cancel: Optional[CancelToken]) -> None:
+  if cancel is not None and cancel.cancelled:
+    raise CancelledError("agent loop cancelled")
+
+
 def _run_agent_loop(
   wid: str,
   sess: str,
@@ -3425,16 +4900,71 @@ def _run_agent_loop(
   temperature: float = 0.2,
   *,
   editor_rel_path: Optional[str] = None,
+  on_event=None,
+  cancel: Optional[CancelToken] = None,
 ) -> AiAssistResponse:
-  """Agent モード: <edit> は提案として返し UI 承認後に保存、<command> でシェル実行。危険コマンドは承認待ち。"""
+  """_iter_agent_loop を最後まで回して結果を返す。on_event を渡すと途中のイベントを 1 つずつ渡す（モデル出力もストリームで取る）"""
+  events = _iter_agent_loop(
+    wid,
+    sess,
+    messages,
+    model,
+    max_iterations=max_iterations,
+    max_tokens=max_tokens,
+    temperature=temperature,
+    editor_rel_path=editor_rel_path,
+    stream=on_event is not None,
+    cancel=cancel,
+  )
+  while True:
+    try:
+      ev = next(events)
+    except StopIteration as stop:
+      return stop.value
+    if on_event is not None:
+      on_event(ev)
+
+
+def _iter_agent_loop(
+  wid: str,
+  sess: str,
+  messages: List[dict],
+  model: Optional[str],
+  max_iterations: int = 10,
+  max_tokens: int = 900,
+  temperature: float = 0.2,
+  *,
+  editor_rel_path: Optional[str] = None,
+  stream: bool = False,
+  cancel: Optional[CancelToken] = None,
+) -> Iterator[dict]:
+  """Agent モード: <edit> は提案として返し UI 承認後に保存、<command> でシェル実行、<search> は Watcher の全文検索。
+  危険コマンドは承認待ち。
+
+  途中経過をイベントとして yield し、最終結果の AiAssistResponse は return する（StopIteration.value）。
+  cancel が立ったら、モデルの生成を打ち切り、次のステップ・コマンドに進まずに CancelledError を送出する。
+  - agent_step: 各ステップの開始 / agent_token: モデル出力の差分（stream=True のときだけ）
+  - agent_command: 提案されたコマンド（<search> も含む） / command_start, command_end: 実行の開始と結果
+  - agent_edit: <edit> の提案
+  """
   logs: List[AgentCommandLog] = []
   shallow_deferrals = 0
   no_cmd_deferrals = 0
   edit_plain_dump_retries = 0
   edit_syntax_retries = 0
-  for _ in range(max_iterations):
+  for step in range(max_iterations):
+    _raise_if_cancelled(cancel)
     effective_editor = editor_rel_path or _extract_current_file_path_from_messages(messages)
-    response = _call_llm_messages(messages, max_tokens=max_tokens, temperature=temperature, model=model)
+    yield {"type": "agent_step", "step": step, "model": model}
+    if stream:
+      response = ""
+      for ev in _stream_provider_chat(_llm_provider(), messages, max_tokens, temperature, model, cancel):
+        if ev["type"] == "token":
+          yield {"type": "agent_token", "step": step, "delta": ev["delta"]}
+        else:
+          response = ev["result"]
+    else:
+      response = _call_llm_messages(messages, max_tokens=max_tokens, temperature=temperature, model=model)
     proposed = _build_proposed_agent_edits(wid, sess, response)
     py_syntax_errs = _collect_python_syntax_errors_for_edits(proposed)
     if proposed and py_syntax_errs:
@@ -3465,6 +4995,7 @@ def _run_agent_loop(
         )
     if proposed:
       for pe in proposed:
+        yield {"type": "agent_edit", "step": step, "path": pe.path, "chars": len(pe.newContent)}
         logs.append(
           AgentCommandLog(
             command=f"[edit proposed] {pe.path}",
@@ -3515,7 +5046,8 @@ def _run_agent_loop(
       )
       continue
     cmds = _extract_commands_from_response(response)
-    if not cmds:
+    searches = _extract_searches_from_response(response)
+    if not cmds and not searches:
       # まだ一度もコマンドを提案していない場合は、要約ではなく具体的コマンド提案を強制する
       if not logs and no_cmd_deferrals < 2:
         no_cmd_deferrals += 1
@@ -3611,6 +5143,7 @@ def _run_agent_loop(
       )
       continue
 
+    yield {"type": "agent_command", "step": step, "commands": cmds + [_agent_search_label(p) for p in searches]}
     for cmd in cmds:
       if _is_potentially_destructive_command(cmd):
         cleaned = _strip_command_tags(response)
@@ -3619,25 +5152,39 @@ def _run_agent_loop(
         return AiAssistResponse(result=cleaned, command=cmd, needsApproval=True, logs=logs)
 
     feedback_blocks: List[str] = []
-    for cmd in cmds:
-      exec_resp, exec_error = _execute_agent_command(wid, sess, cmd, timeout=120)
-      if exec_resp is not None:
-        out = _truncate_agent_output(exec_resp.get("output", ""))
-        exit_code = exec_resp.get("exitCode", 0)
-        logs.append(AgentCommandLog(command=cmd, exitCode=exit_code, output=out))
-        feedback_blocks.append(
-          f"[Command executed]\n"
-          f"$ {cmd}\n\n"
-          f"Exit code: {exit_code}\n\n"
-          f"Output:\n{out}"
-        )
+    # <search> は読み取りだけなので承認不要。コマンドより先に流す
+    for search in searches:
+      _raise_if_cancelled(cancel)
+      label = _agent_search_label(search)
+      yield {"type": "command_start", "step": step, "command": label}
+      log, block = _agent_command_result(label, *_execute_agent_search(wid, sess, search))
+      yield {"type": "command_end", "step": step, **log.model_dump()}
+      logs.append(log)
+      feedback_blocks.append(block)
+    for batch in _agent_command_batches(wid, cmds):
+      _raise_if_cancelled(cancel)
+      for cmd in batch:
+        yield {"type": "command_start", "step": step, "command": cmd}
+      results: Dict[int, Tuple[AgentCommandLog, str]] = {}
+      if len(batch) == 1:
+        results[0] = _agent_command_result(batch[0], *_execute_agent_command(wid, sess, batch[0], timeout=120))
+        yield {"type": "command_end", "step": step, **results[0][0].model_dump()}
       else:
-        logs.append(AgentCommandLog(command=cmd, exitCode=None, output="", error=exec_error))
-        feedback_blocks.append(
-          f"[Command delivery failed]\n"
-          f"$ {cmd}\n\n"
-          f"Error: {exec_error}"
-        )
+        # 読み取り専用のコマンドは Watcher の並列レーンで同時に流し、終わったものから知らせる
+        executor = ThreadPoolExecutor(max_workers=min(len(batch), AGENT_PARALLEL_COMMANDS), thread_name_prefix="agent-cmd")
+        futures = {executor.submit(_execute_agent_command, wid, sess, cmd, 120): idx for idx, cmd in enumerate(batch)}
+        try:
+          for fut in as_completed(futures):
+            idx = futures[fut]
+            results[idx] = _agent_command_result(batch[idx], *fut.result())
+            yield {"type": "command_end", "step": step, **results[idx][0].model_dump()}
+        finally:
+          executor.shutdown(wait=False)
+      # モデルへ返す結果は提案された順に並べる
+      for idx in range(len(batch)):
+        log, block = results[idx]
+        logs.append(log)
+        feedback_blocks.append(block)
 
     feedback = (
       "\n\n".join(feedback_blocks)
@@ -3786,8 +5333,54 @@ def ai_buddy_state():
   }
 
 
+def _run_debate_reviewers(
+  models: List[str],
+  review_messages: List[dict],
+  max_tokens: int,
+  protect: Tuple[str, ...] = (),
+) -> Iterator[Tuple[str, str]]:
+  """Multi モードのレビュアーを並列に呼び、終わった順に (モデル名, コメント) を yield する。
+
+  同時実行数は AI_DEBATE_PARALLEL と、Ollama では VRAM 予算に同時に載るモデル数の小さい方
+  （protect のモデル＝モデレーターが載っている分は予算から除く）。
+  """
+  if not models:
+    return
+  limit = _ai_debate_parallel()
+  if get_llm_config().provider == "ollama":
+    limit = min(limit, _model_residency.concurrent_fit(models, protect))
+  limit = max(1, min(limit, len(models)))
+  if limit == 1:
+    for model_name in models:
+      comment, _tr = _call_llm_messages_with_meta(review_messages, max_tokens=max_tokens, temperature=0.2, model=model_name)
+      yield model_name, (comment or "").strip()
+    return
+  executor = ThreadPoolExecutor(max_workers=limit, thread_name_prefix="debate-review")
+  futures = {
+    executor.submit(_call_llm_messages_with_meta, review_messages, max_tokens, 0.2, model_name): model_name
+    for model_name in models
+  }
+  try:
+    for fut in as_completed(futures):
+      comment, _tr = fut.result()
+      yield futures[fut], (comment or "").strip()
+  finally:
+    # 途中で例外になった / クライアントが切断した場合、まだ始まっていないレビューは呼ばない
+    for fut in futures:
+      fut.cancel()
+    executor.shutdown(wait=False)
+
+
 @app.post("/watchers/{wid}/sessions/{sess}/ai-assist")
 def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
+  return _ai_assist(wid, sess, payload)
+
+
+def _ai_assist(
+  wid: str, sess: str, payload: AiAssistPayload, on_agent_event=None, cancel: Optional[CancelToken] = None,
+) -> AiAssistResponse:
+  """ai_assist の本体。on_agent_event を渡すと Agent ループの途中経過（_iter_agent_loop のイベント）を受け取れる。
+  cancel は Agent ループに渡す（ストリームの切断で止めるため）"""
   session_root(wid, sess)
   if not payload.prompt.strip():
     raise HTTPException(status_code=400, detail="prompt is required")
@@ -3843,9 +5436,9 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
       elif mode == "agent":
         selected_model = routing["inspector_model"]
       else:
-        selected_model = os.environ.get("OLLAMA_MODEL") or "qwen2.5-coder:7b"
+        selected_model = get_llm_config().ollama_model
     else:
-      selected_model = os.environ.get("OLLAMA_MODEL") or "qwen2.5-coder:7b"
+      selected_model = get_llm_config().ollama_model
     # マルチモデル・ディベートモード（multi）はここで分岐
     if mode == "multi":
       # 代表モデル 1 つを Agent として使い、その観点でコマンド実行を行ったうえで、
@@ -3889,12 +5482,14 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
         if len(models) >= 3:
           break
       if not models:
-        models = [os.environ.get("OLLAMA_MODEL") or "qwen2.5-coder:7b", "deepseek-coder:6.7b"]
+        models = [get_llm_config().ollama_model, "deepseek-coder:6.7b"]
+      # 代表モデルが Agent ループを回している間に、レビュアーのモデルを載せておく
+      _model_residency.prefetch(models[1:], protect=(models[0],))
 
       # Round 0 の前に、代表モデル (models[0]) を Agent ループとして動かし、
       # 必要に応じてコマンド実行を行ったうえで一次レポートを得る。
       history = payload.history or []
-      history = history[-max_history:]
+      history = _trim_history(history, max_history)
       # Agent 用 system プロンプト（通常の agent モードに近いが、Multi 用の軽量版）
       system_agent = (
         "You are the primary investigating agent in a multi‑model debate.\n"
@@ -3908,12 +5503,11 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
         "- Do NOT say things like 'I am an AI model and cannot run commands' or 'please run these commands yourself' — those are incorrect in this session.\n"
         "- Prefer sequences of concrete, safe commands (conda/pip installs, python -c checks, running demo scripts) wrapped in <command> blocks, and base your explanation on the actual outputs.\n"
         "- Each <command> is ONE line executed by bash — never raw Python (e.g. plt.legend); use python3 script.py or python3 -c.\n"
-        "\n"
+        + AGENT_SEARCH_PROMPT
+        + "\n"
         "If the user asks to change code and editor context shows a file: output ONE <edit path=\"session/relative\">...</edit> "
         "with the FULL file body — do not paste the whole file as plain chat text.\n"
       )
-      if context_block:
-        system_agent += "\n\n--- Editor context (primary reference for open file + selection) ---\n" + context_block
       if thinking == "deep":
         system_agent += (
           "\n\n[Deep mode]\n"
@@ -3926,7 +5520,6 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
         )
       if payload.persona and payload.persona.strip():
         system_agent = "User-defined persona / instructions:\n" + payload.persona.strip() + "\n\n" + system_agent
-
       agent_messages: List[dict] = [{"role": "system", "content": system_agent}]
       for m in history:
         role = (m.role or "user").strip().lower()
@@ -3938,6 +5531,10 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
       if payload.editorPath or payload.editorSelectedText or payload.editorContent:
         agent_user_content = "[User request]\n" + agent_user_content
       agent_user_content = _append_syncterm_edit_protocol_user_suffix(agent_user_content, ep_agent)
+      # system → 履歴 → エディタ文脈 + 新しい発話 の順（KV キャッシュの再利用のため）
+      agent_user_content = _with_editor_context(
+        agent_user_content, context_block, "Editor context (primary reference for open file + selection)"
+      )
       agent_messages.append({"role": "user", "content": agent_user_content})
 
       # 代表モデルは models[0]
@@ -3952,12 +5549,14 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
         max_iterations=agent_max_iter,
         max_tokens=chat_max_tokens,
         editor_rel_path=ep_agent,
+        on_event=on_agent_event,
+        cancel=cancel,
       )
       if agent_res.needsEditApproval and agent_res.proposedEdits:
         return agent_res.model_copy(update={"debates": []})
 
       history = payload.history or []
-      history = history[-max_history:]
+      history = _trim_history(history, max_history)
       base_messages = []
       if context_block:
         # マルチモデルでも共通の system + コンテキストは同じ
@@ -4048,33 +5647,31 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
         "- Do NOT rewrite the whole answer.\n"
         "- Do NOT invent facts (e.g., file lists, current directory) not present in the primary answer or logs.\n"
       )
+      review_messages = [
+        {"role": "system", "content": review_system},
+        {
+          "role": "user",
+          "content": (
+            "User question:\n"
+            f"{payload.prompt.strip()}\n\n"
+            + (
+              "Primary agent command logs (shared with you):\n"
+              f"{shared_agent_log_text}\n\n"
+              if shared_agent_log_text
+              else ""
+            )
+            + "Primary agent answer:\n"
+            + f"{primary_answer}\n\n"
+            + "Provide your review now."
+          ),
+        },
+      ]
+      # レビュアーは並列に呼ぶ。モデレーターへ渡す順序は毎回同じになるよう models の順に並べ直す
+      reviews = dict(_run_debate_reviewers(
+        models[1:], review_messages, max(256, min(1024, chat_max_tokens)), protect=(models[0],)
+      ))
       for model_name in models[1:]:
-        review_messages = [
-          {"role": "system", "content": review_system},
-          {
-            "role": "user",
-            "content": (
-              "User question:\n"
-              f"{payload.prompt.strip()}\n\n"
-              + (
-                "Primary agent command logs (shared with you):\n"
-                f"{shared_agent_log_text}\n\n"
-                if shared_agent_log_text
-                else ""
-              )
-              + "Primary agent answer:\n"
-              + f"{primary_answer}\n\n"
-              + "Provide your review now."
-            ),
-          },
-        ]
-        comment, _tr_review = _call_llm_messages_with_meta(
-          review_messages,
-          max_tokens=max(256, min(1024, chat_max_tokens)),
-          temperature=0.2,
-          model=model_name,
-        )
-        comment_text = (comment or "").strip()
+        comment_text = reviews.get(model_name, "")
         reviewer_comments.append((model_name, comment_text))
         debate_turns.append(
           DebateTurn(
@@ -4169,7 +5766,8 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
         "In each <command>...</command> block, put exactly ONE shell command only (no '&&', no ';'). "
         "The line is passed to bash — NEVER put raw Python inside (e.g. plt.legend(...) will fail). "
         "Use <command>python3 path/to/script.py</command> or <command>python3 -c \"...\"</command> for Python, or describe code edits without <command>.\n"
-        "Reply in the same language as the user.\n"
+        + AGENT_SEARCH_PROMPT
+        + "Reply in the same language as the user.\n"
         "\n"
         "File edits on the remote workspace (use instead of pasting code only in chat):\n"
         "<edit path=\"session-relative/path/to/file.py\">\n"
@@ -4216,8 +5814,7 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
         "Optional structure (use only when it helps readability for multi-step work):\n"
         "brief plan → commands you run → what you learned → what you suggest next.\n"
       )
-      if context_block:
-        system_prompt += "\n\n--- Editor context (primary; cite symbols from here) ---\n" + context_block
+      context_label = "Editor context (primary; cite symbols from here)"
       if thinking == "deep":
         system_prompt += (
           "\n\n[Deep thinking mode]\n"
@@ -4240,20 +5837,17 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
         "- Call out risks and alternatives when important\n"
         "Use headings and numbered lists, but keep the final answer concise."
       )
-      if context_block:
-        system_prompt += "\n\n--- Editor context (for planning around current code) ---\n" + context_block
+      context_label = "Editor context (for planning around current code)"
     elif mode == "debug":
       system_prompt = (
         "You are a debugging assistant. Think deeply about possible root causes before proposing fixes.\n"
         "Analyze errors, propose hypotheses, and then suggest concrete fixes. "
         "Explain root causes in plain text; include code snippets only when relevant."
       )
-      if context_block:
-        system_prompt += "\n\n--- Editor context (use this code when debugging) ---\n" + context_block
+      context_label = "Editor context (use this code when debugging)"
     else:
       system_prompt = "You are a helpful assistant. Reply concisely. Use plain text, no code fences unless the user asks for code."
-      if context_block:
-        system_prompt += "\n\n--- Editor context (for reference) ---\n" + context_block
+      context_label = "Editor context (for reference)"
     if mode != "agent":
       if thinking == "deep":
         system_prompt += (
@@ -4276,7 +5870,7 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
     if payload.persona and payload.persona.strip():
       system_prompt = "User-defined persona / instructions:\n" + payload.persona.strip() + "\n\n" + system_prompt
     history = payload.history or []
-    history = history[-max_history:]
+    history = _trim_history(history, max_history)
     messages = [{"role": "system", "content": system_prompt}]
     for m in history:
       role = (m.role or "user").strip().lower()
@@ -4289,6 +5883,8 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
       user_content = "[User request]\n" + user_content
       ep_agent = _norm_editor_rel_for_agent(payload.editorPath)
       user_content = _append_syncterm_edit_protocol_user_suffix(user_content, ep_agent)
+    # system（静的な指示）→ 履歴 → エディタ文脈 + 新しい発話 の順を崩さない（KV キャッシュの再利用のため）
+    user_content = _with_editor_context(user_content, context_block, context_label)
     messages.append({"role": "user", "content": user_content})
     if mode == "agent":
       agent_res = _run_agent_loop(
@@ -4299,6 +5895,8 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
         max_iterations=agent_iterations,
         max_tokens=chat_max_tokens,
         editor_rel_path=ep_agent,
+        on_event=on_agent_event,
+        cancel=cancel,
       )
       return agent_res
     else:
@@ -4324,7 +5922,7 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
           messages,
           max_tokens=chat_max_tokens,
           temperature=0.2,
-          model=payload.model,
+          model=selected_model,
         )
         if not extra:
           truncated = truncated2
@@ -4354,7 +5952,7 @@ def ai_assist(wid: str, sess: str, payload: AiAssistPayload):
       )
       selected_model = routing["executor_model"]
     else:
-      selected_model = os.environ.get("OLLAMA_MODEL") or "qwen2.5-coder:7b"
+      selected_model = get_llm_config().ollama_model
 
     if mode == "agent":
       system_prompt = (
@@ -4398,9 +5996,14 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
   """AI 応答を text/event-stream でストリーミング返却するエンドポイント。
 
   - chat / debate（Multi モード）の通常応答は LLM ネイティブのストリーミング API を使用
-  - Agent / コード生成系など複雑なモードは、従来どおり ai_assist の結果を疑似ストリーミングする
+  - Agent モードと Multi の代表エージェントは _iter_agent_loop のイベント（agent_step / agent_token /
+    agent_command / command_start / command_end / agent_edit）を途中経過として流し、最後に done を送る
+  - コード生成系は、従来どおり ai_assist の結果を疑似ストリーミングする
   """
   session_root(wid, sess)
+  # ストリームを始めてからではステータスを返せないので、ai_assist と同じ事前チェックはここで行う
+  if not payload.prompt.strip():
+    raise HTTPException(status_code=400, detail="prompt is required")
 
   action = (payload.action or "").strip().lower()
   mode = (payload.mode or "ask").strip().lower()
@@ -4443,9 +6046,9 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
         elif mode == "agent":
           selected_model = routing["inspector_model"]
         else:
-          selected_model = os.environ.get("OLLAMA_MODEL") or "qwen2.5-coder:7b"
+          selected_model = get_llm_config().ollama_model
       else:
-        selected_model = os.environ.get("OLLAMA_MODEL") or "qwen2.5-coder:7b"
+        selected_model = get_llm_config().ollama_model
 
       # system プロンプト（ai_assist と同等だが、Agent 以外のみ）
       if mode == "plan":
@@ -4455,20 +6058,17 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
           "- Call out risks and alternatives when important\n"
           "Use headings and numbered lists, but keep the final answer concise."
         )
-        if context_block:
-          system_prompt += "\n\n--- Editor context (for planning around current code) ---\n" + context_block
+        context_label = "Editor context (for planning around current code)"
       elif mode == "debug":
         system_prompt = (
           "You are a debugging assistant. Think deeply about possible root causes before proposing fixes.\n"
           "Analyze errors, propose hypotheses, and then suggest concrete fixes. "
           "Explain root causes in plain text; include code snippets only when relevant."
         )
-        if context_block:
-          system_prompt += "\n\n--- Editor context (use this code when debugging) ---\n" + context_block
+        context_label = "Editor context (use this code when debugging)"
       else:
         system_prompt = "You are a helpful assistant. Reply concisely. Use plain text, no code fences unless the user asks for code."
-        if context_block:
-          system_prompt += "\n\n--- Editor context (for reference) ---\n" + context_block
+        context_label = "Editor context (for reference)"
 
       if thinking == "deep":
         system_prompt += (
@@ -4490,16 +6090,16 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
       )
       if payload.persona and payload.persona.strip():
         system_prompt = "User-defined persona / instructions:\n" + payload.persona.strip() + "\n\n" + system_prompt
-
       history = payload.history or []
-      history = history[-max_history:]
+      history = _trim_history(history, max_history)
       messages: List[dict] = [{"role": "system", "content": system_prompt}]
       for m in history:
         role = (m.role or "user").strip().lower()
         if role not in ("user", "assistant"):
           role = "user"
         messages.append({"role": role, "content": (m.content or "").strip()})
-      user_content = payload.prompt.strip()
+      # ai_assist と同じく、静的な指示 → 履歴 → エディタ文脈 + 新しい発話 の順（KV キャッシュの再利用のため）
+      user_content = _with_editor_context(payload.prompt.strip(), context_block, context_label)
       messages.append({"role": "user", "content": user_content})
 
       return StreamingResponse(
@@ -4564,14 +6164,16 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
         if len(models) >= 3:
           break
       if not models:
-        models = [os.environ.get("OLLAMA_MODEL") or "qwen2.5-coder:7b", "deepseek-coder:6.7b"]
+        models = [get_llm_config().ollama_model, "deepseek-coder:6.7b"]
+      # 代表モデルが Agent ループを回している間に、レビュアーのモデルを載せておく
+      _model_residency.prefetch(models[1:], protect=(models[0],))
 
       # 代表モデル（唯一のエージェント） = models[0]
       representative_model = models[0]
 
       # 履歴の切り詰め
       history = payload.history or []
-      history = history[-max_history:]
+      history = _trim_history(history, max_history)
 
       # 代表エージェント用 system プロンプト
       system_agent = (
@@ -4591,14 +6193,13 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
         "- When reporting files, paths, or versions, base your answer ONLY on command output. If a command failed, say so and try an alternative safe command.\n"
         "- In each <command>...</command> block, put exactly ONE shell command only (no '&&', no ';'). "
         "The line runs in bash — never put raw Python (e.g. plt.legend); use python3 -c or python3 script.py.\n"
-        "\n"
+        + AGENT_SEARCH_PROMPT
+        + "\n"
         "File edits: If the user asks to change code and editor context includes a file, output exactly ONE "
         "<edit path=\"session/relative/path\">...</edit> with the FULL new file body. "
         "Do not paste a complete file replacement as plain chat text or markdown-only code — the IDE only "
         "applies <edit> blocks (user approves a diff). Path must match \"Current file (path)\" without a leading slash.\n"
       )
-      if context_block:
-        system_agent += "\n\n--- Editor context (primary reference for open file + selection) ---\n" + context_block
       if thinking == "deep":
         system_agent += (
           "\n\n[Deep mode]\n"
@@ -4612,7 +6213,6 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
         )
       if payload.persona and payload.persona.strip():
         system_agent = "User-defined persona / instructions:\n" + payload.persona.strip() + "\n\n" + system_agent
-
       agent_messages: List[dict] = [{"role": "system", "content": system_agent}]
       for m in history:
         role = (m.role or "user").strip().lower()
@@ -4624,11 +6224,15 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
       if payload.editorPath or payload.editorSelectedText or payload.editorContent:
         agent_user_content = "[User request]\n" + agent_user_content
       agent_user_content = _append_syncterm_edit_protocol_user_suffix(agent_user_content, ep_agent)
+      # system → 履歴 → エディタ文脈 + 新しい発話 の順（KV キャッシュの再利用のため）
+      agent_user_content = _with_editor_context(
+        agent_user_content, context_block, "Editor context (primary reference for open file + selection)"
+      )
       agent_messages.append({"role": "user", "content": agent_user_content})
 
-      # 代表エージェントの Agent ループ（ここは同期実行だが、完了次第すぐに debate_turn を流す）
+      # 代表エージェントの Agent ループ。モデル出力・コマンド実行の途中経過をそのまま流し、完了後に debate_turn を送る
       agent_max_iter = min(agent_iterations, 6)
-      agent_res = _run_agent_loop(
+      agent_events = _iter_agent_loop(
         wid,
         sess,
         agent_messages,
@@ -4636,7 +6240,15 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
         max_iterations=agent_max_iter,
         max_tokens=chat_max_tokens,
         editor_rel_path=ep_agent,
+        stream=True,
       )
+      while True:
+        try:
+          ev_agent = next(agent_events)
+        except StopIteration as stop:
+          agent_res = stop.value
+          break
+        yield f"data: {json.dumps(ev_agent, ensure_ascii=False)}\n\n"
 
       if agent_res.needsEditApproval and agent_res.proposedEdits:
         agent_text_early = _strip_edit_tags(_strip_command_tags((agent_res.result or "").strip()))
@@ -4749,33 +6361,29 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
         "- Do NOT invent facts not present in the primary answer or logs.\n"
       )
       reviewer_comments: List[tuple[str, str]] = []
-      for model_name in models[1:]:
-        review_messages = [
-          {"role": "system", "content": review_system},
-          {
-            "role": "user",
-            "content": (
-              "User question:\n"
-              f"{payload.prompt.strip()}\n\n"
-              + (
-                "Primary agent command logs (shared with you):\n"
-                f"{shared_agent_log_text}\n\n"
-                if shared_agent_log_text
-                else ""
-              )
-              + "Primary agent answer:\n"
-              + f"{agent_text}\n\n"
-              + "Provide your review now."
-            ),
-          },
-        ]
-        comment, _tr = _call_llm_messages_with_meta(
-          review_messages,
-          max_tokens=max(256, min(1024, chat_max_tokens)),
-          temperature=0.2,
-          model=model_name,
-        )
-        text = (comment or "").strip()
+      review_messages = [
+        {"role": "system", "content": review_system},
+        {
+          "role": "user",
+          "content": (
+            "User question:\n"
+            f"{payload.prompt.strip()}\n\n"
+            + (
+              "Primary agent command logs (shared with you):\n"
+              f"{shared_agent_log_text}\n\n"
+              if shared_agent_log_text
+              else ""
+            )
+            + "Primary agent answer:\n"
+            + f"{agent_text}\n\n"
+            + "Provide your review now."
+          ),
+        },
+      ]
+      # レビュアーは並列に呼び、終わったものから順にフロントへ送る
+      for model_name, text in _run_debate_reviewers(
+        models[1:], review_messages, max(256, min(1024, chat_max_tokens)), protect=(models[0],)
+      ):
         reviewer_comments.append((model_name, text))
         turn = DebateTurn(
           round=1,
@@ -4797,6 +6405,8 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
           },
         }
         yield f"data: {json.dumps(ev_turn, ensure_ascii=False)}\n\n"
+      # モデレーターへ渡す順序は終わった順ではなく models の順にそろえる
+      reviewer_comments.sort(key=lambda c: models.index(c[0]))
 
       # Round 2: モデレーターが一次回答＋レビューコメントから最終回答を作る（メタ無し）
       moderator_model = representative_model
@@ -4895,7 +6505,62 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
 
     return StreamingResponse(_iter_events_multi(), media_type="text/event-stream", headers=dict(_AI_SSE_HEADERS))
 
-  # Agent やコード生成系など、その他複雑なモードは既存の ai_assist を利用した疑似ストリーミングを継続
+  # Agent モードはループを別スレッドで回し、ステップごとのイベント（モデル出力・コマンドの開始/結果・edit 提案）を流す
+  if action == "chat" and mode == "agent":
+    agent_queue: "queue.Queue[dict]" = queue.Queue()
+    # クライアントが切断したら立てる。ループは次のステップ・コマンドに進まずに終わる
+    agent_cancel = CancelToken()
+
+    def _agent_worker():
+      try:
+        res = _ai_assist(wid, sess, payload, on_agent_event=agent_queue.put, cancel=agent_cancel)
+        agent_queue.put({"type": "_result", "response": res})
+      except CancelledError:
+        logger.info("agent stream cancelled wid=%s sess=%s", wid, sess)
+      except HTTPException as e:
+        agent_queue.put({"type": "error", "detail": str(e.detail)})
+      except Exception as e:
+        logger.exception("agent stream failed")
+        agent_queue.put({"type": "error", "detail": str(e)})
+
+    threading.Thread(target=_agent_worker, name="ai-agent-stream", daemon=True).start()
+
+    def _iter_events_agent():
+      ping = _ai_sse_keepalive_interval()
+      try:
+        while True:
+          try:
+            ev = agent_queue.get(timeout=ping if ping > 0 else None)
+          except queue.Empty:
+            yield ": syncterm-hb\n\n"
+            continue
+          if ev["type"] != "_result":
+            yield f"data: {json.dumps(ev, ensure_ascii=False)}\n\n"
+            if ev["type"] == "error":
+              return
+            continue
+          res = ev["response"]
+          done_ev = {
+            "type": "done",
+            "result": res.result,
+            "command": res.command,
+            "needsApproval": res.needsApproval,
+            "needsEditApproval": res.needsEditApproval,
+            "proposedEdits": [e.model_dump() for e in res.proposedEdits],
+            "truncated": res.truncated,
+            "autoContinued": res.autoContinued,
+            "logs": [l.model_dump() for l in res.logs],
+            "debates": [d.model_dump() for d in res.debates],
+          }
+          yield f"data: {json.dumps(done_ev, ensure_ascii=False)}\n\n"
+          return
+      finally:
+        # 切断（GeneratorExit）でも正常終了でも、裏のループを止める
+        agent_cancel.cancel()
+
+    return StreamingResponse(_iter_events_agent(), media_type="text/event-stream", headers=dict(_AI_SSE_HEADERS))
+
+  # コード生成系など、その他のモードは既存の ai_assist を利用した疑似ストリーミングを継続
   resp = ai_assist(wid, sess, payload)
 
   def _iter_events_fallback():
@@ -4925,22 +6590,339 @@ def ai_stream(wid: str, sess: str, payload: AiAssistPayload):
   return StreamingResponse(_iter_events_fallback(), media_type="text/event-stream", headers=dict(_AI_SSE_HEADERS))
 
 
-@app.post("/watchers/{wid}/sessions/{sess}/ai-inline")
-def ai_inline(wid: str, sess: str, payload: AiInlinePayload):
-  session_root(wid, sess)
-  prefix = payload.prefix[-3000:]
-  suffix = payload.suffix[:800]
-  if not prefix.strip():
-    return {"completion": ""}
+class _InlineJob:
+  """1 回分のインライン補完の生成。cancel.cancel() で上流の接続を閉じて生成を止める"""
 
-  prefix_last_line = prefix.split("\n")[-1] if prefix else ""
-  base_indent = ""
-  for c in prefix_last_line:
-    if c in " \t":
-      base_indent += c
+  def __init__(self, signature: str):
+    self.signature = signature
+    self.cancel = CancelToken()
+    self.done = threading.Event()
+    self.result: Optional[str] = None
+    self.error: Optional[BaseException] = None
+
+
+class _InlineCoordinator:
+  """インライン補完の要求をエディタ（requestKey）単位でまとめる。
+
+  - 同じキーで新しい要求が来たら、実行中の古い生成はキャンセルする（LLM 側に古い要求を溜めない）。
+    ただし別のキーがまだその生成を共有している場合は、参照が無くなるまで残す
+  - prefix / suffix / モデルが同じ要求は、実行中の生成の結果を待って共有する
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._by_key: Dict[tuple, _InlineJob] = {}
+    self._by_signature: Dict[str, _InlineJob] = {}
+
+  def _referenced(self, job: "_InlineJob") -> bool:
+    """job を待っているキーがまだ残っているか（_lock を保持して呼ぶ）"""
+    return any(j is job for j in self._by_key.values())
+
+  def cancel(self, key: tuple) -> None:
+    """key の実行中の生成をキャンセルする（キャッシュで応答できたときなど）
+
+    同じ生成を共有している別のキーが残っている場合はキャンセルしない。
+    """
+    with self._lock:
+      job = self._by_key.pop(key, None)
+      if job is None or self._referenced(job):
+        return
+    job.cancel.cancel()
+
+  def run(self, key: tuple, signature: str, generate) -> Optional[str]:
+    """generate(job) を実行して結果を返す。キャンセルされた場合は None"""
+    with self._lock:
+      shared = self._by_signature.get(signature)
+      if shared is not None and not shared.done.is_set() and not shared.cancel.cancelled:
+        job = shared
+        owner = False
+      else:
+        job = _InlineJob(signature)
+        self._by_signature[signature] = job
+        owner = True
+      previous = self._by_key.get(key)
+      self._by_key[key] = job
+      # 共有中の生成は、どのキーからも参照されなくなったときだけキャンセルする
+      if previous is not None and previous is not job and not self._referenced(previous):
+        previous.cancel.cancel()
+
+    if owner:
+      try:
+        job.result = generate(job)
+      except BaseException as e:
+        job.error = e
+      finally:
+        job.done.set()
+        with self._lock:
+          if self._by_signature.get(signature) is job:
+            del self._by_signature[signature]
+          for k in [k for k, j in self._by_key.items() if j is job]:
+            del self._by_key[k]
     else:
-      break
+      job.done.wait()
+
+    if job.cancel.cancelled:
+      return None
+    if job.error is not None:
+      raise job.error
+    return job.result
+
+
+_inline_coordinator = _InlineCoordinator()
+
+INLINE_CACHE_MAX_KEYS = 256
+# 1 キーあたり保持する (prefix, completion) の数
+INLINE_CACHE_PREFIXES_PER_KEY = 4
+
+
+class _InlineCompletionCache:
+  """インライン補完の LRU キャッシュ。キーは (wid, sess, path, model, suffix のハッシュ)。
+
+  返した補完どおりにユーザーが打ち進めた場合（新しい prefix = 古い prefix + 補完の先頭）は、
+  打ち終えた分を除いた残りをそのまま返す。prefix は末尾の一定長で切られて届くので、
+  長さではなく「新しい prefix の末尾が補完の先頭 k 文字で、その手前が古い prefix の末尾と一致する」かで判定する。
+  """
+
+  def __init__(self, max_keys: int = INLINE_CACHE_MAX_KEYS):
+    self._lock = threading.Lock()
+    self._entries: "OrderedDict[tuple, List[Tuple[str, str]]]" = OrderedDict()
+    self._max_keys = max_keys
+
+  @staticmethod
+  def _remaining(cached_prefix: str, completion: str, prefix: str) -> Optional[str]:
+    for k in range(min(len(completion), len(prefix)), -1, -1):
+      typed = completion[:k]
+      if not prefix.endswith(typed):
+        continue
+      before = prefix[: len(prefix) - k]
+      if before and cached_prefix.endswith(before):
+        rest = completion[k:]
+        return rest if rest.strip() else None
+    return None
+
+  def get(self, key: tuple, prefix: str) -> Optional[str]:
+    with self._lock:
+      entries = self._entries.get(key)
+      if not entries:
+        return None
+      self._entries.move_to_end(key)
+      entries = list(entries)
+    for cached_prefix, completion in reversed(entries):
+      rest = self._remaining(cached_prefix, completion, prefix)
+      if rest is not None:
+        return rest
+    return None
+
+  def put(self, key: tuple, prefix: str, completion: str) -> None:
+    if not completion.strip():
+      return
+    with self._lock:
+      entries = self._entries.setdefault(key, [])
+      self._entries.move_to_end(key)
+      entries.append((prefix, completion))
+      del entries[:-INLINE_CACHE_PREFIXES_PER_KEY]
+      while len(self._entries) > self._max_keys:
+        self._entries.popitem(last=False)
+
+
+_inline_cache = _InlineCompletionCache()
+
+
+INLINE_MAX_LINES = 25
+INLINE_MAX_CHARS = 1500
+# 同じ行の繰り返しとして数えない行（閉じ括弧だけの行や else: / end / return などのブロックの区切り）
+_INLINE_STRUCTURAL_LINE = re.compile(
+  r"^(?:[^\w\s]*|[)\]}]*\s*(?:else|elif|end|fi|done|esac|then|do|try|finally|pass|break|continue|return)\b\s*[:;{]?)$"
+)
+
+
+class _InlineStreamBuilder:
+  """インライン補完のストリームを行単位で整形し、生成を打ち切ってよいかを判定する。
+
+  先頭のコードフェンス除去・インデント補正・行数／文字数の上限を届いた行から順に適用し、
+  閉じフェンス・上限到達・ブロックの終わり（カーソル行より浅いインデントに戻った）・空行の連続・同じ行の繰り返しで止める
+  （`}` や `else:` のような区切りだけの行は繰り返しに数えない）。
+  """
+
+  def __init__(self, base_indent: str, raw: bool = False):
+    self.base_indent = base_indent
+    # raw: FIM の出力。カーソル位置からの続きそのものなので、1 行目（空行も含む）は手を加えない
+    self.raw = raw
+    self.lines: List[str] = []
+    self.stopped = False
+    self._buf = ""
+    self._chars = 0
+    self._fence_checked = False
+    # 2 行目以降をカーソル行以上のインデントで出してきたか（出していないモデルの行は補正するだけで止めない）
+    self._indented = False
+    self._blank_run = 0
+    self._seen: Dict[str, int] = {}
+
+  def feed(self, delta: str) -> bool:
+    """delta を追加する。以降のトークンが不要になったら True"""
+    if self.stopped:
+      return True
+    self._buf += delta.replace("\r\n", "\n")
+    while "\n" in self._buf and not self.stopped:
+      line, self._buf = self._buf.split("\n", 1)
+      self._add_line(line)
+    if self._chars + len(self._buf) > INLINE_MAX_CHARS:
+      self.stopped = True
+    return self.stopped
+
+  def _append(self, line: str) -> None:
+    self.lines.append(line)
+    self._chars += len(line) + 1
+    if len(self.lines) >= INLINE_MAX_LINES or self._chars > INLINE_MAX_CHARS:
+      self.stopped = True
+
+  def _add_line(self, line: str) -> None:
+    stripped = line.strip()
+    if not self.lines and self.raw:
+      self._append(line)
+      return
+    if not self.lines:
+      # 先頭の空行は捨て、1 行目は現在行の続きなので先頭の空白を除く
+      if not stripped:
+        return
+      if not self._fence_checked and stripped.startswith("```"):
+        self._fence_checked = True
+        first = stripped.lstrip("`").strip()
+        for tag in ("python", "py"):
+          if first.startswith(tag):
+            first = first[len(tag):].strip()
+            break
+        else:
+          first = ""
+        if first:
+          self._append(first)
+        return
+      self._fence_checked = True
+      self._append(line.lstrip())
+      return
+    if stripped.startswith("```"):
+      self.stopped = True
+      return
+    if not stripped:
+      self._blank_run += 1
+      if self._blank_run >= 2:
+        self.stopped = True
+        return
+      self._append("")
+      return
+    self._blank_run = 0
+    leading = len(line) - len(line.lstrip(" \t"))
+    if leading < len(self.base_indent):
+      if self._indented:
+        # カーソルのあるブロックを抜けた
+        self.stopped = True
+        return
+      line = self.base_indent + line.lstrip(" \t")
+    elif self.base_indent:
+      self._indented = True
+    if not _INLINE_STRUCTURAL_LINE.match(stripped):
+      count = self._seen.get(stripped, 0)
+      if count >= 2:
+        self.stopped = True
+        return
+      self._seen[stripped] = count + 1
+    self._append(line)
+
+  def finish(self, prefix_last_line: str) -> str:
+    """ここまでの出力を補完テキストにする"""
+    if not self.stopped and self._buf:
+      self._add_line(self._buf)
+    self._buf = ""
+    lines = list(self.lines)
+    while lines and not lines[-1].strip():
+      lines.pop()
+    if not lines:
+      return ""
+    last_stripped = prefix_last_line.rstrip()
+    if not self.raw and last_stripped and last_stripped[-1] in ")]}\";'":
+      first = lines[0]
+      if first and (first[0].isalpha() or first[0] in "."):
+        # 閉じ括弧などの直後に識別子が続くなら次の行として出す
+        lines[0] = self.base_indent + first
+        lines.insert(0, "")
+    completion = "\n".join(lines[:INLINE_MAX_LINES])
+    if len(completion) > INLINE_MAX_CHARS:
+      head = completion[:INLINE_MAX_CHARS]
+      completion = head.rsplit("\n", 1)[0] if "\n" in head else head
+    return completion
+
+
+# FIM（fill-in-the-middle）テンプレート。モデル名（名前空間と ":" 以降を除いたもの）の先頭一致で選ぶ。
+# プロンプトは prefix + 本文 + suffix + 本文 + middle の順（PSM）に組み、/api/generate に raw で渡す
+_FIM_TEMPLATES: List[Tuple[str, Dict[str, Any]]] = [
+  ("qwen2.5-coder", {
+    "prefix": "<|fim_prefix|>", "suffix": "<|fim_suffix|>", "middle": "<|fim_middle|>",
+    "stop": ["<|endoftext|>", "<|fim_pad|>", "<|file_sep|>", "<|repo_name|>", "<|im_start|>", "<|im_end|>"],
+  }),
+  ("deepseek-coder", {
+    "prefix": "<｜fim▁begin｜>", "suffix": "<｜fim▁hole｜>", "middle": "<｜fim▁end｜>",
+    "stop": ["<｜end▁of▁sentence｜>", "<|EOT|>"],
+  }),
+  ("codellama", {
+    "prefix": "<PRE> ", "suffix": " <SUF>", "middle": " <MID>",
+    "stop": ["<EOT>"],
+  }),
+  ("starcoder", {
+    "prefix": "<fim_prefix>", "suffix": "<fim_suffix>", "middle": "<fim_middle>",
+    "stop": ["<|endoftext|>", "<file_sep>"],
+  }),
+  ("codegemma", {
+    "prefix": "<|fim_prefix|>", "suffix": "<|fim_suffix|>", "middle": "<|fim_middle|>",
+    "stop": ["<|file_separator|>", "<|fim_prefix|>", "<|fim_suffix|>", "<|fim_middle|>"],
+  }),
+]
+
+
+def _fim_template_for(model: str) -> Optional[Dict[str, Any]]:
+  """FIM に対応したモデルならテンプレートを返す（Ollama 以外・無効化時は None）"""
+  config = get_llm_config()
+  if config.provider != "ollama" or not config.inline_fim:
+    return None
+  family = model.strip().lower().rsplit("/", 1)[-1].split(":", 1)[0]
+  for name, template in _FIM_TEMPLATES:
+    if family.startswith(name):
+      return template
+  return None
+
+
+def _stream_ollama_fim(prompt: str, stop: List[str], model: str, cancel: Optional[CancelToken] = None):
+  """FIM プロンプトで /api/generate をストリームし、{"type": "token", "delta"} を yield する"""
+  provider = _llm_provider("ollama")
+  resident = _acquire_resident(provider, model)
+  try:
+    yield from provider.stream_generate(
+      prompt, max_tokens=256, temperature=0.1, model=model, stop=stop, raw=True, cancel=cancel,
+    )
+  except CancelledError:
+    raise
+  except Exception as e:
+    raise _llm_http_exception("Ollama", e)
+  finally:
+    _model_residency.release(resident)
+
+
+def _inline_generate(open_stream, job: _InlineJob, builder: _InlineStreamBuilder, prefix_last_line: str) -> Optional[str]:
+  """open_stream(cancel) のトークンを builder で整形し、補完を返す。
+  打ち切り条件を満たした時点とキャンセル時はストリームを閉じて LLM 側の生成も止める（キャンセル時は None）"""
+  events = open_stream(job.cancel)
+  try:
+    for ev in events:
+      if ev.get("type") == "token" and builder.feed(str(ev.get("delta") or "")):
+        break
+  except CancelledError:
+    return None
+  finally:
+    events.close()
+  return builder.finish(prefix_last_line)
 
+
+def _inline_chat_messages(payload: AiInlinePayload, prefix: str, suffix: str) -> List[dict]:
+  """FIM 非対応モデル向けのチャット形式のインライン補完プロンプト"""
   system_prompt = (
     "You are an inline code completion engine. Output only the completion text. No markdown, no code fences, no explanations. "
     "The cursor is at the end of the last line of 'Text before cursor'. "
@@ -4958,68 +6940,95 @@ def ai_inline(wid: str, sess: str, payload: AiInlinePayload):
     "Text after cursor:\n"
     f"{suffix}\n"
   )
-  out = call_openai_chat_limited(system_prompt, user_prompt, max_tokens=256, model=payload.model)
-  out = out.replace("\r\n", "\n").strip()
-  lines = out.split("\n")
-  if lines and lines[0].strip().startswith("```"):
-    first = lines[0].strip().lstrip("`").strip()
-    if first.startswith("python"):
-      first = first[6:].strip()
-      if first:
-        lines[0] = first
-      else:
-        lines = lines[1:]
-    elif first.startswith("py"):
-      first = first[2:].strip()
-      if first:
-        lines[0] = first
-      else:
-        lines = lines[1:]
+  return [
+    {"role": "system", "content": system_prompt},
+    {"role": "user", "content": user_prompt},
+  ]
+
+
+@app.post("/watchers/{wid}/sessions/{sess}/ai-inline")
+def ai_inline(wid: str, sess: str, payload: AiInlinePayload):
+  session_root(wid, sess)
+  prefix = payload.prefix[-3000:]
+  suffix = payload.suffix[:800]
+  if not prefix.strip():
+    return {"completion": ""}
+
+  key = (wid, sess, payload.requestKey or payload.path)
+  # 直前の補完どおりに打ち進めているなら、残りをキャッシュから返す（LLM は呼ばない）
+  cache_key = (wid, sess, payload.path, payload.model or "", hashlib.sha1(suffix.encode("utf-8")).hexdigest())
+  cached = _inline_cache.get(cache_key, prefix)
+  if cached is not None:
+    _inline_coordinator.cancel(key)
+    return {"completion": cached, "cached": True}
+
+  prefix_last_line = prefix.split("\n")[-1] if prefix else ""
+  base_indent = ""
+  for c in prefix_last_line:
+    if c in " \t":
+      base_indent += c
     else:
-      lines = lines[1:]
-    if lines and lines[-1].strip() == "```":
-      lines = lines[:-1]
-  completion = "\n".join(lines).strip()
-  if completion:
-    last_stripped = prefix_last_line.rstrip()
-    if last_stripped and last_stripped[-1] in ")]}\";'":
-      if not (completion.startswith("\n") or completion.startswith(" ")):
-        first = completion.lstrip()
-        if first and (first[0].isalpha() or first[0] in "."):
-          completion = "\n" + completion
-  if base_indent and completion:
-    out_lines = completion.split("\n")
-    normalized = [out_lines[0]]
-    for line in out_lines[1:]:
-      leading = ""
-      for c in line:
-        if c in " \t":
-          leading += c
-        else:
-          break
-      if len(leading) < len(base_indent):
-        normalized.append(base_indent + line.lstrip(" \t"))
-      else:
-        normalized.append(line)
-    completion = "\n".join(normalized)
-  max_lines = 25
-  if completion.count("\n") >= max_lines:
-    completion = "\n".join(completion.split("\n")[:max_lines])
-  if len(completion) > 1500:
-    completion = completion[:1500].rsplit("\n", 1)[0] if "\n" in completion[:1500] else completion[:1500]
+      break
+
+  model = payload.model or get_llm_config().ollama_model
+  fim = _fim_template_for(model)
+  if fim is not None:
+    # コード向けモデルは FIM トークンで直接補完させる（指示文が要らずプロンプトが短い）
+    prompt = fim["prefix"] + prefix + fim["suffix"] + suffix + fim["middle"]
+
+    def open_stream(cancel):
+      return _stream_ollama_fim(prompt, fim["stop"], model, cancel)
+  else:
+    messages = _inline_chat_messages(payload, prefix, suffix)
+
+    def open_stream(cancel):
+      return _stream_llm_messages(messages, max_tokens=256, temperature=0.1, model=payload.model, cancel=cancel)
+
+  # 同じエディタの古い要求はキャンセルし、同じ内容の要求は 1 回の生成にまとめる
+  signature = hashlib.sha1(
+    "\0".join([payload.model or "", payload.language or "", payload.path, prefix, suffix]).encode("utf-8")
+  ).hexdigest()
+  completion = _inline_coordinator.run(
+    key,
+    signature,
+    lambda job: _inline_generate(open_stream, job, _InlineStreamBuilder(base_indent, raw=fim is not None), prefix_last_line),
+  )
+  if completion is None:
+    return {"completion": "", "cancelled": True}
+  _inline_cache.put(cache_key, prefix, completion)
   return {"completion": completion}
 
 
-@app.get("/watchers/{wid}/sessions/{sess}/runner-config", response_model=Optional[RunnerConfigModel])
-def get_runner_config(wid: str, sess: str):
-  root = session_root(wid, sess)
+# runner 設定のキャッシュ: (wid, sess) -> (mtime_ns, 設定 dict or None)。ファイルが変わったときだけ読み直す
+_runner_config_cache: Dict[Tuple[str, str], Tuple[int, Optional[dict]]] = {}
+_runner_config_lock = threading.Lock()
+
+
+def _load_runner_config(wid: str, sess: str, root: Path) -> Optional[dict]:
   conf_path = root / ".runner_config.json"
-  if not conf_path.exists():
+  try:
+    mtime_ns = conf_path.stat().st_mtime_ns
+  except OSError:
     return None
+  with _runner_config_lock:
+    cached = _runner_config_cache.get((wid, sess))
+  if cached is not None and cached[0] == mtime_ns:
+    return cached[1]
   try:
     data = json.loads(conf_path.read_text("utf-8"))
   except Exception:
     raise HTTPException(status_code=500, detail="runner config invalid")
+  with _runner_config_lock:
+    _runner_config_cache[(wid, sess)] = (mtime_ns, data)
+  return data
+
+
+@app.get("/watchers/{wid}/sessions/{sess}/runner-config", response_model=Optional[RunnerConfigModel])
+def get_runner_config(wid: str, sess: str):
+  root = session_root(wid, sess)
+  data = _load_runner_config(wid, sess, root)
+  if data is None:
+    return None
   return RunnerConfigModel(
     mode=data.get("mode", "host"),
     containerName=data.get("container_name"),
@@ -5041,7 +7050,18 @@ def update_runner_config(wid: str, sess: str, payload: RunnerConfigUpdatePayload
     "extra_args": payload.extraArgs,
   }
   conf_path.write_text(json.dumps(data, indent=2), encoding="utf-8")
-  return {"ok": True}
+  with _runner_config_lock:
+    _runner_config_cache[(wid, sess)] = (conf_path.stat().st_mtime_ns, data)
+  # RT Watcher には直接渡して次のコマンドから反映させる（届かなければ従来どおり rsync pull で反映）
+  pushed = False
+  if _has_rt_transport(wid):
+    cmd = "_internal_set_runner_config::" + json.dumps(data, ensure_ascii=False)
+    resp, reason = _post_command_via_rt_with_response(wid, sess, cmd, timeout=10)
+    # 内部コマンドは exitCode が常に 0 なので、Watcher が返す ok / error で判断する
+    pushed = resp is not None and resp.get("ok") is True and not resp.get("error")
+    if not pushed:
+      logger.warning("runner config push failed wid=%s sess=%s reason=%s", wid, sess, reason or (resp or {}).get("error"))
+  return {"ok": True, "pushed": pushed}
 
 
 if __name__ == "__main__":
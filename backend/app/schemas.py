@@ -11,6 +11,17 @@ class WatcherModel(BaseModel):
   lastHeartbeat: float
 
 
+class WatcherHeartbeatPayload(BaseModel):
+  displayName: Optional[str] = None
+  # 送信間隔（秒）。指定があれば 1 回分の取りこぼしで一覧から外す
+  intervalSec: Optional[float] = None
+
+
+class WatcherListChangesModel(BaseModel):
+  version: int
+  watchers: List[WatcherModel]
+
+
 class SessionModel(BaseModel):
   name: str
   watcherId: str
@@ -29,6 +40,13 @@ class WatcherStatusModel(BaseModel):
   dockerMode: Optional[str] = None
 
 
+class WatcherStatusPushPayload(BaseModel):
+  # .watcher_status.json と同じキー（user / host / cwd / full_cwd / conda_env）
+  status: Dict[str, Any]
+  # False なら前回から変わったキーだけ
+  full: bool = True
+
+
 class FileEntryModel(BaseModel):
   id: str
   name: str
@@ -75,6 +93,12 @@ class FileChunkModel(BaseModel):
   nextOffset: int
 
 
+class CommandOutputChunkModel(FileChunkModel):
+  # Watcher が書き出し中の間は総サイズが分からないので None（inProgress=True）
+  totalSize: Optional[int] = None
+  inProgress: bool = False
+
+
 class RunnerConfigUpdatePayload(BaseModel):
   mode: str
   containerName: Optional[str] = None
@@ -112,6 +136,20 @@ class UploadFilePayload(BaseModel):
   contentBase64: str
 
 
+class SearchPayload(BaseModel):
+  query: str
+  regex: bool = False
+  caseSensitive: bool = False
+  wholeWord: bool = False
+  hidden: bool = False
+  path: str = "."
+  include: List[str] = Field(default_factory=list)
+  exclude: List[str] = Field(default_factory=list)
+  maxResults: Optional[int] = None
+  maxPerFile: Optional[int] = None
+  useIndex: Optional[bool] = None
+
+
 class ExtensionManifestModel(BaseModel):
   id: str
   name: str
@@ -195,6 +233,9 @@ class AiInlinePayload(BaseModel):
   suffix: str
   language: Optional[str] = None
   model: Optional[str] = None
+  # エディタ単位のキー（省略時は path）。クライアント／エディタごとに一意にする。
+  # 同じキーの新しい要求は古い生成をキャンセルする
+  requestKey: Optional[str] = None
 
 
 class AiEnsureModelPayload(BaseModel):
@@ -206,6 +247,8 @@ class AgentCommandLog(BaseModel):
   exitCode: Optional[int] = None
   output: str = ""
   error: Optional[str] = None
+  # 出力が中略されたとき、全文を /command-output/{outputId} から取るための ID
+  outputId: Optional[str] = None
 
 
 class DebateTurn(BaseModel):
@@ -8,10 +8,15 @@ HTTP でコマンドを受信し即時実行。ログは relay の log-append 
 from __future__ import annotations
 
 import base64
+import fnmatch
 import getpass
+import gzip
+import hashlib
+import heapq
 import json
 import os
 import re
+import selectors
 import shlex
 import shutil
 import socket
@@ -19,11 +24,15 @@ import subprocess
 import threading
 import time
 import urllib.error
+import urllib.parse
 import urllib.request
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 # ===== Path Settings =====
 SCRIPT_DIR = Path(__file__).resolve().parent
@@ -44,6 +53,13 @@ else:
     REGISTRY_DIR = BASE_DIR.parent.parent.parent / REGISTRY_DIR_NAME
 
 EOC_MARKER_PREFIX = "__CMD_EXIT_CODE__::"
+# commands.txt 経由の完了記録（relay が直前の行で ID を指定し、実行後に .command_done.<id> を書く）
+COMMAND_ID_LINE_PREFIX = "#@cmd-id "
+COMMAND_DONE_PREFIX = ".command_done."
+COMMAND_DONE_MAX_AGE = 600
+# .commands.offset はバイト位置で保存する（接頭辞なしの数値は旧形式の行数）
+OFFSET_BYTES_PREFIX = "bytes:"
+_SAFE_CMD_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
 MAX_OUTPUT_CHARS = 200_000
 KEEP_ANSI = os.environ.get("KEEP_ANSI", "0") == "1"
 DOCKER_CONTAINER_NAME = os.environ.get("DOCKER_CONTAINER_NAME")
@@ -67,6 +83,600 @@ def _validate_safe_relpath(rel: str) -> None:
         raise ValueError(f"unsafe relpath: {rel!r}")
 
 
+# 読み取り専用の内部コマンド（cwd やファイルを変えないので上限付きの並列レーンで流す）
+READONLY_INTERNAL_PREFIXES = ("_internal_list_dir::", "_internal_read_output::")
+READONLY_PARALLEL = int(os.environ.get("WATCHER_READONLY_PARALLEL", "4"))
+# セッションの cwd / conda 環境 / 実行方式 / コマンドファイルを変える内部コマンド（state ロックで 1 つずつ適用）
+STATE_INTERNAL_PREFIXES = (
+    "_internal_reset_cwd", "_internal_set_runner_config::", "_internal_cleanup_staged", "_internal_clear_commands",
+)
+# 対象パスを持つファイル操作の内部コマンド（同じパスへの操作だけを排他にする）
+PATH_INTERNAL_PREFIXES = (
+    "_internal_move_staged_file::", "_internal_create_file::", "_internal_create_dir::", "_internal_delete_path::",
+    "_internal_rename_path::", "_internal_copy_path::", "_internal_create_link::", "_internal_stage_file_for_download::",
+)
+# rsync で届く .runner_config.json の変更を確認する間隔（relay からの push は即時反映）
+RUNNER_CONFIG_CHECK_SEC = 2.0
+
+
+class CommandRequest:
+    """1 回のコマンド実行に固有の状態。
+    SessionContext は同じセッションの全リクエストで共有されるため、silent / streamed / 添付内容はここに持つ"""
+    def __init__(self, command: str, staged_content: Optional[str] = None, relay_read_only: bool = False):
+        cmd = command.strip()
+        # Agent からの「ターミナル非表示」専用コマンドプレフィックス
+        self.silent = cmd.startswith("_agent_silent::")
+        if self.silent:
+            cmd = cmd.split("::", 1)[1].strip()
+        self.command = cmd
+        # relay が読み取り専用（cat / ls / git log など）と判定したコマンド（/command の readOnly）。判定は relay 側だけで持つ。
+        # 実行後に検索索引を dirty にしない。Agent のものはさらに読み取り専用レーンに流す
+        self.relay_read_only = relay_read_only
+        # RT の _internal_move_staged_file で直接渡された保存内容
+        self.staged_content = staged_content
+        # 部分ログを relay に逐次送信したか（したなら最後にまとめて送らない）
+        self.streamed = False
+        # /command のストリーム応答時の出力先。設定されていれば出力を溜めずにここへ流す
+        self.output_sink = None
+
+    @property
+    def read_only(self) -> bool:
+        if self.command.startswith(READONLY_INTERNAL_PREFIXES):
+            return True
+        # Agent の読み取り専用プローブ（cat / ls / git log など）は cwd もファイルも変えない
+        if self.silent and self.relay_read_only:
+            return True
+        # トークン付きのステージは専用ファイルに書くだけなので並列可（旧形式は共有ファイルのため直列）
+        if self.command.startswith("_internal_stage_file_for_download::"):
+            parts = self.command.split("::", 2)
+            return len(parts) >= 3 and bool(parts[2].strip())
+        return False
+
+    @property
+    def changes_state(self) -> bool:
+        """cwd・conda 環境・実行方式などセッションの状態を変えるコマンドか"""
+        c = self.command
+        if c.startswith("cd ") or c.startswith(STATE_INTERNAL_PREFIXES):
+            return True
+        return c.startswith("conda activate") or c == "conda deactivate"
+
+    @property
+    def locked_paths(self) -> tuple:
+        """ファイル操作の内部コマンドが触るパス（セッション dir 相対）。それ以外は空"""
+        c = self.command
+        if not c.startswith(PATH_INTERNAL_PREFIXES):
+            return ()
+        name, rest = c.split("::", 1)
+        if name == "_internal_move_staged_file":
+            rest = rest.split("::", 1)[-1]
+        elif name == "_internal_stage_file_for_download":
+            # トークン無しの旧形式は共有の .staged_for_download に書く
+            return (".staged_for_download",)
+        elif name in ("_internal_rename_path", "_internal_copy_path", "_internal_create_link"):
+            idx = rest.rfind("::")
+            if idx < 0:
+                return ()
+            first, second = rest[:idx], rest[idx + 2:]
+            # create_link の前半はリンク先（任意の文字列）なので、作るリンク名だけをロックする
+            paths = (second,) if name == "_internal_create_link" else (first, second)
+            return tuple(os.path.normpath(x.strip()) for x in paths)
+        return (os.path.normpath(rest.strip()),)
+
+
+# 1 コマンドの応答に載せる出力の上限。先頭と末尾だけをメモリに持ち、あふれたら全文を gzip に書き出す
+OUTPUT_HEAD_CHARS = int(os.environ.get("WATCHER_OUTPUT_HEAD_CHARS", "64000"))
+OUTPUT_TAIL_CHARS = int(os.environ.get("WATCHER_OUTPUT_TAIL_CHARS", "64000"))
+OUTPUT_SPILL_DIR = ".command_output"
+OUTPUT_SPILL_TTL = 3600.0
+OUTPUT_READ_MAX_BYTES = 1_000_000
+# 書き出しを閉じたときに置く展開後サイズの記録（gzip 末尾の ISIZE は 4GiB で一周し、書き込み中は無いため）
+OUTPUT_SPILL_META_SUFFIX = ".meta.json"
+# 全文は展開後 OUTPUT_SPILL_MEMBER_BYTES ごとに独立した gzip メンバーにし、各メンバーの開始位置
+# （"展開後 offset 圧縮後 offset" の行）を <id>.idx に追記する。読むときは offset 直前のメンバーから展開する
+OUTPUT_SPILL_MEMBER_BYTES = 4 * 1024 * 1024
+OUTPUT_SPILL_INDEX_SUFFIX = ".idx"
+
+
+class OutputBuffer:
+    """1 コマンド分の出力（output_lines の代わりに使う）。
+    先頭 OUTPUT_HEAD_CHARS と直近 OUTPUT_TAIL_CHARS だけを保持し、中間が落ちる時点で全文を
+    .command_output/<id>.log.gz へ書き出す。全文は _internal_read_output::<id> で後から読める。
+    書き出しは OUTPUT_SPILL_MEMBER_BYTES ごとの gzip メンバーに分け（<id>.idx に開始位置）、
+    閉じたときに展開後の総バイト数を <id>.meta.json に記録する。
+    streaming=True（/command のストリーム応答）では、逐次流さなかった行（内部コマンドの結果・終了マーカー）を別に覚え、
+    応答の output にはそれだけを返す（流した行を最後にもう一度送らない）"""
+
+    def __init__(self, base_dir: Path, streaming: bool = False):
+        self.base_dir = base_dir
+        self.streaming = streaming
+        self._unstreamed: List[str] = []
+        self._head: List[str] = []
+        self._head_chars = 0
+        self._tail: deque = deque()
+        self._tail_chars = 0
+        self.omitted_chars = 0
+        self.total_chars = 0
+        self._spill = None
+        self._spill_raw = None
+        self._spill_bytes = 0
+        self._member_bytes = 0
+        self.spill_id: Optional[str] = None
+
+    def append(self, text: str, streamed: bool = False) -> None:
+        """streamed=True はストリーム応答で既に送った行"""
+        text = str(text)
+        if self.streaming and not streamed:
+            self._unstreamed.append(text)
+        n = len(text) + 1
+        self.total_chars += n
+        if self._spill is not None:
+            self._write_spill(text)
+        if not self._tail and self._head_chars + n <= OUTPUT_HEAD_CHARS:
+            self._head.append(text)
+            self._head_chars += n
+            return
+        self._tail.append(text)
+        self._tail_chars += n
+        while self._tail_chars > OUTPUT_TAIL_CHARS and len(self._tail) > 1:
+            if self._spill is None and self.spill_id is None:
+                self._start_spill()
+            dropped = self._tail.popleft()
+            self._tail_chars -= len(dropped) + 1
+            self.omitted_chars += len(dropped) + 1
+
+    def _start_spill(self) -> None:
+        """初めて中間を捨てる直前に、ここまでの全文（先頭 + 末尾バッファ）を書き出して以降は追記する"""
+        self.spill_id = f"{int(time.time() * 1000)}-{os.urandom(4).hex()}"
+        spill_dir = self.base_dir / OUTPUT_SPILL_DIR
+        path = spill_dir / f"{self.spill_id}.log.gz"
+        try:
+            spill_dir.mkdir(parents=True, exist_ok=True)
+            self._spill_raw = path.open("wb")
+            self._spill = gzip.GzipFile(fileobj=self._spill_raw, mode="wb", compresslevel=3)
+            _staged_expiry.register(path, OUTPUT_SPILL_TTL)
+            _staged_expiry.register(spill_dir / f"{self.spill_id}{OUTPUT_SPILL_INDEX_SUFFIX}", OUTPUT_SPILL_TTL)
+            for line in self._head:
+                self._write_spill(line)
+            for line in self._tail:
+                self._write_spill(line)
+        except Exception as e:
+            print(f"[RT] Failed to spill command output: {e}", flush=True)
+            self._close_spill()
+            self.spill_id = None
+
+    def _write_spill(self, text: str) -> None:
+        if self._spill is None:
+            return
+        try:
+            data = (text + "\n").encode("utf-8", errors="replace")
+            self._spill.write(data)
+            self._spill_bytes += len(data)
+            self._member_bytes += len(data)
+            if self._member_bytes >= OUTPUT_SPILL_MEMBER_BYTES:
+                self._next_member()
+        except Exception as e:
+            print(f"[RT] Failed to write spilled output: {e}", flush=True)
+            self._close_spill()
+
+    def _next_member(self) -> None:
+        """今の gzip メンバーを閉じて次を始め、その開始位置を <id>.idx に追記する"""
+        self._spill.close()  # fileobj を渡しているので raw は閉じない（メンバーの末尾だけ書く）
+        self._spill_raw.flush()
+        idx = self.base_dir / OUTPUT_SPILL_DIR / f"{self.spill_id}{OUTPUT_SPILL_INDEX_SUFFIX}"
+        with idx.open("a", encoding="utf-8") as f:
+            f.write(f"{self._spill_bytes} {self._spill_raw.tell()}\n")
+        self._spill = gzip.GzipFile(fileobj=self._spill_raw, mode="wb", compresslevel=3)
+        self._member_bytes = 0
+
+    def _close_spill(self) -> None:
+        for f in (self._spill, self._spill_raw):
+            if f is not None:
+                try:
+                    f.close()
+                except Exception:
+                    pass
+        self._spill = None
+        self._spill_raw = None
+
+    def close(self) -> None:
+        self._close_spill()
+        if self.spill_id is None:
+            return
+        # 書き出し途中で失敗した場合も、gzip に入っている分のバイト数を記録する
+        spill_dir = self.base_dir / OUTPUT_SPILL_DIR
+        meta = spill_dir / f"{self.spill_id}{OUTPUT_SPILL_META_SUFFIX}"
+        tmp = spill_dir / f".tmp-{self.spill_id}{OUTPUT_SPILL_META_SUFFIX}"
+        try:
+            tmp.write_text(json.dumps({"totalBytes": self._spill_bytes}), encoding="utf-8")
+            os.replace(tmp, meta)
+            # 全文と記録は閉じた時点から同じ期限で消す（長く走ったコマンドの全文がすぐ消えないように）
+            for suffix in (".log.gz", OUTPUT_SPILL_INDEX_SUFFIX, OUTPUT_SPILL_META_SUFFIX):
+                _staged_expiry.register(spill_dir / f"{self.spill_id}{suffix}", OUTPUT_SPILL_TTL)
+        except Exception as e:
+            print(f"[RT] Failed to write spilled output size: {e}", flush=True)
+
+    def extra(self) -> dict:
+        """応答に付ける情報（中略したときだけ）"""
+        if not self.omitted_chars:
+            return {}
+        info = {"outputTruncated": True, "outputChars": self.total_chars}
+        if self.spill_id:
+            info["outputId"] = self.spill_id
+        return info
+
+    def __iter__(self):
+        yield from self._head
+        if self.omitted_chars:
+            where = f"; full output id: {self.spill_id}" if self.spill_id else ""
+            yield f"...[{self.omitted_chars} chars omitted{where}]..."
+        yield from self._tail
+
+    def __len__(self) -> int:
+        return len(self._head) + len(self._tail) + (1 if self.omitted_chars else 0)
+
+    def text(self) -> str:
+        """応答の output。ストリーム応答では流していない行だけ"""
+        if self.streaming:
+            return "\n".join(self._unstreamed)
+        return "\n".join(self)
+
+
+def _read_spilled_size(meta: Path) -> Optional[int]:
+    """<id>.meta.json の展開後サイズ。まだ書き出し中（記録が無い）なら None"""
+    try:
+        total = json.loads(meta.read_text(encoding="utf-8")).get("totalBytes")
+    except (OSError, ValueError, AttributeError):
+        return None
+    return total if isinstance(total, int) and total >= 0 else None
+
+
+def _spilled_checkpoint(idx: Path, offset: int) -> tuple:
+    """offset 以前で最も近い gzip メンバーの (展開後 offset, 圧縮後 offset)"""
+    best = (0, 0)
+    try:
+        lines = idx.read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return best
+    for line in lines:
+        parts = line.split()
+        # 書き込み途中の最終行は読み飛ばす
+        if len(parts) != 2 or not parts[0].isdigit() or not parts[1].isdigit():
+            continue
+        uoff, coff = int(parts[0]), int(parts[1])
+        if uoff > offset:
+            break
+        best = (uoff, coff)
+    return best
+
+
+def _utf8_head_skip(data: bytes) -> int:
+    """先頭にある文字の途中（継続バイト）の長さ"""
+    n = 0
+    while n < min(3, len(data)) and 0x80 <= data[n] <= 0xBF:
+        n += 1
+    return n
+
+
+def _utf8_complete_len(data: bytes) -> int:
+    """末尾の途中で切れた UTF-8 文字を除いた長さ"""
+    end = len(data)
+    i = end - 1
+    while i >= 0 and end - i <= 3 and 0x80 <= data[i] <= 0xBF:
+        i -= 1
+    if i < 0:
+        return end
+    lead = data[i]
+    need = 4 if lead >= 0xF0 else 3 if lead >= 0xE0 else 2 if lead >= 0xC0 else 1
+    return end if end - i >= need else i
+
+
+def read_spilled_output(base_dir: Path, output_id: str, offset: int, length: int) -> dict:
+    """書き出した全文のうち offset から length バイト（展開後）を返す。
+    <id>.idx で offset 直前の gzip メンバーから展開するので、先頭から読み直さない。
+    チャンクの境界は UTF-8 の文字境界に合わせる（offset が文字の途中なら次の文字から、末尾の途中で切れた文字は
+    次のチャンクに回す）。返す offset / nextOffset は調整後の値。
+    書き出し中のものは totalSize を None、inProgress を True とし、読めたところまでを返す"""
+    if not re.match(r"^[A-Za-z0-9._-]+$", output_id):
+        raise ValueError("Invalid output id")
+    spill_dir = base_dir / OUTPUT_SPILL_DIR
+    path = spill_dir / f"{output_id}.log.gz"
+    if not path.is_file():
+        raise FileNotFoundError(f"output not found: {output_id}")
+    length = max(1, min(length, OUTPUT_READ_MAX_BYTES))
+    offset = max(0, offset)
+    total_size = _read_spilled_size(spill_dir / f"{output_id}{OUTPUT_SPILL_META_SUFFIX}")
+    start, raw_start = _spilled_checkpoint(spill_dir / f"{output_id}{OUTPUT_SPILL_INDEX_SUFFIX}", offset)
+    # 書き出し中の gzip は末尾が未完で gzip.open では EOFError になるため、zlib で読めたところまで展開する。
+    # 文字境界の調整のため前後に数バイト余分に読む
+    want = length + 4
+    dec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks: List[bytes] = []
+    skip = offset - start
+    got = 0
+    with path.open("rb") as raw:
+        raw.seek(raw_start)
+        pending = b""
+        while got < want:
+            if dec.eof:
+                # 次の gzip メンバー
+                pending = dec.unused_data
+                dec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if not pending:
+                pending = raw.read(65536)
+                if not pending:
+                    break
+            out = dec.decompress(pending, 65536)
+            pending = dec.unconsumed_tail if not dec.eof else b""
+            if skip:
+                cut = min(skip, len(out))
+                out = out[cut:]
+                skip -= cut
+            if out:
+                out = out[:want - got]
+                chunks.append(out)
+                got += len(out)
+    data = b"".join(chunks)
+    head = _utf8_head_skip(data)
+    offset += head
+    data = data[head:]
+    read_len = len(data)
+    at_end = read_len <= length and total_size is not None
+    if not at_end:
+        data = data[:length]
+        cut = _utf8_complete_len(data)
+        # 1 文字にも満たない length では切らない
+        if cut > 0:
+            data = data[:cut]
+    if total_size is None:
+        # 書き出し中: 今読めた分より先がすでにあるか
+        has_more = read_len > len(data)
+    else:
+        has_more = offset + len(data) < total_size
+    return {
+        "content": data.decode("utf-8", errors="replace"),
+        "offset": offset,
+        "length": len(data),
+        "totalSize": total_size,
+        "inProgress": total_size is None,
+        "nextOffset": offset + len(data),
+        "hasMore": has_more,
+    }
+
+
+class PathLocks:
+    """パスごとのロック。使われていないパスのロックは残さない"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # path -> [Lock, 参照数]
+        self._locks: Dict[str, list] = {}
+
+    @contextmanager
+    def hold(self, *paths: str):
+        # 複数パスは常に同じ順で取る（rename a b と rename b a でデッドロックしない）
+        keys = sorted(set(paths))
+        with self._lock:
+            entries = []
+            for key in keys:
+                entry = self._locks.setdefault(key, [threading.Lock(), 0])
+                entry[1] += 1
+                entries.append(entry)
+        try:
+            for entry in entries:
+                entry[0].acquire()
+            try:
+                yield
+            finally:
+                for entry in reversed(entries):
+                    entry[0].release()
+        finally:
+            with self._lock:
+                for key, entry in zip(keys, entries):
+                    entry[1] -= 1
+                    if not entry[1]:
+                        self._locks.pop(key, None)
+
+
+class SessionScheduler:
+    """セッションごとの実行レーン。保証する順序は次のとおり:
+    - cd・conda activate/deactivate・_internal_reset_cwd・_internal_set_runner_config など状態を変えるコマンドは
+      state ロックで 1 つずつ適用する。適用が終わった後に始まるコマンドは必ず新しい cwd / 環境を使う
+    - 通常のシェルコマンドは開始時に cwd / conda 環境を state ロック下で読み取り、あとはその値で他と並行に走る。
+      実行中のコマンドの終了は待たず、実行中のコマンドも後から来た cd の影響を受けない
+    - ファイル操作の内部コマンドは対象パスごとに排他（同じパスへの操作同士だけが重ならない）
+    - 読み取り専用の内部操作・検索は上限付き（READONLY_PARALLEL）で並列
+    到着順に 1 つずつ実行したい場合（commands.txt 経由）は呼び出し側が 1 つずつ run() する"""
+    def __init__(self, parallel: int = READONLY_PARALLEL):
+        self.state = threading.Lock()
+        self.readonly = threading.BoundedSemaphore(max(1, parallel))
+        self.paths = PathLocks()
+
+    def run(self, ctx: "SessionContext", req: CommandRequest) -> tuple:
+        if req.changes_state:
+            with self.state:
+                return ctx.execute(req)
+        if req.read_only:
+            with self.readonly:
+                return ctx.execute(req)
+        paths = req.locked_paths
+        if paths:
+            with self.paths.hold(*paths):
+                return ctx.execute(req)
+        return ctx.execute(req)
+
+
+# ===== Docker warm pool =====
+# docker_run モードでコマンドごとに docker run --rm すると、毎回コンテナ起動を待つことになる。
+# WATCHER_DOCKER_WARM=1 のときだけ、セッション・イメージ・マウント先ごとに 1 つコンテナを常駐させ、コマンドは docker exec で流す。
+# マウント・ユーザー・作業ディレクトリは docker run と同じだが、隔離は同じではない: マウント外への変更（pip install・/tmp・
+# ホーム下の設定など）は常駐コンテナが止まるまで次のコマンドにも残る。コマンドが起動したプロセスは、バックグラウンドのものも含め
+# コマンド終了時（docker exec のクライアントが殺された場合も）に SYNCTERM_EXEC_ID で探して止める。アイドルが続いたコンテナは停止する。
+DOCKER_WARM_ENABLED = os.environ.get("WATCHER_DOCKER_WARM", "0") == "1"
+DOCKER_WARM_IDLE_SEC = float(os.environ.get("WATCHER_DOCKER_WARM_IDLE_SEC", "600"))
+DOCKER_WARM_HEALTH_SEC = 15.0
+DOCKER_WARM_RETRY_SEC = 60.0
+DOCKER_WARM_START_TIMEOUT = 60
+DOCKER_WARM_LABEL = "syncterm.warm-watcher"
+DOCKER_WARM_KILL_TIMEOUT = 30
+# 環境変数 SYNCTERM_EXEC_ID=<id> を持つプロセス（exec したコマンドとその子孫）をすべて止める
+_DOCKER_WARM_KILL_SCRIPT = (
+    'for p in /proc/[0-9]*; do '
+    'tr "\\0" "\\n" 2>/dev/null < "$p/environ" | grep -qx "SYNCTERM_EXEC_ID=$0" && kill -9 "${p#/proc/}" 2>/dev/null; '
+    'done; true'
+)
+
+
+class DockerWarmPool:
+    """(セッション dir, イメージ, マウント先) ごとの常駐コンテナ"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> {"name", "last_used", "last_check", "running", "in_use", "lock"}
+        self._containers: Dict[tuple, dict] = {}
+        self._reaper_started = False
+
+    def _container_name(self, key: tuple) -> str:
+        digest = hashlib.sha1("\0".join(key).encode("utf-8")).hexdigest()[:12]
+        wid = re.sub(r"[^A-Za-z0-9_.-]", "-", WATCHER_ID)[:40] or "watcher"
+        return f"syncterm-warm-{wid}-{digest}"
+
+    def acquire(self, base_dir: Path, image: str, work_dir: str) -> Optional[str]:
+        """常駐コンテナ名を返す（無ければ起動）。起動できなければ None（呼び出し側で docker run にフォールバック）。
+        返した場合はコマンド終了後に release() すること（実行中は停止対象にしない）"""
+        key = (str(base_dir), image, work_dir)
+        with self._lock:
+            entry = self._containers.get(key)
+            if entry is None:
+                entry = {"name": self._container_name(key), "last_used": 0.0, "last_check": 0.0,
+                         "running": False, "in_use": 0, "failed_at": -DOCKER_WARM_RETRY_SEC, "lock": threading.Lock()}
+                self._containers[key] = entry
+            if not self._reaper_started:
+                self._reaper_started = True
+                threading.Thread(target=self._reap_loop, daemon=True, name="docker-warm-reaper").start()
+        with entry["lock"]:
+            now = time.monotonic()
+            entry["last_used"] = now
+            if entry["running"] and now - entry["last_check"] >= DOCKER_WARM_HEALTH_SEC:
+                entry["running"] = self._is_running(entry["name"])
+                entry["last_check"] = now
+            # 起動に失敗した直後は毎コマンドで再試行せず docker run にフォールバックする
+            if not entry["running"] and now - entry["failed_at"] >= DOCKER_WARM_RETRY_SEC:
+                entry["running"] = self._start(entry["name"], base_dir, image, work_dir)
+                entry["last_check"] = now
+                entry["failed_at"] = 0.0 if entry["running"] else now
+            if not entry["running"]:
+                return None
+            with self._lock:
+                entry["in_use"] += 1
+            return entry["name"]
+
+    def finish(self, name: str, exec_id: str) -> None:
+        """コマンド終了。exec したコマンドが残したプロセスを止めてから release する（docker run --rm と同じく残さない）"""
+        try:
+            subprocess.run(
+                ["docker", "exec", name, "sh", "-c", _DOCKER_WARM_KILL_SCRIPT, exec_id],
+                capture_output=True, timeout=DOCKER_WARM_KILL_TIMEOUT,
+            )
+        except Exception as e:
+            print(f"[RT] Docker warm container cleanup failed ({name}): {e}", flush=True)
+        finally:
+            self.release(name)
+
+    def release(self, name: str) -> None:
+        """コマンド終了。アイドル時間はここから数える"""
+        with self._lock:
+            for entry in self._containers.values():
+                if entry["name"] == name:
+                    entry["in_use"] = max(0, entry["in_use"] - 1)
+                    entry["last_used"] = time.monotonic()
+
+    def _is_running(self, name: str) -> bool:
+        try:
+            proc = subprocess.run(
+                ["docker", "inspect", "-f", "{{.State.Running}}", name],
+                capture_output=True, text=True, timeout=10,
+            )
+            return proc.returncode == 0 and proc.stdout.strip() == "true"
+        except Exception:
+            return False
+
+    def _start(self, name: str, base_dir: Path, image: str, work_dir: str) -> bool:
+        # 同名の停止済み・不調なコンテナが残っていれば消してから起動する
+        self._remove(name)
+        cmd = [
+            "docker", "run", "-d", "--rm", "--name", name,
+            "--label", f"{DOCKER_WARM_LABEL}={WATCHER_ID}",
+            "-v", f"{base_dir}:{work_dir}",
+            "--user", f"{os.getuid()}:{os.getgid()}",
+            "-w", work_dir,
+            "--entrypoint", "tail",
+            image, "-f", "/dev/null",
+        ]
+        try:
+            proc = subprocess.run(cmd, capture_output=True, text=True, timeout=DOCKER_WARM_START_TIMEOUT)
+        except Exception as e:
+            print(f"[RT] Docker warm container start failed ({image}): {e}", flush=True)
+            return False
+        if proc.returncode != 0:
+            print(f"[RT] Docker warm container start failed ({image}): {proc.stderr.strip()}", flush=True)
+            return False
+        print(f"[RT] Docker warm container started: {name} ({image})", flush=True)
+        return True
+
+    def _remove(self, name: str) -> None:
+        try:
+            subprocess.run(["docker", "rm", "-f", name], capture_output=True, timeout=30)
+        except Exception:
+            pass
+
+    def _reap_loop(self) -> None:
+        while True:
+            time.sleep(min(60.0, max(5.0, DOCKER_WARM_IDLE_SEC / 4)))
+            now = time.monotonic()
+            with self._lock:
+                idle = [
+                    (key, entry) for key, entry in self._containers.items()
+                    if not entry["in_use"] and now - entry["last_used"] > DOCKER_WARM_IDLE_SEC
+                ]
+            for key, entry in idle:
+                # 起動中・使用開始直後なら lock が取れないので次の周回に回す
+                if not entry["lock"].acquire(blocking=False):
+                    continue
+                try:
+                    with self._lock:
+                        if entry["in_use"] or time.monotonic() - entry["last_used"] <= DOCKER_WARM_IDLE_SEC:
+                            continue
+                        self._containers.pop(key, None)
+                    if entry["running"]:
+                        print(f"[RT] Docker warm container idle, stopping: {entry['name']}", flush=True)
+                        self._remove(entry["name"])
+                finally:
+                    entry["lock"].release()
+
+    def cleanup_stale(self) -> None:
+        """前回の Watcher プロセスが残した常駐コンテナを片付ける"""
+        if not shutil.which("docker"):
+            return
+        try:
+            proc = subprocess.run(
+                ["docker", "ps", "-aq", "--filter", f"label={DOCKER_WARM_LABEL}={WATCHER_ID}"],
+                capture_output=True, text=True, timeout=15,
+            )
+            ids = proc.stdout.split()
+            if ids:
+                subprocess.run(["docker", "rm", "-f", *ids], capture_output=True, timeout=60)
+                print(f"[RT] Removed {len(ids)} stale docker warm container(s)", flush=True)
+        except Exception:
+            pass
+
+
+_docker_warm_pool = DockerWarmPool()
+
+
+# ステータスに載せる固定値（cd のたびに問い合わせない）
+_STATUS_USER = getpass.getuser()
+_STATUS_HOST = socket.gethostname()
+
+
 class SessionContext:
     """セッションごとの状態"""
     def __init__(self, base_dir: Path):
@@ -75,11 +685,15 @@ class SessionContext:
         # Backend から渡される Watcher/Session ID（部分ログ送信用）
         self.watcher_id: Optional[str] = None
         self.session_name: Optional[str] = None
-        self.streamed: bool = False
-        # Agent など「ターミナルには出さずに結果だけ欲しい」実行用フラグ
-        self.silent: bool = False
-        # 直近の execute 呼び出しが silent だったかどうか（_handle_command 側で最終ログ送信を抑制するために使用）
-        self.last_silent: bool = False
+        self.scheduler = SessionScheduler()
+        self._last_status: Optional[dict] = None
+        # .runner_config.json のキャッシュ。stat は RUNNER_CONFIG_CHECK_SEC ごとに 1 回だけ
+        self._runner_config: dict = {}
+        self._runner_config_sig: Optional[tuple] = None
+        self._runner_config_checked = 0.0
+        # 実行中のスレッドの _wrap_command が使った常駐コンテナ（コマンド終了時に release する）。
+        # シェルコマンドは同じセッションでも並行に走るのでスレッドごとに持つ
+        self._warm = threading.local()
         self.conda_env: Optional[str] = "base" if HAS_CONDA else None
         # .runner_config.json で conda_env が指定されていれば採用
         cfg = self._get_runner_config()
@@ -88,46 +702,75 @@ class SessionContext:
         self._write_status()
 
     def _write_status(self) -> None:
-        """セッション用 .watcher_status.json を書き、Relay が full_cwd を読めるようにする"""
+        """セッション用 .watcher_status.json を書き、Relay が full_cwd を読めるようにする。
+        変化が無ければ何もしない。変化があれば relay のキャッシュにも送る（rsync を待たない）"""
         try:
             try:
                 pretty_cwd = f"./{self.cwd.relative_to(self.base_dir)}"
             except ValueError:
                 pretty_cwd = str(self.cwd)
             status_data = {
-                "user": getpass.getuser(),
-                "host": socket.gethostname(),
+                "user": _STATUS_USER,
+                "host": _STATUS_HOST,
                 "cwd": pretty_cwd,
                 "full_cwd": str(self.cwd),
                 "conda_env": self.conda_env or None,
             }
+            if status_data == self._last_status:
+                return
+            self._last_status = status_data
             (self.base_dir / ".watcher_status.json").write_text(
                 json.dumps(status_data, ensure_ascii=False), encoding="utf-8"
             )
         except Exception:
             pass
+        if self._last_status is not None:
+            _status_pusher.push(self.watcher_id or WATCHER_ID, self.session_name or self.base_dir.name, self._last_status)
 
     def _get_runner_config(self) -> dict:
+        """キャッシュした runner 設定を返す。rsync で置き換わった場合に備え、一定間隔で mtime / サイズを確認する"""
+        now = time.monotonic()
+        if self._runner_config_sig is not None and now - self._runner_config_checked < RUNNER_CONFIG_CHECK_SEC:
+            return self._runner_config
+        self._runner_config_checked = now
         p = self.base_dir / ".runner_config.json"
-        if p.exists():
-            try:
-                return json.loads(p.read_text(encoding="utf-8"))
-            except Exception:
-                pass
-        return {}
+        try:
+            st = p.stat()
+            sig = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            sig = (0, -1)
+        if sig != self._runner_config_sig:
+            config = {}
+            if sig[1] >= 0:
+                try:
+                    config = json.loads(p.read_text(encoding="utf-8"))
+                except Exception:
+                    pass
+            self._runner_config = config if isinstance(config, dict) else {}
+            self._runner_config_sig = sig
+        return self._runner_config
 
-    def _wrap_conda(self, cmdline: str) -> str:
-        if not HAS_CONDA or not self.conda_env:
+    def set_runner_config(self, config: dict) -> None:
+        """relay から直接渡された runner 設定を反映する（rsync を待たない）"""
+        p = self.base_dir / ".runner_config.json"
+        p.write_text(json.dumps(config, indent=2), encoding="utf-8")
+        st = p.stat()
+        self._runner_config = config
+        self._runner_config_sig = (st.st_mtime_ns, st.st_size)
+        self._runner_config_checked = time.monotonic()
+
+    def _wrap_conda(self, cmdline: str, conda_env: Optional[str]) -> str:
+        if not HAS_CONDA or not conda_env:
             return cmdline
         # conda run -n <env> で確実にその環境で実行（hook/activate は PATH や login shell に依存するため使わない）
-        return f"{shlex.quote(CONDA_EXE)} run --no-capture-output -n {shlex.quote(self.conda_env)} bash -c {shlex.quote(cmdline)}"
+        return f"{shlex.quote(CONDA_EXE)} run --no-capture-output -n {shlex.quote(conda_env)} bash -c {shlex.quote(cmdline)}"
 
-    def _wrap_docker_exec(self, cmdline: str, config: dict) -> tuple:
+    def _wrap_docker_exec(self, cmdline: str, config: dict, cwd: Path) -> tuple:
         container = config.get("container_name") or config.get("image")
         if not container:
             return cmdline, ""
         try:
-            rel = self.cwd.relative_to(self.base_dir)
+            rel = cwd.relative_to(self.base_dir)
         except ValueError:
             rel = Path(".")
         docker_work_dir = config.get("mount_path") or DOCKER_WORK_DIR
@@ -137,74 +780,88 @@ class SessionContext:
         cmd = f"docker exec -i -w {shlex.quote(str(target))} {shlex.quote(container)} bash -c {shlex.quote(cmdline)}"
         return cmd, f"🐳 [Docker Exec] {container}"
 
-    def _wrap_docker_run(self, cmdline: str, config: dict) -> tuple:
+    def _wrap_docker_run(self, cmdline: str, config: dict, cwd: Path) -> tuple:
         image = config.get("image")
         if not image:
             return cmdline, ""
         try:
-            rel = self.cwd.relative_to(self.base_dir)
+            rel = cwd.relative_to(self.base_dir)
         except ValueError:
             rel = Path(".")
         docker_work_dir = config.get("mount_path") or DOCKER_WORK_DIR
         target = Path(docker_work_dir) / rel
+        if DOCKER_WARM_ENABLED:
+            name = _docker_warm_pool.acquire(self.base_dir, image, docker_work_dir)
+            if name:
+                exec_id = os.urandom(8).hex()
+                self._warm.container = name
+                self._warm.exec_id = exec_id
+                cmd = (
+                    f"docker exec -i -e SYNCTERM_EXEC_ID={exec_id} -w {shlex.quote(str(target))} "
+                    f"{shlex.quote(name)} bash -c {shlex.quote(cmdline)}"
+                )
+                return cmd, f"🐳 [Docker Run] {image} (warm)"
         mount = f"-v {shlex.quote(str(self.base_dir))}:{shlex.quote(docker_work_dir)}"
         user_opt = f"--user {os.getuid()}:{os.getgid()}"
         cmd = f"docker run --rm -i {mount} {user_opt} -w {shlex.quote(str(target))} {shlex.quote(image)} bash -c {shlex.quote(cmdline)}"
         return cmd, f"🐳 [Docker Run] {image}"
 
-    def _wrap_command(self, cmdline: str) -> tuple:
+    def _release_warm_container(self) -> None:
+        """常駐コンテナで実行したコマンドの後始末。残ったプロセスの停止は応答を待たせないよう裏で行う"""
+        name = getattr(self._warm, "container", None)
+        if name:
+            exec_id = self._warm.exec_id
+            self._warm.container = None
+            self._warm.exec_id = None
+            threading.Thread(target=_docker_warm_pool.finish, args=(name, exec_id), daemon=True).start()
+
+    def _snapshot_state(self) -> tuple:
+        """実行開始時の (cwd, conda_env)。cd などの適用中は待つ"""
+        with self.scheduler.state:
+            return self.cwd, self.conda_env
+
+    def _wrap_command(self, cmdline: str, cwd: Path, conda_env: Optional[str]) -> tuple:
         config = self._get_runner_config()
         mode = config.get("mode", "")
         if mode == "docker_exec":
-            return self._wrap_docker_exec(cmdline, config)
+            return self._wrap_docker_exec(cmdline, config, cwd)
         if mode == "docker_run":
-            return self._wrap_docker_run(cmdline, config)
-        return self._wrap_conda(cmdline), ""
+            return self._wrap_docker_run(cmdline, config, cwd)
+        return self._wrap_conda(cmdline, conda_env), ""
 
-    def _append_output(self, text: str, output_lines: List[str]) -> None:
+    def _append_output(self, text: str, output_lines: "OutputBuffer", req: Optional[CommandRequest] = None) -> None:
         """出力をバッファと relay 双方に追加する（可能なら部分ログを即時送信）"""
         t = text
         if not KEEP_ANSI:
             t = ANSI_ESCAPE.sub("", t)
         if MAX_OUTPUT_CHARS and len(t) > MAX_OUTPUT_CHARS:
             t = t[:MAX_OUTPUT_CHARS] + "\n...[truncated]"
-        output_lines.append(t)
+        streamed = req is not None and req.output_sink is not None
+        if streamed:
+            # ストリーム応答では全文をそのまま流す。OutputBuffer は先頭・末尾と書き出しだけを受け持つ
+            req.output_sink(t)
+        output_lines.append(t, streamed=streamed)
         # RT モードでは可能な限り逐次ログ送信して、長時間タスクの進捗を即時反映させる
-        if RELAY_LOG_URL and self.watcher_id and self.session_name and t and not getattr(self, "silent", False):
+        if RELAY_LOG_URL and req is not None and self.watcher_id and self.session_name and t and not req.silent:
             try:
                 post_log_to_relay(self.watcher_id, self.session_name, t if t.endswith("\n") else t + "\n")
-                self.streamed = True
+                req.streamed = True
             except Exception as e:
                 print(f"[RT] Failed to post partial log: {e}", flush=True)
 
-    def run_command(self, cmdline: str, output_lines: List[str]) -> int:
-        """コマンド実行し output_lines に出力を追加。exit_code を返す"""
-        def append(text: str) -> None:
-            self._append_output(text, output_lines)
-
-        stripped = cmdline.lstrip()
-        is_python = stripped.startswith("python ") or stripped.startswith("python3 ")
-
-        if is_python:
-            try:
-                parts = shlex.split(stripped)
-            except Exception:
-                parts = stripped.split()
-            if not parts:
-                return 0
-            if "-u" not in parts[1:]:
-                parts.insert(1, "-u")
-            py_log = (self.cwd / "python.log").resolve()
-            try:
-                py_log.write_text("", encoding="utf-8")
-            except Exception:
-                pass
-            py_cmd = " ".join(shlex.quote(p) for p in parts)
-            final_cmd, info = self._wrap_command(py_cmd)
-            full = f"{final_cmd} > {shlex.quote(str(py_log))} 2>&1"
-            if info:
-                append(f"\n{info}")
-            proc = subprocess.Popen(full, shell=True, cwd=self.cwd)
+    def _run_python(self, parts: List[str], py_log: Path, cwd: Path, conda_env: Optional[str], append) -> int:
+        """python コマンドを python.log 経由で実行し、追記分を逐次 append する"""
+        try:
+            py_log.write_text("", encoding="utf-8")
+        except Exception:
+            pass
+        py_cmd = " ".join(shlex.quote(p) for p in parts)
+        final_cmd, info = self._wrap_command(py_cmd, cwd, conda_env)
+        full = f"{final_cmd} > {shlex.quote(str(py_log))} 2>&1"
+        if info:
+            append(f"\n{info}")
+        try:
+            proc = subprocess.Popen(full, shell=True, cwd=cwd)
             last_pos = 0
             while True:
                 if py_log.exists():
@@ -223,7 +880,32 @@ class SessionContext:
                             append(chunk.rstrip("\n"))
                     break
                 time.sleep(0.1)
-            return proc.returncode if proc.returncode is not None else -1
+        finally:
+            self._release_warm_container()
+        return proc.returncode if proc.returncode is not None else -1
+
+    def run_command(self, cmdline: str, output_lines: "OutputBuffer", req: Optional[CommandRequest] = None) -> int:
+        """コマンド実行し output_lines に出力を追加。exit_code を返す"""
+        def append(text: str) -> None:
+            self._append_output(text, output_lines, req)
+
+        stripped = cmdline.lstrip()
+        is_python = stripped.startswith("python ") or stripped.startswith("python3 ")
+        cwd, conda_env = self._snapshot_state()
+
+        if is_python:
+            try:
+                parts = shlex.split(stripped)
+            except Exception:
+                parts = stripped.split()
+            if not parts:
+                return 0
+            if "-u" not in parts[1:]:
+                parts.insert(1, "-u")
+            py_log = (cwd / "python.log").resolve()
+            # 同じディレクトリの python.log を共有するので、そこで走る python 同士だけは 1 つずつ
+            with self.scheduler.paths.hold(str(py_log)):
+                return self._run_python(parts, py_log, cwd, conda_env, append)
 
         # ===== Safety guard: block obviously dangerous commands =====
         dangerous_patterns = [
@@ -239,32 +921,35 @@ class SessionContext:
                 append("[Watcher] ERROR: command blocked by safety policy (too dangerous).")
                 return 1
 
-        final_cmd, info = self._wrap_command(cmdline)
+        final_cmd, info = self._wrap_command(cmdline, cwd, conda_env)
         if info:
             append(f"\n{info}")
-        proc = subprocess.Popen(
-            final_cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            cwd=self.cwd,
-            encoding="utf-8",
-            errors="replace",
-            env=os.environ.copy(),
-        )
         try:
-            if proc.stdout:
-                for line in proc.stdout:
-                    if line:
-                        append(line.rstrip("\n"))
-            proc.wait()
-        except Exception as e:
-            append(f"[Watcher] ERROR: {e}")
+            proc = subprocess.Popen(
+                final_cmd,
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+                cwd=cwd,
+                encoding="utf-8",
+                errors="replace",
+                env=os.environ.copy(),
+            )
+            try:
+                if proc.stdout:
+                    for line in proc.stdout:
+                        if line:
+                            append(line.rstrip("\n"))
+                proc.wait()
+            except Exception as e:
+                append(f"[Watcher] ERROR: {e}")
+        finally:
+            self._release_warm_container()
         return proc.returncode if proc.returncode is not None else -1
 
-    def handle_cd(self, cmd: str, output_lines: List[str]) -> bool:
+    def handle_cd(self, cmd: str, output_lines: "OutputBuffer") -> bool:
         parts = cmd.strip().split(maxsplit=1)
         if len(parts) == 1 or parts[1] in ("~", "~/", ""):
             target = Path.home()
@@ -289,7 +974,7 @@ class SessionContext:
         output_lines.append(f"{EOC_MARKER_PREFIX}1")
         return False
 
-    def handle_internal(self, cmd: str, output_lines: List[str]) -> Optional[dict]:
+    def handle_internal(self, cmd: str, output_lines: "OutputBuffer", req: Optional[CommandRequest] = None) -> Optional[dict]:
         """内部コマンド処理。ls 結果などがあれば dict で返す"""
         if cmd.startswith("_internal_list_dir::"):
             _, rel = cmd.split("::", 1)
@@ -304,14 +989,13 @@ class SessionContext:
                 errors="replace",
             )
             ls_file = self.base_dir / ".ls_result.txt"
-            if proc.returncode == 0:
-                ls_file.write_text(proc.stdout, encoding="utf-8")
-            else:
-                ls_file.write_text(f"ERROR:\n{proc.stderr}", encoding="utf-8")
+            ls_result = proc.stdout if proc.returncode == 0 else f"ERROR:\n{proc.stderr}"
+            ls_file.write_text(ls_result, encoding="utf-8")
             output_lines.append(f"__LS_DONE__::{rel}")
             output_lines.append(f"{EOC_MARKER_PREFIX}INTERNAL:{proc.returncode}")
-            # 失敗時もファイル本文を返す（ERROR: プレフィックス）。空文字だと Relay 側が成功した空ディレクトリと区別できずフォールバックしない。
-            return {"ls_result": ls_file.read_text(encoding="utf-8")}
+            # 失敗時も本文を返す（ERROR: プレフィックス）。空文字だと Relay 側が成功した空ディレクトリと区別できずフォールバックしない。
+            # 並列実行中の別の一覧で .ls_result.txt が上書きされうるため、読み直さず手元の結果を返す。
+            return {"ls_result": ls_result}
 
         if cmd.startswith("_internal_stage_file_for_download::"):
             parts = cmd.split("::", 2)
@@ -343,12 +1027,7 @@ class SessionContext:
             except Exception:
                 pass
             # 60 秒後に staged ファイルを削除（relay の rsync 取得後を想定）
-            def _cleanup_staged(p: Path) -> None:
-                try:
-                    p.unlink(missing_ok=True)
-                except Exception:
-                    pass
-            threading.Timer(60.0, _cleanup_staged, args=[dest]).start()
+            _staged_expiry.register(dest, STAGED_DOWNLOAD_TTL)
             return out_extra
 
         if cmd.startswith("_internal_move_staged_file::"):
@@ -356,11 +1035,13 @@ class SessionContext:
             rel_path = rel_path.strip()
             _validate_safe_relpath(rel_path)
             staged = self.base_dir / ".staged_uploads" / token
+            # 取り込みに失敗して残った場合も期限で消す（成功時は移動済みなので何もしない）
+            _staged_expiry.register(staged, STAGED_MAX_AGE)
             # RT: staged_content が渡されていれば直接書き込む（rsync 待ち不要）
-            if getattr(self, "_staged_content", None) is not None:
+            if req is not None and req.staged_content is not None:
                 staged.parent.mkdir(parents=True, exist_ok=True)
-                raw = self._staged_content
-                delattr(self, "_staged_content")
+                raw = req.staged_content
+                req.staged_content = None
                 if isinstance(raw, str) and raw.startswith("base64:"):
                     try:
                         staged.write_bytes(base64.b64decode(raw[7:]))
@@ -484,6 +1165,35 @@ class SessionContext:
             output_lines.append(f"{EOC_MARKER_PREFIX}INTERNAL:{proc.returncode}")
             return {}
 
+        if cmd.startswith("_internal_set_runner_config::"):
+            try:
+                config = json.loads(cmd.split("::", 1)[1])
+                if not isinstance(config, dict):
+                    raise ValueError("runner config must be an object")
+                self.set_runner_config(config)
+            except Exception as e:
+                # relay は応答の ok / error で反映できたかを判断する（内部コマンドの exitCode は常に 0 のため）
+                output_lines.append(f"Failed to set runner config: {e}")
+                output_lines.append(f"{EOC_MARKER_PREFIX}INTERNAL:1")
+                return {"ok": False, "error": f"Failed to set runner config: {e}"}
+            output_lines.append(f"{EOC_MARKER_PREFIX}INTERNAL:0")
+            return {"ok": True}
+
+        if cmd.startswith("_internal_read_output::"):
+            # _internal_read_output::<id>::<offset>::<length>
+            parts = cmd.split("::")
+            output_id = parts[1].strip() if len(parts) > 1 else ""
+            try:
+                offset = int(parts[2]) if len(parts) > 2 and parts[2].strip() else 0
+                length = int(parts[3]) if len(parts) > 3 and parts[3].strip() else OUTPUT_READ_MAX_BYTES
+                chunk = read_spilled_output(self.base_dir, output_id, offset, length)
+            except Exception as e:
+                output_lines.append(f"Failed to read output: {e}")
+                output_lines.append(f"{EOC_MARKER_PREFIX}INTERNAL:1")
+                return {}
+            output_lines.append(f"{EOC_MARKER_PREFIX}INTERNAL:0")
+            return {"outputChunk": chunk}
+
         if cmd == "_internal_clear_log":
             log_file = self.base_dir / "commands.log"
             log_file.write_text("", encoding="utf-8")
@@ -526,88 +1236,74 @@ class SessionContext:
                                 deleted += 1
                             except Exception:
                                 failed += 1
-            cmd_file = self.base_dir / "commands.txt"
-            offset_file = self.base_dir / ".commands.offset"
-            try:
-                if cmd_file.exists():
-                    cmd_file.write_text("", encoding="utf-8")
-                if offset_file.exists():
-                    offset_file.write_text("0", encoding="utf-8")
-            except Exception:
-                pass
+            reset_command_file(self.base_dir)
             msg = f"Staged キャッシュを削除しました ({deleted} 件)。commands.txt もリセットしました。" + (f" 削除できず: {failed} 件" if failed else "")
             output_lines.append(msg)
             output_lines.append(f"{EOC_MARKER_PREFIX}INTERNAL:0")
             return {}
 
         if cmd == "_internal_clear_commands":
-            cmd_file = self.base_dir / "commands.txt"
-            offset_file = self.base_dir / ".commands.offset"
-            try:
-                if cmd_file.exists():
-                    cmd_file.write_text("", encoding="utf-8")
-                if offset_file.exists():
-                    offset_file.write_text("0", encoding="utf-8")
-            except Exception:
-                pass
+            reset_command_file(self.base_dir)
             output_lines.append("commands.txt と .commands.offset をクリアしました。")
             output_lines.append(f"{EOC_MARKER_PREFIX}INTERNAL:0")
             return {}
 
         return None
 
-    def execute(self, cmd: str) -> tuple:
-        """コマンドを実行し (output_text, exit_code, extra) を返す"""
-        output_lines: List[str] = []
-        cmd = cmd.strip()
-
-        # Agent からの「ターミナル非表示」専用コマンドプレフィックス
-        silent = False
-        if cmd.startswith("_agent_silent::"):
-            silent = True
-            cmd = cmd.split("::", 1)[1]
-
-        # このコマンドが silent かどうかを覚えておく（最後に _handle_command 側で参照）
-        self.last_silent = silent
-
-        prev_silent = self.silent
-        self.silent = silent
-        try:
-            if not cmd or cmd.startswith("#"):
-                return "\n".join(output_lines), 0, {}
-
-            if cmd.startswith("cd "):
-                self.handle_cd(cmd, output_lines)
-                return "\n".join(output_lines), 0, {}
-
-            extra = self.handle_internal(cmd, output_lines)
-            if extra is not None:
-                return "\n".join(output_lines), 0, extra
-
-            if cmd.strip().startswith("conda activate"):
-                parts = cmd.strip().split(maxsplit=2)
-                rest = (parts[2].strip() if len(parts) > 2 else "") or ""
-                env_name = rest.split()[0] if rest else ""
-                if env_name:
-                    self.conda_env = env_name
-                    self._write_status()
-                else:
-                    output_lines.append("conda activate: 環境名を指定してください")
-                    output_lines.append(f"{EOC_MARKER_PREFIX}1")
-                    return "\n".join(output_lines), 1, {}
-                output_lines.append(f"{EOC_MARKER_PREFIX}0")
-                return "\n".join(output_lines), 0, {}
-            if cmd.strip() == "conda deactivate":
-                self.conda_env = "base" if HAS_CONDA else None
+    def execute(self, req) -> tuple:
+        """コマンドを実行し (output_text, exit_code, extra) を返す。
+        req は CommandRequest（文字列なら包む）。同一セッションでの排他は SessionScheduler が担う。
+        出力は OutputBuffer で先頭と末尾だけを返し、中略した場合は extra に outputId などを付ける"""
+        if not isinstance(req, CommandRequest):
+            req = CommandRequest(str(req))
+        output_lines = OutputBuffer(self.base_dir, streaming=req.output_sink is not None)
+        cmd = req.command
+        try:
+            _output, exit_code, extra = self._execute(req, output_lines)
+            output = output_lines.text()
+        finally:
+            output_lines.close()
+            if cmd and not req.relay_read_only and not cmd.startswith(SEARCH_INDEX_READONLY_PREFIXES):
+                mark_search_index_dirty(self.base_dir)
+        truncated = output_lines.extra()
+        if truncated:
+            extra = {**extra, **truncated}
+        return output, exit_code, extra
+
+    def _execute(self, req: CommandRequest, output_lines: OutputBuffer) -> tuple:
+        cmd = req.command
+        if not cmd or cmd.startswith("#"):
+            return "\n".join(output_lines), 0, {}
+
+        if cmd.startswith("cd "):
+            self.handle_cd(cmd, output_lines)
+            return "\n".join(output_lines), 0, {}
+
+        extra = self.handle_internal(cmd, output_lines, req)
+        if extra is not None:
+            return "\n".join(output_lines), 1 if extra.get("ok") is False else 0, extra
+
+        if cmd.strip().startswith("conda activate"):
+            parts = cmd.strip().split(maxsplit=2)
+            rest = (parts[2].strip() if len(parts) > 2 else "") or ""
+            env_name = rest.split()[0] if rest else ""
+            if env_name:
+                self.conda_env = env_name
                 self._write_status()
-                output_lines.append(f"{EOC_MARKER_PREFIX}0")
-                return "\n".join(output_lines), 0, {}
+            else:
+                output_lines.append("conda activate: 環境名を指定してください")
+                output_lines.append(f"{EOC_MARKER_PREFIX}1")
+                return "\n".join(output_lines), 1, {}
+            output_lines.append(f"{EOC_MARKER_PREFIX}0")
+            return "\n".join(output_lines), 0, {}
+        if cmd.strip() == "conda deactivate":
+            self.conda_env = "base" if HAS_CONDA else None
+            self._write_status()
+            output_lines.append(f"{EOC_MARKER_PREFIX}0")
+            return "\n".join(output_lines), 0, {}
 
-            exit_code = self.run_command(cmd, output_lines)
-            return "\n".join(output_lines), exit_code, {}
-        finally:
-            # 他の通常コマンドに影響しないよう毎回元に戻す
-            self.silent = prev_silent
+        exit_code = self.run_command(cmd, output_lines, req)
+        return "\n".join(output_lines), exit_code, {}
 
 
 # セッションコンテキストのキャッシュ
@@ -633,7 +1329,9 @@ def get_session(base_dir: Path, watcher_id: Optional[str] = None, session_name:
 
 
 def post_log_to_relay(watcher_id: str, session: str, log_text: str) -> bool:
-    """relay の log-append にログを POST"""
+    """relay にログを送る。リレーチャネルが繋がっていればそのフレームで、無ければ log-append に POST"""
+    if _relay_channel is not None and _relay_channel.send_log(watcher_id, session, log_text):
+        return True
     url = RELAY_LOG_URL
     if not url:
         return False
@@ -652,155 +1350,983 @@ def post_log_to_relay(watcher_id: str, session: str, log_text: str) -> bool:
         return False
 
 
-class RTRequestHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        if self.path == "/command" or self.path.startswith("/command?"):
-            self._handle_command()
-        elif self.path == "/gpu-status" or self.path.startswith("/gpu-status?"):
-            self._handle_gpu_status()
-        else:
-            self.send_error(404)
+# ===== Workspace search =====
+RG_EXE = shutil.which("rg")
+SEARCH_MAX_RESULTS = int(os.environ.get("WATCHER_SEARCH_MAX_RESULTS", "2000"))
+SEARCH_MAX_FILE_BYTES = 2_000_000
+SEARCH_PREVIEW_CHARS = 300
+SEARCH_WORKERS = int(os.environ.get("WATCHER_SEARCH_WORKERS", str(min(16, (os.cpu_count() or 2) * 2))))
+# セッションルート直下の Watcher 管理ファイルは検索対象外
+SEARCH_INDEX_FILE = ".search_index.json.gz"
+SEARCH_SESSION_FILES = frozenset({"commands.txt", "commands.log", "python.log", SEARCH_INDEX_FILE, OUTPUT_SPILL_DIR})
+# トライグラム索引（WATCHER_SEARCH_INDEX=0 で無効。リクエストの useIndex で個別に上書き可）
+SEARCH_INDEX_ENABLED = os.environ.get("WATCHER_SEARCH_INDEX", "1") == "1"
+SEARCH_INDEX_REFRESH_SEC = 2.0
+# dirty でなくディレクトリの mtime も変わっていなくても、この間隔ごとには全体を stat し直す（上書き保存の取りこぼし対策）
+SEARCH_INDEX_FULL_REFRESH_SEC = 300.0
+SEARCH_INDEX_SAVE_SEC = 30.0
+# 索引に載せるファイル数・合計バイト数の上限。超えるワークスペースでは索引を使わず rg / Python 検索にする
+SEARCH_INDEX_MAX_FILES = int(os.environ.get("WATCHER_SEARCH_INDEX_MAX_FILES", "200000"))
+SEARCH_INDEX_MAX_BYTES = int(os.environ.get("WATCHER_SEARCH_INDEX_MAX_BYTES", str(1024 * 1024 * 1024)))
+# ファイルを変更しない内部コマンド（実行後に索引を dirty にしない）
+SEARCH_INDEX_READONLY_PREFIXES = (
+    "#", "_internal_list_dir::", "_internal_stage_file_for_download::", "_internal_set_runner_config::",
+    "_internal_read_output::",
+)
+
+try:
+    from re import _parser as _sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parse
+
+
+class SearchOptions:
+    """/search リクエストの検索条件"""
+    def __init__(self, data: dict):
+        self.query: str = str(data.get("query") or "")
+        self.regex: bool = bool(data.get("regex", False))
+        self.case_sensitive: bool = bool(data.get("caseSensitive", False))
+        self.whole_word: bool = bool(data.get("wholeWord", False))
+        self.hidden: bool = bool(data.get("hidden", False))
+        self.rel_path: str = str(data.get("path") or ".").strip().lstrip("/") or "."
+        self.include: List[str] = [str(g) for g in (data.get("include") or []) if str(g).strip()]
+        self.exclude: List[str] = [str(g) for g in (data.get("exclude") or []) if str(g).strip()]
+        try:
+            max_results = int(data.get("maxResults") or SEARCH_MAX_RESULTS)
+        except (TypeError, ValueError):
+            max_results = SEARCH_MAX_RESULTS
+        self.max_results = max(1, min(max_results, SEARCH_MAX_RESULTS))
+        try:
+            self.max_per_file = max(0, int(data.get("maxPerFile") or 0))
+        except (TypeError, ValueError):
+            self.max_per_file = 0
+        use_index = data.get("useIndex")
+        self.use_index: bool = SEARCH_INDEX_ENABLED if use_index is None else bool(use_index)
+
+    def compile(self) -> "re.Pattern[str]":
+        pat = self.query if self.regex else re.escape(self.query)
+        if self.whole_word:
+            pat = rf"\b(?:{pat})\b"
+        return re.compile(pat, 0 if self.case_sensitive else re.IGNORECASE)
+
+
+def _search_preview(line: str, col: int) -> str:
+    """長い行は一致位置の周辺だけを残す"""
+    line = line.rstrip("\r\n")
+    if len(line) <= SEARCH_PREVIEW_CHARS:
+        return line
+    start = max(0, col - SEARCH_PREVIEW_CHARS // 3)
+    return line[start:start + SEARCH_PREVIEW_CHARS]
+
+
+class _GitIgnoreRules:
+    """.gitignore の主要な書式（否定・ディレクトリ限定・アンカー）だけを扱う簡易マッチャ"""
+    def __init__(self, base_rel: str, lines: List[str]):
+        self.base_rel = base_rel
+        self.rules: List[tuple] = []
+        for raw in lines:
+            line = raw.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            line = line.lstrip("/")
+            if line:
+                self.rules.append((line, negate, dir_only, anchored))
+
+    def match(self, rel: str, is_dir: bool) -> Optional[bool]:
+        """ignore 対象なら True、否定ルールで明示的に含めるなら False、該当なしは None"""
+        sub = rel[len(self.base_rel) + 1:] if self.base_rel else rel
+        name = sub.rsplit("/", 1)[-1]
+        result: Optional[bool] = None
+        for pat, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if anchored:
+                hit = fnmatch.fnmatchcase(sub, pat) or fnmatch.fnmatchcase(sub, pat + "/**")
+            else:
+                hit = fnmatch.fnmatchcase(name, pat)
+            if hit:
+                result = not negate
+        return result
 
-    def _handle_gpu_status(self):
-        """nvidia-smi 等を実行し結果を返す。SessionContext は使わず subprocess のみで実行するため、
-        ログが relay に送られずターミナルに一切表示されない。"""
+
+def _search_glob_allowed(rel: str, name: str, opts: SearchOptions) -> bool:
+    if opts.include and not any(fnmatch.fnmatchcase(name, g) or fnmatch.fnmatchcase(rel, g) for g in opts.include):
+        return False
+    if opts.exclude and any(fnmatch.fnmatchcase(name, g) or fnmatch.fnmatchcase(rel, g) for g in opts.exclude):
+        return False
+    return True
+
+
+def _iter_search_files(root: Path, opts: SearchOptions, stop: threading.Event, on_dir=None):
+    """ignore ルールを考慮してセッション配下の検索対象ファイル (rel, Path) を列挙する。
+    on_dir があれば、読む直前の各ディレクトリ (rel, Path) を渡す"""
+    start_rel = "" if opts.rel_path == "." else opts.rel_path.rstrip("/")
+    start = root / start_rel if start_rel else root
+    if start.is_file():
+        yield start_rel, start
+        return
+    stack: List[tuple] = [(start_rel, start, [])]
+    while stack and not stop.is_set():
+        dir_rel, dir_path, parent_rules = stack.pop()
+        if on_dir is not None:
+            on_dir(dir_rel, dir_path)
+        rules = list(parent_rules)
+        gi = dir_path / ".gitignore"
         try:
-            content_len = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_len).decode("utf-8", errors="replace")
-            data = json.loads(body)
+            if gi.is_file():
+                rules.append(_GitIgnoreRules(dir_rel, gi.read_text("utf-8", errors="replace").splitlines()))
+        except OSError:
+            pass
+        try:
+            entries = sorted(os.scandir(dir_path), key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs: List[tuple] = []
+        for entry in entries:
+            name = entry.name
+            if name == ".git" or (name.startswith(".") and not opts.hidden):
+                continue
+            rel = f"{dir_rel}/{name}" if dir_rel else name
+            if not dir_rel and name in SEARCH_SESSION_FILES:
+                continue
+            try:
+                # ディレクトリへのシンボリックリンクはたどらない（rg の既定と同じ。a -> .. のような循環で止まらない）
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and entry.is_symlink() and entry.is_dir():
+                    continue
+            except OSError:
+                continue
+            ignored = False
+            for r in rules:
+                m = r.match(rel, is_dir)
+                if m is not None:
+                    ignored = m
+            if ignored:
+                continue
+            if is_dir:
+                subdirs.append((rel, Path(entry.path), rules))
+                continue
+            if not _search_glob_allowed(rel, name, opts):
+                continue
+            yield rel, Path(entry.path)
+        stack.extend(reversed(subdirs))
+
+
+def _search_file(rel: str, path: Path, pattern: "re.Pattern[str]", max_per_file: int) -> List[dict]:
+    try:
+        if path.stat().st_size > SEARCH_MAX_FILE_BYTES:
+            return []
+        data = path.read_bytes()
+    except OSError:
+        return []
+    if b"\x00" in data[:8192]:
+        return []
+    text = data.decode("utf-8", errors="replace")
+    if not pattern.search(text):
+        return []
+    out: List[dict] = []
+    for lineno, line in enumerate(text.splitlines(), start=1):
+        m = pattern.search(line)
+        if not m:
+            continue
+        out.append({
+            "type": "match",
+            "path": rel,
+            "line": lineno,
+            "column": m.start() + 1,
+            "matchLength": m.end() - m.start(),
+            "preview": _search_preview(line, m.start()),
+        })
+        if max_per_file and len(out) >= max_per_file:
+            break
+    return out
+
+
+def _search_python(root: Path, opts: SearchOptions, emit, files=None, stop: Optional[threading.Event] = None) -> tuple:
+    """Python フォールバック: ファイル列挙と読み込み・照合をスレッドプールで並列化。
+    files を渡すとその (rel, Path) 列だけを照合する（索引で絞り込んだ候補用）"""
+    pattern = opts.compile()
+    stop = stop or threading.Event()
+    if files is None:
+        files = _iter_search_files(root, opts, stop)
+    matches = 0
+    files_matched = 0
+    window = max(1, SEARCH_WORKERS * 4)
+    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as pool:
+        pending: deque = deque()
+
+        def drain(block: bool) -> None:
+            """完了した先頭から順に結果を流す（列挙順を保つ）。block=True なら全件待つ"""
+            nonlocal matches, files_matched
+            while pending and not stop.is_set() and (block or pending[0].done()):
+                results = pending.popleft().result()
+                if not results:
+                    continue
+                files_matched += 1
+                for item in results:
+                    emit(item)
+                    matches += 1
+                    if matches >= opts.max_results:
+                        stop.set()
+                        break
+
+        for rel, path in files:
+            pending.append(pool.submit(_search_file, rel, path, pattern, opts.max_per_file))
+            if len(pending) >= window:
+                # 先頭の完了を待ってから流し、投入済みタスク数を window 内に抑える
+                pending[0].result()
+                drain(block=False)
+            if stop.is_set():
+                break
+        drain(block=True)
+        for fut in pending:
+            fut.cancel()
+    return matches, files_matched, stop.is_set()
+
+
+def _search_ripgrep(root: Path, opts: SearchOptions, emit) -> tuple:
+    """rg --json を起動して結果を逐次変換する。上限に達したらプロセスを止めて打ち切る"""
+    args = [RG_EXE, "--json", "--no-config", "--no-require-git", f"--max-filesize={SEARCH_MAX_FILE_BYTES}"]
+    args.append("-s" if opts.case_sensitive else "-i")
+    if not opts.regex:
+        args.append("-F")
+    if opts.whole_word:
+        args.append("-w")
+    if opts.hidden:
+        args.append("--hidden")
+    if opts.max_per_file:
+        args.append(f"--max-count={opts.max_per_file}")
+    for g in opts.include:
+        args.extend(["-g", g])
+    for g in opts.exclude:
+        args.extend(["-g", f"!{g}"])
+    for name in SEARCH_SESSION_FILES:
+        args.extend(["-g", f"!/{name}"])
+    args.extend(["-e", opts.query, "--", opts.rel_path])
+    proc = subprocess.Popen(args, cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    matches = 0
+    files_matched = 0
+    truncated = False
+    try:
+        assert proc.stdout is not None
+        for raw in proc.stdout:
+            try:
+                ev = json.loads(raw)
+            except ValueError:
+                continue
+            kind = ev.get("type")
+            data = ev.get("data") or {}
+            if kind == "begin":
+                files_matched += 1
+                continue
+            if kind != "match":
+                continue
+            rel = str((data.get("path") or {}).get("text") or "")
+            if rel.startswith("./"):
+                rel = rel[2:]
+            line = str((data.get("lines") or {}).get("text") or "")
+            subs = data.get("submatches") or []
+            byte_start = int(subs[0].get("start", 0)) if subs else 0
+            byte_end = int(subs[0].get("end", byte_start)) if subs else byte_start
+            raw_line = line.encode("utf-8", errors="replace")
+            col = len(raw_line[:byte_start].decode("utf-8", errors="replace"))
+            emit({
+                "type": "match",
+                "path": rel,
+                "line": int(data.get("line_number") or 0),
+                "column": col + 1,
+                "matchLength": len(raw_line[byte_start:byte_end].decode("utf-8", errors="replace")),
+                "preview": _search_preview(line, col),
+            })
+            matches += 1
+            if matches >= opts.max_results:
+                truncated = True
+                break
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+    return matches, files_matched, truncated
+
+
+def _literal_runs(opts: SearchOptions) -> List[str]:
+    """クエリが必ず含む連続リテラル列を取り出す（正規表現は先頭レベルの連接のみ辿る保守的な解析）"""
+    if not opts.regex:
+        return [opts.query]
+    try:
+        parsed = _sre_parse.parse(opts.query)
+    except Exception:
+        return []
+    runs: List[str] = []
+    cur: List[str] = []
+
+    def flush() -> None:
+        if cur:
+            runs.append("".join(cur))
+            cur.clear()
+
+    def walk(items) -> None:
+        for op, av in items:
+            name = str(op)
+            if name == "LITERAL":
+                cur.append(chr(av))
+            elif name == "SUBPATTERN":
+                walk(av[-1])
+            elif name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+                flush()
+                if av[0] >= 1:
+                    walk(av[2])
+                    flush()
+            else:
+                flush()
+
+    walk(parsed)
+    flush()
+    return runs
+
+
+def _text_trigrams(text: str) -> set:
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _query_trigrams(opts: SearchOptions) -> set:
+    """候補ファイルが必ず持つトライグラム集合。空なら索引では絞り込めない"""
+    grams: set = set()
+    for run in _literal_runs(opts):
+        grams |= _text_trigrams(run)
+    return grams
+
+
+def _read_index_trigrams(path: Path) -> frozenset:
+    """索引用にファイルのトライグラムを作る。検索対象外（巨大・バイナリ）は空集合"""
+    try:
+        if path.stat().st_size > SEARCH_MAX_FILE_BYTES:
+            return frozenset()
+        data = path.read_bytes()
+    except OSError:
+        return frozenset()
+    if b"\x00" in data[:8192]:
+        return frozenset()
+    return frozenset(_text_trigrams(data.decode("utf-8", errors="replace")))
+
+
+class TrigramIndex:
+    """セッションルートごとのトライグラム索引。
+    セッションディレクトリに gzip JSON で永続化し、mtime/サイズが変わったファイルだけ読み直して差分更新する。
+    全体の stat し直しは、書き込みうるコマンドの実行後（dirty）・ディレクトリの mtime が変わったとき・
+    SEARCH_INDEX_FULL_REFRESH_SEC ごとだけ。ファイル数・バイト数が上限を超えたら索引は使わない。
+    その場で書き換えられたファイル（実行中のジョブのログ、別の SSH セッションでの編集など）はディレクトリの mtime を
+    変えないため、検索時に対象範囲の索引済みファイルを stat し直し（revalidate）、変わったものはその場で読み直す。
+    大文字小文字を無視した索引なので、検索時は候補を絞るだけで一致判定は通常の照合で行う"""
+    VERSION = 1
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.path = root / SEARCH_INDEX_FILE
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # rel -> (mtime_ns, size, trigrams)
+        self._files: Dict[str, tuple] = {}
+        self._postings: Dict[str, set] = {}
+        self._ready = False
+        self._building = False
+        self._dirty = True
+        self._last_refresh = 0.0
+        self._last_full = 0.0
+        self._last_save = 0.0
+        # 前回の全走査で見たディレクトリの mtime（rel -> mtime_ns）。作成・削除・リネームの検出に使う
+        self._dirs: Dict[str, int] = {}
+        self.over_limit = False
+
+    @property
+    def ready(self) -> bool:
+        return self._ready and not self.over_limit
+
+    def mark_dirty(self) -> None:
+        self._dirty = True
+
+    def ensure_building(self) -> None:
+        """未構築ならバックグラウンドで読み込み/構築を始める"""
+        with self._lock:
+            if self._ready or self._building or self.over_limit:
+                return
+            self._building = True
+        threading.Thread(target=self._build, daemon=True).start()
+
+    def _build(self) -> None:
+        started = time.time()
+        try:
+            self._load()
+            self.refresh(force=True)
+            if self.over_limit:
+                return
+            self._ready = True
+            print(f"[RT] Search index ready: {self.root} ({len(self._files)} files, {time.time() - started:.1f}s)", flush=True)
         except Exception as e:
-            self._send_json(400, {"error": str(e)})
+            print(f"[RT] Search index build failed: {e}", flush=True)
+        finally:
+            self._building = False
+
+    def _add(self, rel: str, entry: tuple) -> None:
+        self._files[rel] = entry
+        for g in entry[2]:
+            self._postings.setdefault(g, set()).add(rel)
+
+    def _remove(self, rel: str) -> None:
+        old = self._files.pop(rel, None)
+        if not old:
             return
+        for g in old[2]:
+            posting = self._postings.get(g)
+            if posting is not None:
+                posting.discard(rel)
+                if not posting:
+                    del self._postings[g]
+
+    def _dirs_changed(self) -> bool:
+        for rel, mtime_ns in self._dirs.items():
+            try:
+                if os.stat(self.root / rel if rel else self.root).st_mtime_ns != mtime_ns:
+                    return True
+            except OSError:
+                return True
+        return False
 
-        session = data.get("session", "")
-        # command が空の場合は nvitop 優先でフォールバック付きコマンドをデフォルトとする
-        command = data.get("command", "").strip()
+    def _needs_walk(self, force: bool) -> bool:
+        if force or self._dirty:
+            return True
+        now = time.time()
+        if now - self._last_refresh < SEARCH_INDEX_REFRESH_SEC:
+            return False
+        if now - self._last_full >= SEARCH_INDEX_FULL_REFRESH_SEC or self._dirs_changed():
+            return True
+        self._last_refresh = now
+        return False
 
-        if not session:
-            self._send_json(400, {"error": "session required"})
+    def _drop_over_limit(self, files: int, total_bytes: int) -> None:
+        self.over_limit = True
+        with self._lock:
+            self._files.clear()
+            self._postings.clear()
+        self._dirs = {}
+        print(f"[RT] Search index disabled for {self.root}: {files} files / {total_bytes} bytes exceed the limit", flush=True)
+
+    def refresh(self, force: bool = False) -> None:
+        """変更を検出し、変わったファイルだけ索引を更新する。
+        dirty でなければ、ディレクトリの mtime だけを見て変化が無い限りファイルの stat はしない"""
+        if self.over_limit or not self._needs_walk(force):
             return
+        with self._refresh_lock:
+            if self.over_limit or not self._needs_walk(force):
+                return
+            self._dirty = False
+            seen: set = set()
+            changed: List[tuple] = []
+            dirs: Dict[str, int] = {}
+
+            def on_dir(rel: str, path: Path) -> None:
+                try:
+                    dirs[rel] = path.stat().st_mtime_ns
+                except OSError:
+                    pass
 
-        local_watcher_dir = Path(os.environ.get("LOCAL_WATCHER_DIR", str(BASE_DIR.parent)))
-        base_dir = local_watcher_dir / session
-        if not base_dir.exists():
+            total_bytes = 0
+            for rel, path in _iter_search_files(self.root, SearchOptions({}), threading.Event(), on_dir=on_dir):
+                seen.add(rel)
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                if st.st_size <= SEARCH_MAX_FILE_BYTES:
+                    total_bytes += st.st_size
+                if len(seen) > SEARCH_INDEX_MAX_FILES or total_bytes > SEARCH_INDEX_MAX_BYTES:
+                    self._drop_over_limit(len(seen), total_bytes)
+                    return
+                old = self._files.get(rel)
+                if old is None or old[0] != st.st_mtime_ns or old[1] != st.st_size:
+                    changed.append((rel, path, st.st_mtime_ns, st.st_size))
+            self._dirs = dirs
+            self._last_full = time.time()
+            removed = [rel for rel in self._files if rel not in seen]
+            if changed:
+                with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as pool:
+                    grams = list(pool.map(lambda c: _read_index_trigrams(c[1]), changed))
+            else:
+                grams = []
+            with self._lock:
+                for rel in removed:
+                    self._remove(rel)
+                for (rel, _path, mtime_ns, size), g in zip(changed, grams):
+                    self._remove(rel)
+                    self._add(rel, (mtime_ns, size, g))
+            self._last_refresh = time.time()
+            if (changed or removed) and (force or time.time() - self._last_save >= SEARCH_INDEX_SAVE_SEC):
+                self._save()
+
+    def walk_age(self) -> float:
+        """最後の全走査からの秒数"""
+        return time.time() - self._last_full if self._last_full else 0.0
+
+    def revalidate(self, keep) -> int:
+        """keep(rel) が真の索引済みファイルを stat し、mtime / サイズが変わったものを読み直す。読み直した数を返す。
+        候補の絞り込みで一致を取りこぼさないよう、検索のたびに呼ぶ（ディレクトリは走査しない）"""
+        with self._lock:
+            entries = [(rel, e[0], e[1]) for rel, e in self._files.items() if keep(rel)]
+
+        def check(item):
+            rel, mtime_ns, size = item
             try:
-                base_dir.mkdir(parents=True, exist_ok=True)
-            except Exception as e:
-                self._send_json(500, {"error": f"failed to create session dir {session}: {e}"})
-                return
-        if not base_dir.is_dir():
-            self._send_json(500, {"error": f"session path is not a directory: {session}"})
-            return
+                st = os.stat(self.root / rel)
+            except OSError:
+                return rel, None
+            if st.st_mtime_ns == mtime_ns and st.st_size == size:
+                return None
+            return rel, (st.st_mtime_ns, st.st_size)
+
+        with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as pool:
+            stale = [r for r in pool.map(check, entries, chunksize=256) if r is not None]
+            changed = [(rel, st) for rel, st in stale if st is not None]
+            grams = list(pool.map(lambda c: _read_index_trigrams(self.root / c[0]), changed))
+        if not stale:
+            return 0
+        with self._lock:
+            for rel, st in stale:
+                self._remove(rel)
+            for (rel, (mtime_ns, size)), g in zip(changed, grams):
+                self._add(rel, (mtime_ns, size, g))
+        return len(stale)
+
+    def candidates(self, trigrams: set) -> List[str]:
+        with self._lock:
+            postings = []
+            for g in trigrams:
+                posting = self._postings.get(g)
+                if not posting:
+                    return []
+                postings.append(posting)
+            postings.sort(key=len)
+            result = set(postings[0])
+            for posting in postings[1:]:
+                result &= posting
+                if not result:
+                    break
+            return sorted(result)
 
-        def run_cmd(cmd: str, timeout_sec: int = 15) -> tuple[str, int]:
+    def _load(self) -> None:
+        if not self.path.is_file():
+            return
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"[RT] Search index load failed (rebuilding): {e}", flush=True)
+            return
+        if data.get("version") != self.VERSION:
+            return
+        with self._lock:
+            for rel, (mtime_ns, size, packed) in (data.get("files") or {}).items():
+                grams = frozenset(packed[i:i + 3] for i in range(0, len(packed), 3))
+                self._add(rel, (int(mtime_ns), int(size), grams))
+
+    def _save(self) -> None:
+        with self._lock:
+            files = {rel: [e[0], e[1], "".join(sorted(e[2]))] for rel, e in self._files.items()}
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=1) as f:
+                json.dump({"version": self.VERSION, "files": files}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._last_save = time.time()
+            # 索引ファイル自身の書き込みでルートの mtime が変わったのを変更とみなさない
+            if "" in self._dirs:
+                self._dirs[""] = self.root.stat().st_mtime_ns
+        except Exception as e:
+            print(f"[RT] Search index save failed: {e}", flush=True)
             try:
-                proc = subprocess.run(
-                    cmd,
-                    shell=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    timeout=timeout_sec,
-                    cwd=base_dir,
-                    encoding="utf-8",
-                    errors="replace",
-                    env=os.environ.copy(),
-                )
-                out = (proc.stdout or "").strip()
-                code = proc.returncode if proc.returncode is not None else -1
-                return out, code
-            except subprocess.TimeoutExpired:
-                return "", -1
-            except Exception as e:
-                return str(e), 1
+                tmp.unlink()
+            except OSError:
+                pass
 
-        output = ""
-        exit_code = 0
-        source = "nvidia-smi"
 
-        if command:
-            output, exit_code = run_cmd(command)
+_search_indexes: Dict[str, TrigramIndex] = {}
+_search_indexes_lock = threading.Lock()
+
+
+def get_search_index(root: Path) -> TrigramIndex:
+    with _search_indexes_lock:
+        key = str(root)
+        if key not in _search_indexes:
+            _search_indexes[key] = TrigramIndex(root)
+        return _search_indexes[key]
+
+
+def mark_search_index_dirty(root: Path) -> None:
+    """ファイルを変更しうる操作の後に呼ぶ。次回検索時に差分更新させる"""
+    index = _search_indexes.get(str(root))
+    if index is not None:
+        index.mark_dirty()
+
+
+def _search_indexed(root: Path, opts: SearchOptions, index: TrigramIndex, trigrams: set, emit) -> tuple:
+    """索引で候補ファイルを絞ってから照合する。(一致数, ファイル数, 打ち切り, 読み直したファイル数) を返す"""
+    index.refresh()
+    start_rel = "" if opts.rel_path == "." else opts.rel_path.rstrip("/")
+
+    def in_scope(rel: str) -> bool:
+        if start_rel and rel != start_rel and not rel.startswith(start_rel + "/"):
+            return False
+        return _search_glob_allowed(rel, rel.rsplit("/", 1)[-1], opts)
+
+    # 索引が古いまま候補を絞ると、書き換わったファイルの一致を黙って落とすので、範囲内は stat で確かめる
+    revalidated = index.revalidate(in_scope)
+    files = [(rel, root / rel) for rel in index.candidates(trigrams) if in_scope(rel)]
+    return (*_search_python(root, opts, emit, files=files), revalidated)
+
+
+def run_workspace_search(root: Path, opts: SearchOptions, emit) -> dict:
+    """ワークスペース検索を実行し、各一致を emit(dict) に渡す。戻り値は done フレーム"""
+    _validate_safe_relpath(opts.rel_path)
+    started = time.time()
+    engine = "rg" if RG_EXE else "python"
+    # 索引は隠しファイルを含まないため hidden 指定時は使わない
+    trigrams = _query_trigrams(opts) if opts.use_index and not opts.hidden else set()
+    index = get_search_index(root) if trigrams else None
+    index_info: dict = {}
+    if index is not None and index.ready:
+        engine = "index"
+        matches, files_matched, truncated, revalidated = _search_indexed(root, opts, index, trigrams, emit)
+        # 索引の鮮度（最後の全走査からの経過と、今回 stat で見つけて読み直したファイル数）
+        index_info = {"indexAgeMs": int(index.walk_age() * 1000), "indexRevalidated": revalidated}
+    else:
+        if index is not None:
+            # 初回は構築を裏で始め、今回は通常検索で返す
+            index.ensure_building()
+        if engine == "rg":
+            matches, files_matched, truncated = _search_ripgrep(root, opts, emit)
         else:
-            # nvitop を先に試し、失敗時は nvidia-smi（GPU + プロセス）
-            output, exit_code = run_cmd("nvitop --snapshot 2>/dev/null", timeout_sec=8)
-            if exit_code == 0 and output.startswith("{"):
-                source = "nvitop"
-            else:
-                gpu_cmd = (
-                    "nvidia-smi --query-gpu=index,name,memory.used,memory.total,utilization.gpu,temperature.gpu "
-                    "--format=csv,noheader,nounits"
-                )
-                proc_cmd = (
-                    "nvidia-smi --query-compute-apps=pid,process_name,used_memory "
-                    "--format=csv,noheader,nounits"
-                )
-                gpu_out, _ = run_cmd(gpu_cmd)
-                proc_out, _ = run_cmd(proc_cmd)
-                output = gpu_out + "\n___PROC___\n" + (proc_out or "").strip()
-                exit_code = 0
+            matches, files_matched, truncated = _search_python(root, opts, emit)
+    return {
+        "type": "done",
+        "matches": matches,
+        "files": files_matched,
+        "truncated": truncated,
+        "engine": engine,
+        **index_info,
+        "elapsedMs": int((time.time() - started) * 1000),
+    }
+
+
+def _resolve_session_dir(session: str, create: bool) -> tuple:
+    """セッション dir を返す。(base_dir, None) または (None, (status, エラー dict))"""
+    if not session:
+        return None, (400, {"error": "session required"})
+    # LOCAL_WATCHER_DIR = セッション親ディレクトリ。セッション dir が無ければ自動作成する。
+    local_watcher_dir = Path(os.environ.get("LOCAL_WATCHER_DIR", str(BASE_DIR.parent)))
+    base_dir = local_watcher_dir / session
+    if not base_dir.exists():
+        if not create:
+            return None, (404, {"error": f"session not found: {session}"})
+        try:
+            base_dir.mkdir(parents=True, exist_ok=True)
+        except Exception as e:
+            return None, (500, {"error": f"failed to create session dir {session}: {e}"})
+    if not base_dir.is_dir():
+        return None, (500, {"error": f"session path is not a directory: {session}"})
+    return base_dir, None
 
-        resp = {"ok": exit_code == 0, "output": output, "exitCode": exit_code, "source": source}
-        self._send_json(200, resp)
 
-    def _handle_command(self):
+def _prepare_command(data: dict) -> tuple:
+    """/command の検証とセッション解決。((status, エラー dict), None) か (None, (ctx, req, watcher_id, session)) を返す"""
+    watcher_id = data.get("watcherId", WATCHER_ID)
+    session = data.get("session", "")
+    command = data.get("command", "")
+
+    cmd_preview = (command[:50] + "..") if len(command) > 50 else command
+    print(f"[RT /command] received watcher={watcher_id} session={session!r} cmd={cmd_preview!r}", flush=True)
+
+    base_dir, err = _resolve_session_dir(session, create=True)
+    if err:
+        return err, None
+
+    ctx = get_session(base_dir, watcher_id=watcher_id, session_name=session)
+    staged_content = None
+    if command.strip().startswith("_internal_move_staged_file::") and "stagedContent" in data:
+        staged_content = data.get("stagedContent") or ""
+    req = CommandRequest(command, staged_content=staged_content, relay_read_only=data.get("readOnly") is True)
+    return None, (ctx, req, watcher_id, session)
+
+
+def _run_prepared_command(ctx: "SessionContext", req: CommandRequest, watcher_id: str, session: str) -> tuple:
+    try:
+        output, exit_code, extra = ctx.scheduler.run(ctx, req)
+    except Exception as e:
+        output = str(e)
+        exit_code = 1
+        extra = {}
+
+    # 逐次送信が一度も行われなかった場合のみ、ここでまとめて送る。
+    # Agent など silent 実行モードのときは、ターミナルには一切流さない。
+    if not req.streamed and not req.silent and output:
+        log_text = output
+        if not log_text.endswith("\n"):
+            log_text += "\n"
+        post_log_to_relay(watcher_id, session, log_text)
+    return output, exit_code, extra
+
+
+def handle_command_payload(data: dict) -> tuple:
+    """/command の本体。HTTP とリレーチャネルの両方から呼ばれる。(status, レスポンス dict) を返す"""
+    err, prepared = _prepare_command(data)
+    if err:
+        return err
+    ctx, req, watcher_id, session = prepared
+    output, exit_code, extra = _run_prepared_command(ctx, req, watcher_id, session)
+
+    resp = {"ok": True, "output": output, "exitCode": exit_code, **extra}
+    out_len = len(output)
+    print(f"[RT /command] responding session={session!r} output_len={out_len} exitCode={exit_code}", flush=True)
+    return 200, resp
+
+
+# ストリーム応答の output フレーム 1 つに詰める上限と、まとめる最大時間
+COMMAND_STREAM_FRAME_CHARS = 32_000
+COMMAND_STREAM_FRAME_SEC = 0.1
+
+
+class OutputFrameWriter:
+    """コマンド出力を output フレームにまとめて送る（行ごとにフレームを作らない）。
+    送信先が切れたら以降の出力は捨て、コマンド自体は最後まで実行させる"""
+
+    def __init__(self, emit):
+        self._emit = emit
+        self._buf: List[str] = []
+        self._size = 0
+        self._last = time.monotonic()
+        self.broken = False
+        self.chars = 0
+
+    def write(self, text: str) -> None:
+        if self.broken:
+            return
+        self._buf.append(text)
+        self._size += len(text) + 1
+        self.chars += len(text) + 1
+        if self._size >= COMMAND_STREAM_FRAME_CHARS or time.monotonic() - self._last >= COMMAND_STREAM_FRAME_SEC:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buf or self.broken:
+            return
+        text = "\n".join(self._buf)
+        self._buf, self._size = [], 0
+        self._last = time.monotonic()
+        self.send({"type": "output", "text": text})
+
+    def send(self, frame: dict) -> None:
+        if self.broken:
+            return
+        try:
+            self._emit(frame)
+        except (OSError, BrokenPipeError, ConnectionResetError) as e:
+            print(f"[RT /command] stream receiver gone, dropping further output: {e}", flush=True)
+            self.broken = True
+
+
+def prepare_command_stream(data: dict) -> tuple:
+    """/command のストリーム版（stream: true）。(status, エラー dict) か (None, 実行関数) を返す。
+    出力は output フレームで逐次返し、最後に exit フレーム（exitCode と extra）を返す"""
+    err, prepared = _prepare_command(data)
+    if err:
+        return err
+    ctx, req, watcher_id, session = prepared
+
+    def run(emit) -> None:
+        writer = OutputFrameWriter(emit)
+        req.output_sink = writer.write
+        output, exit_code, extra = _run_prepared_command(ctx, req, watcher_id, session)
+        # 溜めずに流した分以外（内部コマンドの結果・終了マーカーなど）はここで送る
+        if output:
+            writer.write(output)
+        writer.flush()
+        writer.send({"type": "exit", "ok": True, "exitCode": exit_code, **extra})
+        print(
+            f"[RT /command] stream finished session={session!r} output_chars={writer.chars} exitCode={exit_code}",
+            flush=True,
+        )
+
+    return None, run
+
+
+def handle_gpu_status_payload(data: dict) -> tuple:
+    """nvidia-smi 等を実行し結果を返す。SessionContext は使わず subprocess のみで実行するため、
+    ログが relay に送られずターミナルに一切表示されない。"""
+    session = data.get("session", "")
+    # command が空の場合は nvitop 優先でフォールバック付きコマンドをデフォルトとする
+    command = data.get("command", "").strip()
+
+    base_dir, err = _resolve_session_dir(session, create=True)
+    if err:
+        return err
+
+    def run_cmd(cmd: str, timeout_sec: int = 15) -> tuple[str, int]:
+        try:
+            proc = subprocess.run(
+                cmd,
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                timeout=timeout_sec,
+                cwd=base_dir,
+                encoding="utf-8",
+                errors="replace",
+                env=os.environ.copy(),
+            )
+            out = (proc.stdout or "").strip()
+            code = proc.returncode if proc.returncode is not None else -1
+            return out, code
+        except subprocess.TimeoutExpired:
+            return "", -1
+        except Exception as e:
+            return str(e), 1
+
+    output = ""
+    exit_code = 0
+    source = "nvidia-smi"
+
+    if command:
+        output, exit_code = run_cmd(command)
+    else:
+        # nvitop を先に試し、失敗時は nvidia-smi（GPU + プロセス）
+        output, exit_code = run_cmd("nvitop --snapshot 2>/dev/null", timeout_sec=8)
+        if exit_code == 0 and output.startswith("{"):
+            source = "nvitop"
+        else:
+            gpu_cmd = (
+                "nvidia-smi --query-gpu=index,name,memory.used,memory.total,utilization.gpu,temperature.gpu "
+                "--format=csv,noheader,nounits"
+            )
+            proc_cmd = (
+                "nvidia-smi --query-compute-apps=pid,process_name,used_memory "
+                "--format=csv,noheader,nounits"
+            )
+            gpu_out, _ = run_cmd(gpu_cmd)
+            proc_out, _ = run_cmd(proc_cmd)
+            output = gpu_out + "\n___PROC___\n" + (proc_out or "").strip()
+            exit_code = 0
+
+    return 200, {"ok": exit_code == 0, "output": output, "exitCode": exit_code, "source": source}
+
+
+def prepare_search_payload(data: dict) -> tuple:
+    """/search の検証。(status, エラー dict) か (None, 実行関数) を返す。実行関数は emit(dict) を受け取る"""
+    session = data.get("session", "")
+    if not session:
+        return 400, {"error": "session required"}
+    opts = SearchOptions(data)
+    if not opts.query:
+        return 400, {"error": "query required"}
+    try:
+        _validate_safe_relpath(opts.rel_path)
+        opts.compile()
+    except (ValueError, re.error) as e:
+        return 400, {"error": str(e)}
+    base_dir, err = _resolve_session_dir(session, create=False)
+    if err:
+        return err
+    ctx = get_session(base_dir, watcher_id=data.get("watcherId", WATCHER_ID), session_name=session)
+
+    def run(emit) -> None:
+        try:
+            # 読み取り専用レーンで実行（同時検索数を抑え、実行中のコマンドは待たない）
+            with ctx.scheduler.readonly:
+                done = run_workspace_search(base_dir, opts, emit)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        except Exception as e:
+            done = {"type": "error", "error": str(e)}
+        try:
+            emit(done)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    return None, run
+
+
+class RTRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics" or self.path.startswith("/metrics?"):
+            self._send_json(200, watcher_metrics())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path == "/command" or self.path.startswith("/command?"):
+            self._handle_command()
+        elif self.path == "/search" or self.path.startswith("/search?"):
+            self._handle_search()
+        elif self.path == "/gpu-status" or self.path.startswith("/gpu-status?"):
+            self._handle_json(handle_gpu_status_payload)
+        else:
+            self.send_error(404)
+
+    def _read_json_body(self) -> Optional[dict]:
         try:
             content_len = int(self.headers.get("Content-Length", 0))
             body = self.rfile.read(content_len).decode("utf-8", errors="replace")
-            data = json.loads(body)
+            return json.loads(body)
         except Exception as e:
             self._send_json(400, {"error": str(e)})
-            return
+            return None
 
-        watcher_id = data.get("watcherId", WATCHER_ID)
-        session = data.get("session", "")
-        command = data.get("command", "")
+    def _handle_json(self, handler) -> None:
+        data = self._read_json_body()
+        if data is None:
+            return
+        status, resp = handler(data)
+        self._send_json(status, resp)
 
-        cmd_preview = (command[:50] + "..") if len(command) > 50 else command
-        print(f"[RT /command] received watcher={watcher_id} session={session!r} cmd={cmd_preview!r}", flush=True)
+    def _handle_command(self):
+        """stream: true（または ?stream=1）なら出力を NDJSON で逐次返す。それ以外は従来どおり 1 つの JSON"""
+        data = self._read_json_body()
+        if data is None:
+            return
+        if not (data.get("stream") or "stream=1" in self.path):
+            status, resp = handle_command_payload(data)
+            self._send_json(status, resp)
+            return
+        self._send_ndjson(*prepare_command_stream(data))
 
-        if not session:
-            self._send_json(400, {"error": "session required"})
+    def _handle_search(self):
+        """ワークスペース全文検索。結果は NDJSON で一致ごとに逐次返す（最後に done フレーム）"""
+        data = self._read_json_body()
+        if data is None:
             return
+        self._send_ndjson(*prepare_search_payload(data))
 
-        # LOCAL_WATCHER_DIR = セッション親ディレクトリ。セッション dir が無ければ自動作成する。
-        local_watcher_dir = Path(os.environ.get("LOCAL_WATCHER_DIR", str(BASE_DIR.parent)))
-        base_dir = local_watcher_dir / session
-        if not base_dir.exists():
-            try:
-                base_dir.mkdir(parents=True, exist_ok=True)
-            except Exception as e:
-                self._send_json(500, {"error": f"failed to create session dir {session}: {e}"})
-                return
-        if not base_dir.is_dir():
-            self._send_json(500, {"error": f"session path is not a directory: {session}"})
+    def _send_ndjson(self, status, result) -> None:
+        """prepare_* の結果を NDJSON ストリームで返す（接続を閉じて終端を示す）"""
+        if status is not None:
+            self._send_json(status, result)
             return
 
-        ctx = get_session(base_dir, watcher_id=watcher_id, session_name=session)
-        ctx.streamed = False
-        if command.strip().startswith("_internal_move_staged_file::") and "stagedContent" in data:
-            ctx._staged_content = data.get("stagedContent") or ""
-        try:
-            output, exit_code, extra = ctx.execute(command)
-        except Exception as e:
-            output = str(e)
-            exit_code = 1
-            extra = {}
-        finally:
-            if getattr(ctx, "_staged_content", None) is not None:
-                delattr(ctx, "_staged_content")
-
-        # 逐次送信が一度も行われなかった場合のみ、ここでまとめて送る。
-        # Agent など silent 実行モードのときは、ターミナルには一切流さない。
-        if RELAY_LOG_URL and not ctx.streamed and not getattr(ctx, "last_silent", False):
-            log_text = output
-            if not log_text.endswith("\n"):
-                log_text += "\n"
-            post_log_to_relay(watcher_id, session, log_text)
-
-        resp = {"ok": True, "output": output, "exitCode": exit_code, **extra}
-        out_len = len(output)
-        print(f"[RT /command] responding session={session!r} output_len={out_len} exitCode={exit_code}", flush=True)
-        self._send_json(200, resp)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+
+        def emit(frame: dict) -> None:
+            self.wfile.write((json.dumps(frame, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+        result(emit)
 
     def _send_json(self, status: int, data: dict):
         body = json.dumps(data, ensure_ascii=False).encode("utf-8")
@@ -814,99 +2340,1136 @@ class RTRequestHandler(BaseHTTPRequestHandler):
         pass
 
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    daemon_threads = True
+# ===== Worker pool / admission control =====
+HTTP_WORKERS = int(os.environ.get("WATCHER_HTTP_WORKERS", "16"))
+# うち対話系（ファイル操作・一覧・検索）専用に確保するワーカー数。長いコマンドで埋まっても対話系は止まらない
+HTTP_RESERVED_INTERACTIVE = int(os.environ.get("WATCHER_HTTP_RESERVED_INTERACTIVE", "4"))
+HTTP_QUEUE_LIMITS = {
+    "interactive": int(os.environ.get("WATCHER_HTTP_QUEUE_INTERACTIVE", "64")),
+    "command": int(os.environ.get("WATCHER_HTTP_QUEUE_COMMAND", "16")),
+}
+HTTP_RETRY_AFTER_SEC = 1
+# 優先度判定でリクエスト先頭を待つ上限（relay は接続直後に送るので通常は即座に読める）。
+# 待つのは受付スレッドではなく RequestClassifier のスレッドで、届かなければ command レーンに回す
+HTTP_CLASSIFY_TIMEOUT = 0.5
+INTERACTIVE_PATHS = ("/search", "/gpu-status", "/metrics")
+
+
+def classify_path(path: str) -> str:
+    return "interactive" if path.split("?", 1)[0] in INTERACTIVE_PATHS else "command"
+
+
+def classify_request_head(head: bytes) -> str:
+    """リクエスト先頭（要求行とヘッダ）から優先度レーンを決める。
+    X-RT-Priority ヘッダがあればそれに従い、無ければ /command 以外を対話系とみなす"""
+    text = head.decode("latin-1", errors="replace")
+    lines = text.split("\r\n")
+    for line in lines[1:]:
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "x-rt-priority":
+            value = value.strip().lower()
+            if value in HTTP_QUEUE_LIMITS:
+                return value
+    parts = lines[0].split(" ") if lines else []
+    return classify_path(parts[1] if len(parts) >= 2 else "")
+
+
+class WorkerPool:
+    """固定数のワーカーと優先度別の有限キュー。HTTP サーバとリレーチャネルで共有する。
+    一部のワーカーは対話系レーン専用にして、長いコマンドで埋まっても対話系を止めない"""
+
+    def __init__(self, workers: int = HTTP_WORKERS, reserved_interactive: int = HTTP_RESERVED_INTERACTIVE):
+        workers = max(2, workers)
+        reserved_interactive = max(1, min(reserved_interactive, workers - 1))
+        self._cond = threading.Condition()
+        self._queues: Dict[str, deque] = {lane: deque() for lane in HTTP_QUEUE_LIMITS}
+        self._active: Dict[str, int] = {lane: 0 for lane in HTTP_QUEUE_LIMITS}
+        self._stats: Dict[str, dict] = {
+            lane: {"handled": 0, "rejected": 0, "waitMsTotal": 0.0, "waitMsMax": 0.0}
+            for lane in HTTP_QUEUE_LIMITS
+        }
+        self._workers = workers
+        self._reserved_interactive = reserved_interactive
+        for i in range(workers):
+            threading.Thread(
+                target=self._worker_loop, args=(i < reserved_interactive,), daemon=True, name=f"rt-worker-{i}"
+            ).start()
+
+    def submit(self, lane: str, job) -> bool:
+        """job() をキューに積む。満杯なら False（呼び出し側で即座に busy を返す）"""
+        if lane not in self._queues:
+            lane = "command"
+        with self._cond:
+            queue = self._queues[lane]
+            if len(queue) >= HTTP_QUEUE_LIMITS[lane]:
+                self._stats[lane]["rejected"] += 1
+                return False
+            queue.append((job, time.monotonic()))
+            self._cond.notify_all()
+            return True
+
+    def _next_job(self, interactive_only: bool) -> tuple:
+        with self._cond:
+            while True:
+                if self._queues["interactive"]:
+                    lane = "interactive"
+                    break
+                if not interactive_only and self._queues["command"]:
+                    lane = "command"
+                    break
+                self._cond.wait()
+            job, enqueued = self._queues[lane].popleft()
+            self._active[lane] += 1
+            wait_ms = (time.monotonic() - enqueued) * 1000
+            st = self._stats[lane]
+            st["waitMsTotal"] += wait_ms
+            st["waitMsMax"] = max(st["waitMsMax"], wait_ms)
+        return lane, job
+
+    def _worker_loop(self, interactive_only: bool) -> None:
+        while True:
+            lane, job = self._next_job(interactive_only)
+            try:
+                job()
+            except Exception as e:
+                print(f"[RT] Worker job failed: {e}", flush=True)
+            finally:
+                with self._cond:
+                    self._active[lane] -= 1
+                    self._stats[lane]["handled"] += 1
+
+    def metrics(self) -> dict:
+        with self._cond:
+            lanes = {}
+            for lane, st in self._stats.items():
+                dequeued = st["handled"] + self._active[lane]
+                lanes[lane] = {
+                    "queued": len(self._queues[lane]),
+                    "queueLimit": HTTP_QUEUE_LIMITS[lane],
+                    "active": self._active[lane],
+                    "handled": st["handled"],
+                    "rejected": st["rejected"],
+                    "waitMsAvg": round(st["waitMsTotal"] / dequeued, 1) if dequeued else 0.0,
+                    "waitMsMax": round(st["waitMsMax"], 1),
+                }
+            return {
+                "workers": self._workers,
+                "reservedInteractive": self._reserved_interactive,
+                "lanes": lanes,
+            }
+
+
+_worker_pool: Optional[WorkerPool] = None
+_worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool() -> WorkerPool:
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = WorkerPool()
+        return _worker_pool
+
+
+def watcher_metrics() -> dict:
+    data = get_worker_pool().metrics()
+    data["channel"] = _relay_channel.status() if _relay_channel is not None else None
+    return data
+
+
+def _peek_request_head(request) -> Optional[bytes]:
+    """待たずにリクエスト先頭を覗く。まだ何も届いていなければ None（切断・エラーは空 bytes）"""
+    try:
+        request.setblocking(False)
+        return request.recv(4096, socket.MSG_PEEK)
+    except BlockingIOError:
+        return None
+    except OSError:
+        return b""
+    finally:
+        try:
+            request.setblocking(True)
+        except OSError:
+            pass
+
+
+class RequestClassifier:
+    """接続直後にまだ先頭が届いていないソケットを受け取り、届くか HTTP_CLASSIFY_TIMEOUT が過ぎるまで
+    selector でまとめて待ってからレーンを決める。受付スレッドは黙ったクライアントで止まらない"""
+
+    def __init__(self, dispatch):
+        self._dispatch = dispatch
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        self._incoming: List[tuple] = []
+        # ソケット -> (client_address, 期限)
+        self._waiting: dict = {}
+        threading.Thread(target=self._loop, daemon=True, name="rt-classifier").start()
+
+    def add(self, request, client_address) -> None:
+        with self._lock:
+            self._incoming.append((request, client_address, time.monotonic() + HTTP_CLASSIFY_TIMEOUT))
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _finish(self, request) -> None:
+        client_address, _deadline = self._waiting.pop(request)
+        self._selector.unregister(request)
+        head = _peek_request_head(request)
+        self._dispatch(classify_request_head(head or b""), request, client_address)
+
+    def _loop(self) -> None:
+        while True:
+            timeout = None
+            if self._waiting:
+                timeout = max(0.0, min(d for _a, d in self._waiting.values()) - time.monotonic())
+            for key, _mask in self._selector.select(timeout):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                if key.fileobj in self._waiting:
+                    self._finish(key.fileobj)
+            with self._lock:
+                incoming, self._incoming = self._incoming, []
+            for request, client_address, deadline in incoming:
+                try:
+                    self._selector.register(request, selectors.EVENT_READ)
+                except (OSError, ValueError):
+                    self._dispatch("command", request, client_address)
+                    continue
+                self._waiting[request] = (client_address, deadline)
+            now = time.monotonic()
+            for request in [r for r, (_a, d) in self._waiting.items() if d <= now]:
+                # 期限までに何も届かなければ command レーン（届かないままならワーカー側でタイムアウトする）
+                self._finish(request)
+
+
+class PooledHTTPServer(HTTPServer):
+    """WorkerPool で処理する HTTP サーバ（1 リクエスト 1 スレッドにしない）。
+    キューが満杯なら即座に 503 + Retry-After を返す。受付スレッドはリクエスト先頭を待たずに覗くだけで、
+    まだ届いていない接続は RequestClassifier に渡す"""
+
+    def __init__(self, server_address, handler_class, pool: Optional[WorkerPool] = None):
+        super().__init__(server_address, handler_class)
+        self.pool = pool or get_worker_pool()
+        self.classifier = RequestClassifier(self._dispatch)
+
+    def process_request(self, request, client_address):
+        head = _peek_request_head(request)
+        if head is None:
+            self.classifier.add(request, client_address)
+            return
+        self._dispatch(classify_request_head(head), request, client_address)
+
+    def _dispatch(self, lane: str, request, client_address) -> None:
+        if self.pool.submit(lane, lambda: self._process(request, client_address)):
+            return
+        print(f"[RT] Rejecting {lane} request from {client_address[0]}: queue full", flush=True)
+        self._reject(request)
+        self.shutdown_request(request)
+
+    def _process(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def _reject(self, request) -> None:
+        body = json.dumps({"error": "watcher busy", "retryAfterSec": HTTP_RETRY_AFTER_SEC}).encode("utf-8")
+        head = (
+            "HTTP/1.0 503 Service Unavailable\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Retry-After: {HTTP_RETRY_AFTER_SEC}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1")
+        try:
+            request.sendall(head + body)
+            request.shutdown(socket.SHUT_WR)
+            # 未読の本文を残して close すると RST になりクライアントが 503 を読めないため、短時間だけ読み捨てる
+            request.settimeout(0.05)
+            drained = 0
+            while drained < 8 * 1024 * 1024:
+                chunk = request.recv(65536)
+                if not chunk:
+                    break
+                drained += len(chunk)
+        except OSError:
+            pass
+
+    def metrics(self) -> dict:
+        return watcher_metrics()
+
+
+# ===== Relay channel =====
+# Watcher から relay へ張る常設 WebSocket。relay → Watcher のリクエスト、その応答・ストリーム、
+# Watcher → relay のログやステータス通知を 1 本で多重化する（リバーストンネルのポートが無くても動く）。
+# フレームは JSON テキスト。ストリーム応答（検索など）は relay が credit で送信量を制御する。
+CHANNEL_ENABLED = os.environ.get("WATCHER_CHANNEL", "1") == "1"
+CHANNEL_URL = os.environ.get("RT_CHANNEL_URL")  # 未設定なら RT_RELAY_LOG_URL から導出
+CHANNEL_PING_SEC = 20.0
+CHANNEL_RECONNECT_MAX_SEC = 30.0
+# relay から credit が届かないまま待つ上限（超えたらストリームを打ち切る）
+CHANNEL_CREDIT_TIMEOUT_SEC = 60.0
+# relay が credit を指定しなかったときの初期送信枠（data フレーム数）
+CHANNEL_INITIAL_CREDIT = 16
+
+
+def _channel_url() -> Optional[str]:
+    if CHANNEL_URL:
+        return CHANNEL_URL.replace("{wid}", WATCHER_ID)
+    if not RELAY_LOG_URL:
+        return None
+    base = RELAY_LOG_URL.rstrip("/")
+    if base.startswith("https://"):
+        base = "wss://" + base[len("https://"):]
+    elif base.startswith("http://"):
+        base = "ws://" + base[len("http://"):]
+    return f"{base}/watchers/{WATCHER_ID}/channel"
+
+
+def _ws_mask(data: bytes, key: bytes) -> bytes:
+    if not data:
+        return data
+    n = len(data)
+    k = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(k, "big")).to_bytes(n, "big")
+
+
+class _WebSocketClient:
+    """RFC 6455 の最小クライアント（テキスト・ping/pong・close のみ。標準ライブラリだけで動かすため自前実装）"""
+
+    def __init__(self, url: str, timeout: float = 10.0):
+        parsed = urllib.parse.urlsplit(url)
+        secure = parsed.scheme == "wss"
+        host = parsed.hostname or "127.0.0.1"
+        port = parsed.port or (443 if secure else 80)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        sock = socket.create_connection((host, port), timeout=timeout)
+        if secure:
+            import ssl
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        key = base64.b64encode(os.urandom(16)).decode("ascii")
+        request = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        )
+        sock.sendall(request.encode("latin-1"))
+        self._sock = sock
+        self._buf = b""
+        head = self._read_until(b"\r\n\r\n").decode("latin-1", errors="replace")
+        status_line = head.split("\r\n", 1)[0]
+        if " 101 " not in status_line + " ":
+            sock.close()
+            raise ConnectionError(f"websocket handshake failed: {status_line}")
+        expected = base64.b64encode(
+            hashlib.sha1((key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode("ascii")).digest()
+        ).decode("ascii")
+        if expected not in head:
+            sock.close()
+            raise ConnectionError("websocket handshake failed: bad accept key")
+        sock.settimeout(None)
+        self._send_lock = threading.Lock()
+
+    def _read_until(self, marker: bytes) -> bytes:
+        while marker not in self._buf:
+            chunk = self._sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("connection closed during handshake")
+            self._buf += chunk
+        head, self._buf = self._buf.split(marker, 1)
+        return head
+
+    def _read_exact(self, n: int) -> bytes:
+        while len(self._buf) < n:
+            chunk = self._sock.recv(max(65536, n - len(self._buf)))
+            if not chunk:
+                raise ConnectionError("connection closed")
+            self._buf += chunk
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+    def _send_frame(self, opcode: int, payload: bytes) -> None:
+        header = bytearray([0x80 | opcode])
+        n = len(payload)
+        if n < 126:
+            header.append(0x80 | n)
+        elif n < 65536:
+            header.append(0x80 | 126)
+            header += n.to_bytes(2, "big")
+        else:
+            header.append(0x80 | 127)
+            header += n.to_bytes(8, "big")
+        key = os.urandom(4)
+        with self._send_lock:
+            self._sock.sendall(bytes(header) + key + _ws_mask(payload, key))
+
+    def send_text(self, text: str) -> None:
+        self._send_frame(0x1, text.encode("utf-8"))
+
+    def ping(self) -> None:
+        self._send_frame(0x9, b"")
+
+    def recv_text(self) -> Optional[str]:
+        """テキストメッセージを 1 つ返す。close を受けたら None"""
+        message = b""
+        while True:
+            b1, b2 = self._read_exact(2)
+            fin, opcode = b1 & 0x80, b1 & 0x0F
+            n = b2 & 0x7F
+            if n == 126:
+                n = int.from_bytes(self._read_exact(2), "big")
+            elif n == 127:
+                n = int.from_bytes(self._read_exact(8), "big")
+            mask = self._read_exact(4) if b2 & 0x80 else None
+            payload = self._read_exact(n)
+            if mask:
+                payload = _ws_mask(payload, mask)
+            if opcode == 0x8:
+                return None
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+            message += payload
+            if fin:
+                return message.decode("utf-8", errors="replace")
+
+    def close(self) -> None:
+        try:
+            self._send_frame(0x8, b"")
+        except OSError:
+            pass
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+
+class _StreamCredit:
+    """ストリームごとの送信枠。relay から credit フレームで枠が補充される"""
+
+    def __init__(self, initial: int):
+        self._cond = threading.Condition()
+        self._credit = initial
+        self.cancelled = False
+
+    def grant(self, n: int) -> None:
+        with self._cond:
+            self._credit += n
+            self._cond.notify_all()
+
+    def cancel(self) -> None:
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify_all()
+
+    def acquire(self) -> None:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._credit > 0 or self.cancelled, timeout=CHANNEL_CREDIT_TIMEOUT_SEC):
+                raise BrokenPipeError("stream credit timeout")
+            if self.cancelled:
+                raise BrokenPipeError("stream cancelled by relay")
+            self._credit -= 1
+
+
+class RelayChannel:
+    """relay への常設チャネル。切断時は指数バックオフで張り直す"""
+
+    def __init__(self, url: str, pool: WorkerPool):
+        self.url = url
+        self.pool = pool
+        self._ws: Optional[_WebSocketClient] = None
+        self._lock = threading.Lock()
+        self._streams: Dict[str, _StreamCredit] = {}
+        self._connected_at: Optional[float] = None
+        self._connects = 0
+        self._frames_in = 0
+        self._frames_out = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None
+
+    @property
+    def connection_id(self) -> int:
+        """接続ごとに変わる番号（relay 側の状態が引き継がれているかの判定用）"""
+        return self._connects
+
+    def status(self) -> dict:
+        return {
+            "url": self.url,
+            "connected": self.connected,
+            "connectedAt": self._connected_at,
+            "connects": self._connects,
+            "framesIn": self._frames_in,
+            "framesOut": self._frames_out,
+            "openStreams": len(self._streams),
+        }
+
+    def start(self) -> None:
+        threading.Thread(target=self._run_forever, daemon=True, name="relay-channel").start()
+        threading.Thread(target=self._ping_loop, daemon=True, name="relay-channel-ping").start()
+
+    def send(self, frame: dict) -> bool:
+        ws = self._ws
+        if ws is None:
+            return False
+        try:
+            ws.send_text(json.dumps(frame, ensure_ascii=False))
+            self._frames_out += 1
+            return True
+        except OSError as e:
+            print(f"[RT] Channel send failed: {e}", flush=True)
+            self._drop(ws)
+            return False
+
+    def send_log(self, watcher_id: str, session: str, text: str) -> bool:
+        return self.send({"type": "log", "watcherId": watcher_id, "session": session, "text": text})
+
+    def _drop(self, ws: _WebSocketClient) -> None:
+        with self._lock:
+            if self._ws is ws:
+                self._ws = None
+                self._connected_at = None
+            streams = list(self._streams.values())
+            self._streams.clear()
+        for credit in streams:
+            credit.cancel()
+        ws.close()
+
+    def _run_forever(self) -> None:
+        backoff = 1.0
+        while True:
+            try:
+                ws = _WebSocketClient(self.url)
+            except Exception as e:
+                print(f"[RT] Channel connect failed ({self.url}): {e}", flush=True)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, CHANNEL_RECONNECT_MAX_SEC)
+                continue
+            backoff = 1.0
+            with self._lock:
+                self._ws = ws
+                self._connected_at = time.time()
+                self._connects += 1
+            print(f"[RT] Channel connected: {self.url}", flush=True)
+            self.send({
+                "type": "hello",
+                "watcherId": WATCHER_ID,
+                "displayName": os.environ.get("DISPLAY_NAME", WATCHER_ID),
+                "rtPort": RT_HTTP_PORT,
+                "heartbeatSec": HEARTBEAT_SEC,
+            })
+            _status_pusher.resend_all()
+            try:
+                while True:
+                    text = ws.recv_text()
+                    if text is None:
+                        break
+                    self._frames_in += 1
+                    try:
+                        frame = json.loads(text)
+                    except ValueError:
+                        continue
+                    self._on_frame(frame)
+            except (OSError, ConnectionError) as e:
+                print(f"[RT] Channel disconnected: {e}", flush=True)
+            self._drop(ws)
+            time.sleep(backoff)
+
+    def _ping_loop(self) -> None:
+        while True:
+            time.sleep(CHANNEL_PING_SEC)
+            ws = self._ws
+            if ws is not None:
+                try:
+                    ws.ping()
+                except OSError:
+                    self._drop(ws)
+
+    def _on_frame(self, frame: dict) -> None:
+        kind = frame.get("type")
+        stream_id = str(frame.get("id", ""))
+        if kind == "request":
+            lane = frame.get("priority") or classify_path(str(frame.get("path", "")))
+            if not self.pool.submit(lane, lambda: self._serve(frame)):
+                self.send({
+                    "type": "response", "id": frame.get("id"), "status": 503,
+                    "body": {"error": "watcher busy", "retryAfterSec": HTTP_RETRY_AFTER_SEC},
+                })
+        elif kind == "credit":
+            credit = self._streams.get(stream_id)
+            if credit is not None:
+                credit.grant(int(frame.get("credit") or 0))
+        elif kind == "cancel":
+            credit = self._streams.get(stream_id)
+            if credit is not None:
+                credit.cancel()
+
+    def _serve(self, frame: dict) -> None:
+        req_id = frame.get("id")
+        path = str(frame.get("path", "")).split("?", 1)[0]
+        body = frame.get("body") or {}
+        try:
+            if path == "/command" and body.get("stream"):
+                status, result = prepare_command_stream(body)
+                if status is None:
+                    self._serve_stream(req_id, int(frame.get("credit") or CHANNEL_INITIAL_CREDIT), result)
+                    return
+                resp = result
+            elif path == "/command":
+                status, resp = handle_command_payload(body)
+            elif path == "/gpu-status":
+                status, resp = handle_gpu_status_payload(body)
+            elif path == "/metrics":
+                status, resp = 200, watcher_metrics()
+            elif path == "/search":
+                status, result = prepare_search_payload(body)
+                if status is None:
+                    self._serve_stream(req_id, int(frame.get("credit") or CHANNEL_INITIAL_CREDIT), result)
+                    return
+                resp = result
+            else:
+                status, resp = 404, {"error": f"unknown path: {path}"}
+        except Exception as e:
+            status, resp = 500, {"error": str(e)}
+        self.send({"type": "response", "id": req_id, "status": status, "body": resp})
+
+    def _serve_stream(self, req_id, initial_credit: int, run) -> None:
+        """ストリーム応答: response(stream) → data... → end。data は credit の範囲でだけ送る"""
+        credit = _StreamCredit(initial_credit)
+        key = str(req_id)
+        self._streams[key] = credit
+        try:
+            if not self.send({"type": "response", "id": req_id, "status": 200, "stream": True}):
+                return
+
+            def emit(item: dict) -> None:
+                credit.acquire()
+                if not self.send({"type": "data", "id": req_id, "data": item}):
+                    raise BrokenPipeError("channel closed")
+
+            run(emit)
+            self.send({"type": "end", "id": req_id})
+        finally:
+            self._streams.pop(key, None)
+
+
+_relay_channel: Optional[RelayChannel] = None
+
+
+def start_relay_channel() -> Optional[RelayChannel]:
+    global _relay_channel
+    url = _channel_url()
+    if not CHANNEL_ENABLED or not url:
+        return None
+    _relay_channel = RelayChannel(url, get_worker_pool())
+    _relay_channel.start()
+    return _relay_channel
+
+
+# ===== Status push =====
+# 状態の送信に失敗したセッションを送り直すまでの間隔
+STATUS_RETRY_SEC = 10.0
+
+
+class StatusPusher:
+    """セッション状態（cwd・conda 環境など）を relay のキャッシュへ送る。
+    送信は専用スレッドで行い、同じセッションの連続した更新は最新だけを送る。
+    チャネルでは前回送った内容から変わったキーだけを送り、再接続後の最初の 1 回は全体を送る。
+    送れなかったセッションは STATUS_RETRY_SEC 後にその時点の最新を全体で送り直す（relay に古い値を残さない）"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending: Dict[tuple, dict] = {}
+        self._latest: Dict[tuple, dict] = {}
+        self._started = False
+        # 以下は送信スレッドだけが触る
+        self._sent: Dict[tuple, dict] = {}
+        self._sent_connection = -1
+
+    def push(self, watcher_id: str, session: str, status: dict) -> None:
+        key = (watcher_id, session)
+        with self._cond:
+            self._latest[key] = dict(status)
+            self._pending[key] = self._latest[key]
+            if not self._started:
+                self._started = True
+                threading.Thread(target=self._loop, daemon=True, name="status-pusher").start()
+            self._cond.notify()
+
+    def resend_all(self) -> None:
+        """チャネルを張り直したとき、relay 側のキャッシュを作り直すために全セッション分を送る"""
+        with self._cond:
+            if not self._latest:
+                return
+            self._pending.update(self._latest)
+            self._cond.notify()
+
+    def _loop(self) -> None:
+        # 送り直し待ちのセッション -> 送り直す時刻（送信スレッドだけが触る）
+        retry_at: Dict[tuple, float] = {}
+        while True:
+            with self._cond:
+                while not self._pending:
+                    if not retry_at:
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    due = [key for key, at in retry_at.items() if at <= now]
+                    for key in due:
+                        del retry_at[key]
+                        self._pending[key] = self._latest[key]
+                    if not due:
+                        self._cond.wait(timeout=min(retry_at.values()) - now)
+                items, self._pending = self._pending, {}
+            for key, status in items.items():
+                retry_at.pop(key, None)
+                ok = False
+                try:
+                    ok = self._send(key[0], key[1], status)
+                except Exception as e:
+                    print(f"[RT] Failed to push status: {e}", flush=True)
+                if not ok and (RELAY_LOG_URL or _relay_channel is not None):
+                    retry_at[key] = time.monotonic() + STATUS_RETRY_SEC
+
+    def _send(self, watcher_id: str, session: str, status: dict) -> bool:
+        key = (watcher_id, session)
+        channel = _relay_channel
+        if channel is not None and channel.connected:
+            if channel.connection_id != self._sent_connection:
+                self._sent.clear()
+                self._sent_connection = channel.connection_id
+            previous = self._sent.get(key)
+            changed = status if previous is None else {k: v for k, v in status.items() if previous.get(k) != v}
+            if not changed:
+                return True
+            frame = {"type": "status", "watcherId": watcher_id, "session": session,
+                     "status": changed, "full": previous is None}
+            if channel.send(frame):
+                self._sent[key] = status
+                return True
+        self._sent.pop(key, None)
+        if not RELAY_LOG_URL:
+            return False
+        # チャネルが無いときは HTTP で全体を送る（小さいので差分にしない）
+        url = (
+            f"{RELAY_LOG_URL.rstrip('/')}/watchers/{urllib.parse.quote(watcher_id, safe='')}"
+            f"/sessions/{urllib.parse.quote(session, safe='')}/status"
+        )
+        body = json.dumps({"status": status, "full": True}, ensure_ascii=False).encode("utf-8")
+        try:
+            req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                return resp.status == 200
+        except Exception:
+            # 旧 relay は .watcher_status.json（rsync）を読む
+            return False
+
+
+_status_pusher = StatusPusher()
+
+
+# ===== Heartbeat =====
+# relay のメモリ上のレジストリへ生存を直接知らせる（_registry/*.json の rsync より早く反映される）。
+# チャネル接続中はそのフレームで、未接続なら POST /watchers/{wid}/heartbeat で送る。
+HEARTBEAT_SEC = float(os.environ.get("WATCHER_HEARTBEAT_SEC", "5"))
+
+
+def send_heartbeat() -> bool:
+    display_name = os.environ.get("DISPLAY_NAME", WATCHER_ID)
+    frame = {"type": "heartbeat", "displayName": display_name, "intervalSec": HEARTBEAT_SEC}
+    if _relay_channel is not None and _relay_channel.send(frame):
+        return True
+    if not RELAY_LOG_URL:
+        return False
+    url = f"{RELAY_LOG_URL.rstrip('/')}/watchers/{WATCHER_ID}/heartbeat"
+    body = json.dumps({"displayName": display_name, "intervalSec": HEARTBEAT_SEC}, ensure_ascii=False).encode("utf-8")
+    try:
+        req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(req, timeout=HEARTBEAT_SEC) as resp:
+            return resp.status == 200
+    except Exception:
+        # 旧 relay（エンドポイント無し）や一時的な切断は _registry/*.json の rsync に任せる
+        return False
+
+
+def _heartbeat_loop() -> None:
+    # 送信にかかった時間を差し引き、HEARTBEAT_SEC ごとに送る（relay は 3 倍で期限切れにする）
+    while True:
+        started = time.monotonic()
+        send_heartbeat()
+        time.sleep(max(0.0, HEARTBEAT_SEC - (time.monotonic() - started)))
 
 
 POLL_SEC = float(os.environ.get("WATCHER_POLL_SEC", "0.5"))
-STAGED_CLEANUP_INTERVAL = 300.0   # 5 分ごと
 STAGED_MAX_AGE = 3600.0           # 1 時間以上経過した staged を削除
+STAGED_DOWNLOAD_TTL = 60.0        # ダウンロード用 staged は relay の取得後を想定して 60 秒
+# watcher_manager_rt.sh が rsync pull で受け取った .staged_uploads/* のパス一覧を置くディレクトリ。
+# 1 回の pull ごとに 1 ファイル（tmp → mv で置く）。中の各行は LOCAL_WATCHER_DIR からの相対パス
+STAGED_NOTIFY_DIR = os.environ.get("WATCHER_STAGED_NOTIFY_DIR", "")
+
+
+class StagedExpiry:
+    """staged ファイル・完了記録の削除予定を期限順のヒープで持ち、期限が来たものだけ消す。
+    ディレクトリを定期的に走査しない（走査は起動時のクラッシュ復旧 _sweep_staged_files だけ）。
+    rsync で届いたアップロードは、届いた時点の通知（_register_received_uploads）で登録する"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap: List[tuple] = []
+        # path -> 最新の期限。同じパスを登録し直したら古いヒープ要素は無視する
+        self._deadlines: Dict[str, float] = {}
+        self._started = False
+
+    def register(self, path: Path, ttl: float, replace: bool = True) -> None:
+        """path を ttl 秒後に消す。replace=False なら既に登録済みのパスはそのまま"""
+        key = str(path)
+        with self._cond:
+            if not replace and key in self._deadlines:
+                return
+            deadline = time.time() + ttl
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, key))
+            if not self._started:
+                self._started = True
+                threading.Thread(target=self._loop, daemon=True, name="staged-expiry").start()
+            self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.time()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(timeout=wait)
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, key = heapq.heappop(self._heap)
+                    if self._deadlines.get(key) == deadline:
+                        del self._deadlines[key]
+                        due.append(key)
+            for path in due:
+                _unlink_staged(Path(path))
+
+
+def _unlink_staged(p: Path) -> bool:
+    try:
+        p.unlink(missing_ok=True)
+        return True
+    except OSError:
+        try:
+            os.chmod(p, 0o644)
+            p.unlink(missing_ok=True)
+            return True
+        except Exception:
+            return False
 
 
-def _cleanup_staged_files_loop():
-    """古い .staged_for_download* と .staged_uploads/* を定期的に削除"""
-    while True:
+_staged_expiry = StagedExpiry()
+
+
+def _sweep_staged_files() -> None:
+    """起動時のクラッシュ復旧: 前回のプロセスが消し損ねた staged と完了記録を片付け、残りは期限を登録する"""
+    local_watcher_dir = Path(os.environ.get("LOCAL_WATCHER_DIR", str(BASE_DIR.parent)))
+    if not local_watcher_dir.is_dir():
+        return
+    now = time.time()
+
+    def _expire(p: Path, max_age: float) -> None:
+        age = now - p.stat().st_mtime
+        if age >= max_age:
+            _unlink_staged(p)
+        else:
+            _staged_expiry.register(p, max_age - age, replace=False)
+
+    for session_dir in local_watcher_dir.iterdir():
+        if not session_dir.is_dir():
+            continue
         try:
-            time.sleep(STAGED_CLEANUP_INTERVAL)
-            local_watcher_dir = Path(os.environ.get("LOCAL_WATCHER_DIR", str(BASE_DIR.parent)))
-            if not local_watcher_dir.is_dir():
+            for p in session_dir.glob(".staged_for_download*"):
+                if p.is_file():
+                    _expire(p, STAGED_MAX_AGE)
+            for p in session_dir.glob(f"{COMMAND_DONE_PREFIX}*"):
+                if p.is_file():
+                    _expire(p, COMMAND_DONE_MAX_AGE)
+            uploads = session_dir / ".staged_uploads"
+            if uploads.is_dir():
+                for p in uploads.iterdir():
+                    if p.is_file():
+                        _expire(p, STAGED_MAX_AGE)
+        except Exception as e:
+            print(f"[RT] Staged cleanup error in {session_dir}: {e}", flush=True)
+
+
+class _ReceivedUploads:
+    """STAGED_NOTIFY_DIR の通知を読み、rsync で届いたアップロードに期限を登録する。
+    取り込み（_internal_move_staged_file）が来ないまま残るファイルも STAGED_MAX_AGE で消える。
+    ポーリングごとに見るのは通知ディレクトリの mtime だけ"""
+
+    def __init__(self, local_watcher_dir: Path):
+        self.local_watcher_dir = local_watcher_dir
+        self._mtime_ns: Optional[int] = None
+
+    def poll(self) -> None:
+        if not STAGED_NOTIFY_DIR:
+            return
+        notify_dir = Path(STAGED_NOTIFY_DIR)
+        try:
+            mtime_ns = notify_dir.stat().st_mtime_ns
+        except OSError:
+            return
+        if mtime_ns == self._mtime_ns:
+            return
+        self._mtime_ns = mtime_ns
+        for note in notify_dir.iterdir():
+            if note.name.startswith(".") or not note.is_file():
                 continue
-            cutoff = time.time() - STAGED_MAX_AGE
-            for session_dir in local_watcher_dir.iterdir():
-                if not session_dir.is_dir():
+            try:
+                lines = note.read_text(encoding="utf-8", errors="replace").splitlines()
+            except OSError:
+                continue
+            now = time.time()
+            for line in lines:
+                rel = Path(line.strip())
+                if not line.strip() or rel.is_absolute() or ".." in rel.parts or len(rel.parts) < 3:
                     continue
+                if rel.parts[-2] != ".staged_uploads":
+                    continue
+                p = self.local_watcher_dir / rel
                 try:
-                    for p in session_dir.glob(".staged_for_download*"):
-                        if p.is_file() and p.stat().st_mtime < cutoff:
-                            p.unlink(missing_ok=True)
-                    uploads = session_dir / ".staged_uploads"
-                    if uploads.is_dir():
-                        for p in uploads.iterdir():
-                            if p.is_file() and p.stat().st_mtime < cutoff:
-                                p.unlink(missing_ok=True)
-                except Exception as e:
-                    print(f"[RT] Staged cleanup error in {session_dir}: {e}", flush=True)
-        except Exception as e:
-            print(f"[RT] Staged cleanup loop error: {e}", flush=True)
+                    age = now - p.stat().st_mtime
+                except OSError:
+                    age = 0.0
+                # 取り込みで既に登録済みならそのまま
+                _staged_expiry.register(p, max(0.0, STAGED_MAX_AGE - age), replace=False)
+            _unlink_staged(note)
+
+
+def _write_command_done(session_dir: Path, cmd_id: str, exit_code: int) -> None:
+    """commands.txt 経由のコマンド完了記録。relay はこのファイルの出現で待機を解く（tmp → rename で原子的に置く）"""
+    record = session_dir / f"{COMMAND_DONE_PREFIX}{cmd_id}"
+    tmp = session_dir / f".tmp{COMMAND_DONE_PREFIX}{cmd_id}"
+    try:
+        tmp.write_text(json.dumps({"id": cmd_id, "exitCode": exit_code, "finishedAt": time.time()}), encoding="utf-8")
+        os.replace(tmp, record)
+        _staged_expiry.register(record, COMMAND_DONE_MAX_AGE)
+    except Exception as e:
+        print(f"[RT] Failed to write command done record: {e}", flush=True)
+
+
+class CommandFileTail:
+    """commands.txt の追記分だけを読むセッションごとのリーダ。
+    処理済み位置はバイト offset として .commands.offset に "bytes:<n>" 形式で保存する
+    （旧形式の行数は初回に一度だけバイト位置へ換算）。サイズと mtime が変わらなければ読まない。
+    ファイルが置き換わった（inode が変わった）・短くなった・位置の直前が改行でない場合は、
+    .commands.offset から位置を取り直し、それも合わなければ先頭から読む"""
+
+    def __init__(self, session_dir: Path):
+        self.cmd_file = session_dir / "commands.txt"
+        self.offset_file = session_dir / ".commands.offset"
+        self.pos = self._load_offset()
+        self._sig: Optional[tuple] = None
+        # 最後に読んだ commands.txt の (st_dev, st_ino)
+        self._ident: Optional[tuple] = None
+
+    def _load_offset(self) -> int:
+        try:
+            raw = self.offset_file.read_text(encoding="utf-8").strip()
+        except OSError:
+            # 新規セッションやバックエンドが commands.txt を新規作成した直後は 0 から処理する
+            # （末尾から始めると最初の行をスキップしてしまい Rename / create file 等が動かない）
+            return 0
+        try:
+            if raw.startswith(OFFSET_BYTES_PREFIX):
+                return int(raw[len(OFFSET_BYTES_PREFIX):])
+            line_count = int(raw or "0")
+        except ValueError:
+            try:
+                return self.cmd_file.stat().st_size
+            except OSError:
+                return 0
+        pos = 0
+        try:
+            with self.cmd_file.open("rb") as f:
+                for _ in range(line_count):
+                    line = f.readline()
+                    if not line:
+                        break
+                    pos += len(line)
+        except OSError:
+            pass
+        return pos
+
+    def reset(self) -> None:
+        self.pos = 0
+        self._sig = None
+        self._ident = None
+
+    def _at_line_start(self, f, pos: int, size: int) -> bool:
+        if pos == 0:
+            return True
+        if pos > size:
+            return False
+        f.seek(pos - 1)
+        return f.read(1) == b"\n"
+
+    def _resync(self, f, size: int) -> None:
+        """今の位置が行頭でなければ .commands.offset → 先頭の順に取り直す"""
+        if self._at_line_start(f, self.pos, size):
+            return
+        saved = self._load_offset()
+        self.pos = saved if self._at_line_start(f, saved, size) else 0
+        print(f"[RT] commands.txt changed under the reader; resuming at byte {self.pos}: {self.cmd_file}", flush=True)
+
+    def read_new_lines(self) -> List[tuple]:
+        """前回位置以降の完結した行を [(line, 行末のバイト位置), ...] で返す"""
+        try:
+            st = self.cmd_file.stat()
+        except OSError:
+            return []
+        sig = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        if sig == self._sig:
+            return []
+        ident = (st.st_dev, st.st_ino)
+        try:
+            with self.cmd_file.open("rb") as f:
+                if ident != self._ident:
+                    # rsync などで置き換わった。保存済みの位置が今のファイルでも行頭かを確かめる
+                    self._ident = ident
+                    saved = self._load_offset()
+                    if saved != self.pos and self._at_line_start(f, saved, st.st_size):
+                        self.pos = saved
+                # クリア後に元の長さ以上まで書き足された場合も、位置の直前が改行でなくなるので気づける
+                self._resync(f, st.st_size)
+                if st.st_size == self.pos:
+                    # 読み切った状態のときだけ覚える（未処理行が残っていれば次回も読む）
+                    self._sig = sig
+                    return []
+                f.seek(self.pos)
+                data = f.read(st.st_size - self.pos)
+        except OSError:
+            return []
+        # 改行で終わっていない末尾（書き込み途中）は次回に回す
+        end = data.rfind(b"\n")
+        if end < 0:
+            return []
+        out: List[tuple] = []
+        pos = self.pos
+        for raw in data[:end].split(b"\n"):
+            pos += len(raw) + 1
+            out.append((raw.decode("utf-8", errors="replace"), pos))
+        return out
+
+    def commit(self, pos: int) -> None:
+        self.pos = pos
+        try:
+            self.offset_file.write_text(f"{OFFSET_BYTES_PREFIX}{pos}", encoding="utf-8")
+        except Exception:
+            pass
+
+
+_command_tails: Dict[str, CommandFileTail] = {}
+_command_tails_lock = threading.Lock()
+
+
+def get_command_tail(session_dir: Path) -> CommandFileTail:
+    with _command_tails_lock:
+        key = str(session_dir)
+        if key not in _command_tails:
+            _command_tails[key] = CommandFileTail(session_dir)
+        return _command_tails[key]
+
+
+def reset_command_file(session_dir: Path) -> None:
+    """commands.txt と .commands.offset を空に戻し、ポーリングの読み位置も先頭に戻す"""
+    cmd_file = session_dir / "commands.txt"
+    offset_file = session_dir / ".commands.offset"
+    with _command_tails_lock:
+        try:
+            if cmd_file.exists():
+                cmd_file.write_text("", encoding="utf-8")
+            if offset_file.exists():
+                offset_file.write_text("0", encoding="utf-8")
+        except Exception:
+            pass
+        tail = _command_tails.get(str(session_dir))
+        if tail is not None:
+            tail.reset()
 
 
 def _poll_commands_loop():
-    """内部コマンド用: commands.txt をポーリング（rsync で取り込まれた分を処理）"""
+    """内部コマンド用: commands.txt をポーリング（rsync で取り込まれた分を処理）。
+    各セッションは stat で変化を見て、追記されたバイトだけを読む"""
     local_watcher_dir = Path(os.environ.get("LOCAL_WATCHER_DIR", str(BASE_DIR.parent)))
     watcher_id = os.environ.get("WATCHER_ID", "default")
-    offsets: dict[str, int] = {}
+    # セッションごとの「次の行に付ける完了記録 ID」（relay が "#@cmd-id <id>" 行で指定）
+    pending_ids: dict[str, str] = {}
+    received_uploads = _ReceivedUploads(local_watcher_dir)
 
     while True:
         try:
             if not local_watcher_dir.is_dir():
                 time.sleep(POLL_SEC)
                 continue
+            received_uploads.poll()
             for session_dir in local_watcher_dir.iterdir():
                 if not session_dir.is_dir():
                     continue
                 session = session_dir.name
-                cmd_file = session_dir / "commands.txt"
-                offset_file = session_dir / ".commands.offset"
-                if not cmd_file.exists():
-                    continue
-                try:
-                    lines = cmd_file.read_text("utf-8", errors="replace").splitlines()
-                except Exception:
-                    continue
-                start = offsets.get(session)
-                if start is None:
-                    if offset_file.exists():
-                        try:
-                            start = min(int(offset_file.read_text(encoding="utf-8").strip()), len(lines))
-                        except (ValueError, OSError):
-                            start = len(lines)
-                    else:
-                        # 新規セッションやバックエンドが commands.txt を新規作成した直後は 0 から処理する
-                        # （start = len(lines) だと最初の行をスキップしてしまい Rename / create file 等が動かない）
-                        start = 0
-                    offsets[session] = start
-                if start > len(lines):
-                    start = len(lines)
-                    offsets[session] = start
-                for i, line in enumerate(lines[start:], start=start):
+                tail = get_command_tail(session_dir)
+                for line, end_pos in tail.read_new_lines():
                     cmd = line.strip()
+                    if cmd.startswith(COMMAND_ID_LINE_PREFIX):
+                        pending_ids[session] = cmd[len(COMMAND_ID_LINE_PREFIX):].strip()
                     if not cmd or cmd.startswith("#"):
-                        offsets[session] = i + 1
+                        tail.pos = end_pos
                         continue
                     base_dir = session_dir
                     ctx = get_session(base_dir, watcher_id=watcher_id, session_name=session)
+                    req = CommandRequest(cmd)
                     try:
-                        output, _, _ = ctx.execute(cmd)
+                        output, exit_code, _ = ctx.scheduler.run(ctx, req)
                     except Exception as e:
                         output = str(e)
+                        exit_code = 1
                     log_text = output if output.endswith("\n") else output + "\n"
-                    if RELAY_LOG_URL:
+                    if RELAY_LOG_URL and not req.streamed and not req.silent:
                         post_log_to_relay(watcher_id, session, log_text)
-                    try:
-                        offset_file.write_text(str(i + 1), encoding="utf-8")
-                    except Exception:
-                        pass
-                    offsets[session] = i + 1
+                    tail.commit(end_pos)
+                    cmd_id = pending_ids.pop(session, None)
+                    if cmd_id and _SAFE_CMD_ID.match(cmd_id):
+                        _write_command_done(session_dir, cmd_id, exit_code)
         except Exception as e:
             print(f"[RT] Poll error: {e}", flush=True)
         time.sleep(POLL_SEC)
@@ -919,10 +3482,16 @@ def main():
 
     poll_thread = threading.Thread(target=_poll_commands_loop, daemon=True)
     poll_thread.start()
-    cleanup_thread = threading.Thread(target=_cleanup_staged_files_loop, daemon=True)
+    cleanup_thread = threading.Thread(target=_sweep_staged_files, daemon=True)
     cleanup_thread.start()
-
-    server = ThreadedHTTPServer(("0.0.0.0", port), RTRequestHandler)
+    if DOCKER_WARM_ENABLED:
+        _docker_warm_pool.cleanup_stale()
+    channel = start_relay_channel()
+    print(f"[RT Watcher] Relay channel: {channel.url if channel else '(disabled)'}", flush=True)
+    heartbeat_thread = threading.Thread(target=_heartbeat_loop, daemon=True)
+    heartbeat_thread.start()
+
+    server = PooledHTTPServer(("0.0.0.0", port), RTRequestHandler)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
@@ -583,6 +583,23 @@ export const AiChatPanel: React.FC<AiChatPanelProps> = ({ fallbackEditorPath = n
             messages: [...(prev[mid]?.messages ?? []), { role: "assistant", text: "" }]
           }
         }));
+        // Agent ループの途中経過（モデル出力）を表示中か。最終回答の token / done が来たら置き換える
+        let agentStreaming = false;
+        let answerStarted = false;
+        // command_end で逐次追加したログは done の logs と重複させない
+        let streamedLogs = false;
+        const updateLastAssistant = (fn: (text: string) => string) => {
+          setChats((prev) => {
+            const cur = prev[mid];
+            if (!cur) return prev;
+            const msgs = cur.messages ?? [];
+            if (!msgs.length) return prev;
+            const last = msgs[msgs.length - 1];
+            if (!last || last.role !== "assistant") return prev;
+            const nextLast = { ...last, text: fn(last.text ?? "") };
+            return { ...prev, [mid]: { ...cur, messages: [...msgs.slice(0, -1), nextLast] } };
+          });
+        };
         await api.streamAi(
           currentWatcher.id,
           currentSession.name,
@@ -603,21 +620,49 @@ export const AiChatPanel: React.FC<AiChatPanelProps> = ({ fallbackEditorPath = n
           },
           (ev) => {
             if (ev.type === "token" && ev.delta) {
+              const delta = ev.delta;
+              if (agentStreaming && !answerStarted) {
+                answerStarted = true;
+                updateLastAssistant(() => delta);
+              } else {
+                updateLastAssistant((text) => text + delta);
+              }
+            }
+            if (ev.type === "agent_step" && agentStreaming && (ev.step ?? 0) > 0) {
+              updateLastAssistant((text) => (text.endsWith("\n") || !text ? text : text + "\n\n"));
+            }
+            if (ev.type === "agent_token" && ev.delta) {
+              const delta = ev.delta;
+              agentStreaming = true;
+              updateLastAssistant((text) => text + delta);
+            }
+            if (ev.type === "command_start" && ev.command) {
+              const command = ev.command;
+              updateLastAssistant((text) => `${text}${text && !text.endsWith("\n") ? "\n" : ""}$ ${command}\n`);
+            }
+            if (ev.type === "command_end" && ev.command) {
+              streamedLogs = true;
+              const entry: AgentLogEntry = {
+                command: ev.command,
+                exitCode: ev.exitCode ?? undefined,
+                output: ev.output ?? undefined,
+                error: ev.error ?? undefined
+              };
               setChats((prev) => {
-                const cur = prev[mid];
-                if (!cur) return prev;
-                const msgs = cur.messages ?? [];
-                if (!msgs.length) return prev;
-                const last = msgs[msgs.length - 1];
-                if (!last || last.role !== "assistant") return prev;
-                const nextLast = { ...last, text: (last.text ?? "") + ev.delta };
-                const nextMsgs = [...msgs.slice(0, -1), nextLast];
+                const original = prev[mid];
+                const curLogs = Array.isArray(original?.logs) ? (original!.logs as AgentLogEntry[]) : [];
                 return {
                   ...prev,
-                  [mid]: { ...cur, messages: nextMsgs }
+                  [mid]: {
+                    ...(original ?? { name: undefined, messages: [] as Message[] }),
+                    logs: [...curLogs, entry]
+                  }
                 };
               });
             }
+            if (ev.type === "error") {
+              updateLastAssistant(() => `Error: ${ev.detail ?? "Request failed"}`);
+            }
             if (ev.type === "debate_turn" && ev.debateId && ev.turn) {
               setChats((prev) => {
                 const cur = prev[mid] || { name: undefined, messages: [] as Message[] };
@@ -653,6 +698,11 @@ export const AiChatPanel: React.FC<AiChatPanelProps> = ({ fallbackEditorPath = n
               });
             }
             if (ev.type === "done") {
+              // Agent の途中経過を表示していた場合は最終回答で置き換える
+              if (agentStreaming && ev.result) {
+                const result = ev.result;
+                updateLastAssistant(() => result);
+              }
               // token ストリームが空だった場合でも、最終結果は done.result で補完する
               if (ev.result) {
                 setChats((prev) => {
@@ -668,7 +718,10 @@ export const AiChatPanel: React.FC<AiChatPanelProps> = ({ fallbackEditorPath = n
                   return { ...prev, [mid]: { ...cur, messages: [...msgs.slice(0, -1), nextLast] } };
                 });
               }
-              const logs = ev.logs;
+              // command_end で追加済みのコマンドログは除き、edit 提案のログだけ足す
+              const logs = streamedLogs
+                ? (ev.logs ?? []).filter((l) => l.command.startsWith("[edit proposed]"))
+                : ev.logs;
               const debates = ev.debates;
               if (logs && logs.length) {
                 setChats((prev) => {
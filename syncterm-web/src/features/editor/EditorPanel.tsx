@@ -341,8 +341,9 @@ function trimEchoedPrefix(prefix: string, completion: string): string {
 }
 
 function sanitizeInlineCompletion(raw: string, prefix: string): string {
-  let text = (raw || "").replace(/\r\n/g, "\n").trim();
-  if (!text) return "";
+  // 先頭の改行・空白は残す（FIM の補完は「改行して次の行へ」「空白を挟んで続ける」から始まることがある）
+  let text = (raw || "").replace(/\r\n/g, "\n").trimEnd();
+  if (!text.trim()) return "";
   const lines = text.split("\n");
   const firstLineContent = lines[0] ?? "";
   if (firstLineContent.includes("```")) return "";
@@ -391,6 +392,9 @@ export const EditorPanel: React.FC<EditorPanelProps> = ({
   const [editorInstance, setEditorInstance] = useState<MonacoEditorType.IStandaloneCodeEditor | null>(null);
   const [monacoInstance, setMonacoInstance] = useState<Monaco | null>(null);
   const inlineReqSeqRef = useRef(0);
+  // エディタインスタンスごとの ID（別タブ・別クライアントで同じファイルを開いても要求を取り消し合わない）
+  const inlineEditorIdRef = useRef<string | null>(null);
+  if (inlineEditorIdRef.current === null) inlineEditorIdRef.current = crypto.randomUUID();
   const lastHandledTreeReopenByPathRef = useRef<Record<string, number>>({});
   const { setActiveEditorState, registerApplyToSelection, registerAppendAtCursor, registerFileAppliedFromAi } =
     useActiveEditor();
@@ -841,10 +845,12 @@ export const EditorPanel: React.FC<EditorPanelProps> = ({
             prefix: prefixTrimmed,
             suffix: suffixTrimmed,
             language,
-            model
+            model,
+            // 同じエディタの古い要求は Relay 側でもキャンセルされる
+            requestKey: `editor:${inlineEditorIdRef.current}:${file.path}`
           }, { signal: ctrl.signal });
           if (disposed || reqId !== inlineReqSeqRef.current) return { items: [] };
-          const raw = (out.completion || "").trim();
+          const raw = (out.completion || "").trimEnd();
           const text = sanitizeInlineCompletion(raw, prefixTrimmed);
           if (!text) {
             if (raw && import.meta.env?.DEV) console.warn("[inline] sanitize dropped", { raw: raw.slice(0, 80) });
@@ -36,6 +36,42 @@ export interface BuddyState {
   hints: { id: string; text: string }[];
 }
 
+/** ワークスペース全文検索の条件（POST .../search の本文） */
+export interface WorkspaceSearchQuery {
+  query: string;
+  regex?: boolean;
+  caseSensitive?: boolean;
+  wholeWord?: boolean;
+  hidden?: boolean;
+  /** セッションルートからの相対パス（既定 "."） */
+  path?: string;
+  include?: string[];
+  exclude?: string[];
+  maxResults?: number;
+  maxPerFile?: number;
+  useIndex?: boolean;
+}
+
+export interface WorkspaceSearchMatch {
+  type: "match";
+  path: string;
+  line: number;
+  column: number;
+  matchLength: number;
+  preview: string;
+}
+
+export interface WorkspaceSearchDone {
+  type: "done";
+  matches: number;
+  files: number;
+  truncated: boolean;
+  engine: string;
+  elapsedMs: number;
+  indexAgeMs?: number;
+  indexRevalidated?: number;
+}
+
 export interface SyncApi {
   listWatchers(): Promise<WatcherInfo[]>;
   listSessions(watcherId: string): Promise<SessionInfo[]>;
@@ -203,7 +239,17 @@ export interface SyncApi {
       hybridRouting?: boolean;
     },
     onEvent: (ev: {
-      type: "token" | "done" | "debate_turn";
+      type:
+        | "token"
+        | "done"
+        | "debate_turn"
+        | "agent_step"
+        | "agent_token"
+        | "agent_command"
+        | "agent_edit"
+        | "command_start"
+        | "command_end"
+        | "error";
       delta?: string;
       result?: string;
       command?: string;
@@ -221,6 +267,16 @@ export interface SyncApi {
       }[];
       debateId?: string;
       turn?: { round: number; speaker: string; model: string; role: string; content: string };
+      // Agent ループの途中経過
+      step?: number;
+      commands?: string[];
+      exitCode?: number | null;
+      output?: string;
+      error?: string | null;
+      outputId?: string | null;
+      path?: string;
+      chars?: number;
+      detail?: string;
     }) => void,
     options?: { signal?: AbortSignal }
   ): Promise<void>;
@@ -241,9 +297,9 @@ export interface SyncApi {
   getAiInlineCompletion(
     watcherId: string,
     session: string,
-    payload: { path: string; prefix: string; suffix: string; language?: string; model?: string },
+    payload: { path: string; prefix: string; suffix: string; language?: string; model?: string; requestKey?: string },
     options?: { signal?: AbortSignal }
-  ): Promise<{ completion: string }>;
+  ): Promise<{ completion: string; cancelled?: boolean }>;
 
   getRunnerConfig(watcherId: string, session: string): Promise<RunnerConfig | null>;
   updateRunnerConfig(
@@ -284,6 +340,15 @@ export interface SyncApi {
     source: "nvitop" | "nvidia-smi";
     data?: unknown;
   }>;
+
+  /** ワークスペース全文検索。一致は届いた順に onMatch へ渡し、done フレームで resolve する */
+  searchWorkspace(
+    watcherId: string,
+    session: string,
+    query: WorkspaceSearchQuery,
+    onMatch: (match: WorkspaceSearchMatch) => void,
+    options?: { signal?: AbortSignal }
+  ): Promise<WorkspaceSearchDone>;
 }
 
 // --------------------------------------------------------------------------------
@@ -820,7 +885,17 @@ class HttpSyncApi implements SyncApi {
       hybridRouting?: boolean;
     },
     onEvent: (ev: {
-      type: "token" | "done" | "debate_turn";
+      type:
+        | "token"
+        | "done"
+        | "debate_turn"
+        | "agent_step"
+        | "agent_token"
+        | "agent_command"
+        | "agent_edit"
+        | "command_start"
+        | "command_end"
+        | "error";
       delta?: string;
       result?: string;
       command?: string;
@@ -838,6 +913,16 @@ class HttpSyncApi implements SyncApi {
       }[];
       debateId?: string;
       turn?: { round: number; speaker: string; model: string; role: string; content: string };
+      // Agent ループの途中経過
+      step?: number;
+      commands?: string[];
+      exitCode?: number | null;
+      output?: string;
+      error?: string | null;
+      outputId?: string | null;
+      path?: string;
+      chars?: number;
+      detail?: string;
     }) => void,
     options?: { signal?: AbortSignal }
   ): Promise<void> {
@@ -922,10 +1007,10 @@ class HttpSyncApi implements SyncApi {
   async getAiInlineCompletion(
     watcherId: string,
     session: string,
-    payload: { path: string; prefix: string; suffix: string; language?: string; model?: string },
+    payload: { path: string; prefix: string; suffix: string; language?: string; model?: string; requestKey?: string },
     options?: { signal?: AbortSignal }
-  ): Promise<{ completion: string }> {
-    return http<{ completion: string }>(
+  ): Promise<{ completion: string; cancelled?: boolean }> {
+    return http<{ completion: string; cancelled?: boolean }>(
       `/watchers/${encodeURIComponent(watcherId)}/sessions/${encodeURIComponent(session)}/ai-inline`,
       {
         method: "POST",
@@ -1004,6 +1089,62 @@ class HttpSyncApi implements SyncApi {
       `/watchers/${encodeURIComponent(watcherId)}/sessions/${encodeURIComponent(session)}/gpu-status`
     );
   }
+
+  async searchWorkspace(
+    watcherId: string,
+    session: string,
+    query: WorkspaceSearchQuery,
+    onMatch: (match: WorkspaceSearchMatch) => void,
+    options?: { signal?: AbortSignal }
+  ): Promise<WorkspaceSearchDone> {
+    const path = `/watchers/${encodeURIComponent(watcherId)}/sessions/${encodeURIComponent(session)}/search`;
+    const res = await fetch(`${BACKEND_URL}${path}`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(query),
+      signal: options?.signal
+    });
+    if (!res.ok) {
+      const text = await res.text();
+      throw new Error(`HTTP ${res.status}: ${text}`);
+    }
+    const reader = res.body?.getReader();
+    if (!reader) throw new Error("No body");
+    const dec = new TextDecoder();
+    let buf = "";
+    // 1 行 1 JSON（match... / done、途中で切れたときは error）
+    const handle = (line: string): WorkspaceSearchDone | null => {
+      if (!line.trim()) return null;
+      let ev: { type?: string; error?: string };
+      try {
+        ev = JSON.parse(line);
+      } catch {
+        return null;
+      }
+      if (ev.type === "match") onMatch(ev as WorkspaceSearchMatch);
+      else if (ev.type === "done") return ev as WorkspaceSearchDone;
+      else if (ev.type === "error") throw new Error(ev.error ?? "Search failed");
+      return null;
+    };
+    try {
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buf += dec.decode(value, { stream: true });
+        const lines = buf.split("\n");
+        buf = lines.pop() ?? "";
+        for (const line of lines) {
+          const result = handle(line);
+          if (result) return result;
+        }
+      }
+      const result = handle(buf);
+      if (result) return result;
+      throw new Error("Search stream ended without a done frame");
+    } finally {
+      reader.releaseLock();
+    }
+  }
 }
 
 export const api: SyncApi = new HttpSyncApi();
@@ -0,0 +1,51 @@
+"""command_watcher_rt の /command ストリーム応答（stream: true）のフレーム"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+
+import command_watcher_rt as watcher  # noqa: E402
+
+
+class CommandStreamFramesTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._env = os.environ.get("LOCAL_WATCHER_DIR")
+        os.environ["LOCAL_WATCHER_DIR"] = self._tmp.name
+
+    def tearDown(self):
+        if self._env is None:
+            os.environ.pop("LOCAL_WATCHER_DIR", None)
+        else:
+            os.environ["LOCAL_WATCHER_DIR"] = self._env
+        self._tmp.cleanup()
+
+    def _run(self, command: str) -> list:
+        err, run = watcher.prepare_command_stream({"session": "s1", "command": command, "stream": True})
+        self.assertIsNone(err)
+        frames = []
+        run(frames.append)
+        return frames
+
+    def _output_text(self, frames: list) -> str:
+        return "\n".join(f["text"] for f in frames if f["type"] == "output")
+
+    def test_shell_output_is_sent_once(self):
+        frames = self._run("printf 'a\\nb\\n'")
+        self.assertEqual(frames[-1]["type"], "exit")
+        self.assertEqual(frames[-1]["exitCode"], 0)
+        text = self._output_text(frames)
+        lines = [line for line in text.split("\n") if not line.startswith(watcher.EOC_MARKER_PREFIX)]
+        self.assertEqual(lines.count("a"), 1, text)
+        self.assertEqual(lines.count("b"), 1, text)
+
+    def test_internal_result_is_still_sent(self):
+        frames = self._run("_internal_clear_commands")
+        self.assertIn("commands.txt", self._output_text(frames))
+
+
+if __name__ == "__main__":
+    unittest.main()
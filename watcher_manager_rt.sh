@@ -75,6 +75,8 @@ LOCAL_BASE="${WATCHER_LOCAL_DIR:-${WATCHER_MIRROR_DIR:-$HOME/watcher_local_mirro
 LOCAL_SESSIONS_ROOT="$LOCAL_BASE/$SESSIONS_DIR_NAME"
 LOCAL_WATCHER_DIR="$LOCAL_SESSIONS_ROOT/$WATCHER_ID"
 LOCAL_REGISTRY_DIR="$LOCAL_BASE/$REGISTRY_DIR_NAME"
+# rsync pull で届いた .staged_uploads/* を Watcher に知らせる（Watcher はここを見て削除期限を登録する）
+STAGED_NOTIFY_DIR="$LOCAL_BASE/.staged_received_${WATCHER_ID}"
 
 SSH_OPTS="-o BatchMode=yes -o StrictHostKeyChecking=accept-new -o ConnectTimeout=5 -o ServerAliveInterval=15 -o ServerAliveCountMax=2"
 RSYNC_TIMEOUT="${RSYNC_TIMEOUT:-10}"
@@ -147,9 +149,11 @@ start_watcher_rt() {
   WATCHER_ID="$WATCHER_ID" \
   DISPLAY_NAME="$DISPLAY_NAME" \
   LOCAL_WATCHER_DIR="$LOCAL_WATCHER_DIR" \
+  WATCHER_STAGED_NOTIFY_DIR="$STAGED_NOTIFY_DIR" \
   RT_RELAY_LOG_URL="http://127.0.0.1:${RELAY_LOCAL_PORT}" \
   REMOTE_SESSIONS_ROOT="$BASE_REMOTE" \
   REGISTRY_DIR_NAME="$REGISTRY_DIR_NAME" \
+  WATCHER_HEARTBEAT_SEC="$INTERVAL" \
   DOCKER_CONTAINER_NAME="${DOCKER_CONTAINER_NAME:-}" \
   DOCKER_IMAGE_NAME="${DOCKER_IMAGE_NAME:-}" \
   DOCKER_WORK_DIR="${DOCKER_WORK_DIR:-/workspace}" \
@@ -179,7 +183,7 @@ trap cleanup EXIT
 
 # ===== メイン =====
 echo "[RT] Started for WATCHER_ID='${WATCHER_ID}' DISPLAY_NAME='${DISPLAY_NAME}'"
-mkdir -p "$LOCAL_WATCHER_DIR" "$LOCAL_REGISTRY_DIR" "$PID_DIR"
+mkdir -p "$LOCAL_WATCHER_DIR" "$LOCAL_REGISTRY_DIR" "$PID_DIR" "$STAGED_NOTIFY_DIR"
 # セッションが一つも無い場合は default を自動作成（初起動時）
 if [ -z "$(find "$LOCAL_WATCHER_DIR" -maxdepth 1 -type d ! -path "$LOCAL_WATCHER_DIR" 2>/dev/null | head -1)" ]; then
   mkdir -p "${LOCAL_WATCHER_DIR}/default"
@@ -205,10 +209,13 @@ while true; do
     --exclude '*/.runner_config.json' \
     --exclude '*/.staged_uploads/' \
     --exclude '*/.staged_uploads/**' \
+    --exclude '*/.search_index.json.gz*' \
+    --exclude '*/.command_output/' \
     "$LOCAL_WATCHER_DIR/" "$SERVER:$REMOTE_WATCHER_DIR/"
 
-  # Rsync: pull
-  run_nofail rsync_pull \
+  # Rsync: pull（受け取ったファイル名を出し、.staged_uploads/* だけを通知として Watcher に渡す）
+  received_tmp="$STAGED_NOTIFY_DIR/.tmp.$$"
+  run_nofail rsync_pull --out-format='%n' \
     --include '*/' \
     --include '*/commands.txt' \
     --include '*/.runner_config.json' \
@@ -217,7 +224,13 @@ while true; do
     --include '*/.staged_uploads/' \
     --include '*/.staged_uploads/**' \
     --exclude '*' \
-    "$SERVER:$REMOTE_WATCHER_DIR/" "$LOCAL_WATCHER_DIR/"
+    "$SERVER:$REMOTE_WATCHER_DIR/" "$LOCAL_WATCHER_DIR/" \
+    | grep '/\.staged_uploads/[^/][^/]*$' > "$received_tmp" || true
+  if [[ -s "$received_tmp" ]]; then
+    mv "$received_tmp" "$STAGED_NOTIFY_DIR/$(date +%s).$$"
+  else
+    rm -f "$received_tmp"
+  fi
 
   # RT: トンネルと watcher 起動
   start_tunnel